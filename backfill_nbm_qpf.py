@@ -0,0 +1,237 @@
+#!/usr/local/anaconda3/envs/py37/bin/python
+
+"""-------------------------------------------------------------
+	Script Name: 	backfill_nbm_qpf.py
+	Description: 	Convert and evaluate a range of NBM QPF inits, resumable
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, datetime, time, traceback, argparse
+import concurrent.futures
+import process_nbm_qpf
+import find_nbm_qpf_stats
+import run_state
+from process_nbm_qpf import convertHour, initJobs, initWorker, makeOutputDirs, printSummary, recordMetrics
+from find_nbm_qpf_stats import evaluateRun, processRun
+from fire_catalog import loadCatalog
+from run_state import openState, transaction, recordConversions, convertedHours, statsHours
+from pipeline_metrics import startRun, finishRun, addTime, addCount, event
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+current_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+# backfilled GeoTiffs, images, json and checkpoints go under their own root, out of reach of the
+# live retention windows
+backfill_dir = current_dir + "/data/nbm/backfill"
+
+# conversion and stats worker processes
+workers = int(os.environ.get("NBM_QPF_WORKERS", 4))
+stats_workers = max(workers // 4, 1)
+
+#-------------------------------------------------------
+# Point both scripts at the backfill tree
+#------------------------------------------------------
+def configure(data_root, redo=False):
+	"""
+	this function will set the output directories and run-state store of the conversion and stats
+	modules to data_root, in the parent and in every worker process
+	"""
+	process_nbm_qpf.geotiff_dir = data_root + "/geotiff"
+	process_nbm_qpf.images_dir = data_root + "/images"
+	process_nbm_qpf.use_run_state = True
+	process_nbm_qpf.process_again = redo
+
+	find_nbm_qpf_stats.data_dir = data_root + "/json"
+	find_nbm_qpf_stats.nbm_data_dir = data_root + "/geotiff"
+	find_nbm_qpf_stats.nbm_images_dir = data_root + "/images"
+	find_nbm_qpf_stats.use_run_state = True
+	find_nbm_qpf_stats.incremental = not redo
+
+	run_state.state_file = data_root + "/run_state.sqlite"
+
+	os.makedirs(find_nbm_qpf_stats.data_dir, exist_ok=True)
+
+def initBackfillWorker(data_root, redo, stats=False):
+	"""
+	this function will set up a worker process: GDAL cache and backfill tree, and for stats workers
+	the fire catalog loaded once so every init the worker handles reuses it (fire masks and remap
+	tables are cached the same way on first use)
+	"""
+	initWorker()
+	configure(data_root, redo)
+	if stats:
+		loadCatalog(find_nbm_qpf_stats.fire_sources, find_nbm_qpf_stats.catalog_file)
+
+#-------------------------------------------------------
+# Checkpoints
+#------------------------------------------------------
+def resetInits(conn, inits):
+	"""
+	this function will clear the checkpoints of inits so --redo converts and evaluates them again
+	"""
+	with transaction(conn):
+		conn.executemany("""
+			UPDATE hours SET convert_status = 'pending', convert_attempts = 0, stats_status = 'pending'
+			WHERE init = ?""", [ (dt.strftime("%Y%m%d%H"),) for dt in inits ])
+
+def needsStats(conn, dt):
+	"""
+	this function will check an init has converted hours missing from its fire output
+	"""
+	init = dt.strftime("%Y%m%d%H")
+	converted = convertedHours(conn, init)
+	return len(converted) > 0 and set(statsHours(conn, init)) != set(converted)
+
+#-------------------------------------------------------
+# Stats unit of one init (worker process)
+#------------------------------------------------------
+def backfillStats(dt, gate=False):
+	"""
+	this function will evaluate the fires of an init
+	"""
+	start = time.time()
+	error = None
+
+	try:
+		if gate:
+			processRun(dt)
+		else:
+			evaluateRun(dt)
+	except Exception as err:
+		error = traceback.format_exc()
+
+	return { "init": dt.strftime("%Y%m%d%H"), "seconds": time.time() - start, "error": error }
+
+#-------------------------------------------------------
+# Schedule conversion and stats across the pools
+#------------------------------------------------------
+def backfill(inits, data_root, workers, stats_workers, redo=False, gate=False):
+	"""
+	this function will convert the hours of inits still to do across a process pool, and evaluate
+	each init in a second pool as soon as its last hour is converted; every finished unit is
+	checkpointed in the run-state store, so a rerun resumes where an interrupted one stopped
+	"""
+	conn = openState()
+
+	if redo:
+		resetInits(conn, inits)
+
+	# conversion jobs from the checkpoints, oldest init first
+	jobs = {}
+
+	for dt in inits:
+		nbm_path = process_nbm_qpf.nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+		if os.path.exists(nbm_path):
+			makeOutputDirs(dt)
+			jobs[dt] = initJobs(dt)
+		else:
+			print("NBM Grib2 data not available for %sZ" % dt.strftime("%b %d, %Y, %H"))
+			addCount("inits_missing")
+
+	total = sum(len(fhrs) for fhrs in jobs.values())
+	print("\nBackfilling %d inits: %d fcst hours to convert with %d workers, stats with %d workers\n" % (len(inits), total, workers, stats_workers))
+
+	results = []
+	stats_results = []
+	remaining = { dt: len(fhrs) for dt, fhrs in jobs.items() }
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initBackfillWorker, initargs=(data_root, redo)) as convert_pool, \
+		concurrent.futures.ProcessPoolExecutor(max_workers=stats_workers, initializer=initBackfillWorker, initargs=(data_root, redo, True)) as stats_pool:
+
+		stats_futures = {}
+
+		def submitStats(dt):
+			if needsStats(conn, dt):
+				stats_futures[stats_pool.submit(backfillStats, dt, gate)] = dt
+
+		# inits converted by an earlier pass only need their stats
+		for dt in jobs:
+			if remaining[dt] == 0:
+				submitStats(dt)
+
+		futures = {}
+		for dt in sorted(jobs):
+			for fhr in jobs[dt]:
+				futures[convert_pool.submit(convertHour, dt, fhr)] = (dt, fhr)
+
+		for n, future in enumerate(concurrent.futures.as_completed(futures)):
+			dt, fhr = futures[future]
+			try:
+				result = future.result()
+			except Exception as err:
+				result = { "init": dt.strftime("%Y%m%d%H"), "fhr": fhr, "status": "failed", "seconds": 0., "error": traceback.format_exc() }
+
+			# checkpoint every hour as it finishes
+			recordConversions(conn, [result])
+			recordMetrics([result])
+			results.append(result)
+
+			print("[%d/%d] %s f%03d %s" % (n + 1, total, result["init"], fhr, result["status"]))
+
+			remaining[dt] -= 1
+			if remaining[dt] == 0:
+				submitStats(dt)
+
+		for future in concurrent.futures.as_completed(stats_futures):
+			dt = stats_futures[future]
+			try:
+				result = future.result()
+			except Exception as err:
+				result = { "init": dt.strftime("%Y%m%d%H"), "seconds": 0., "error": traceback.format_exc() }
+
+			stats_results.append(result)
+			addTime("init_stats", result["seconds"], status="failed" if result["error"] else "done")
+			event("backfill_stats", init=result["init"], seconds=round(result["seconds"], 4),
+				error=result["error"].strip().split("\n")[-1] if result["error"] else None)
+
+			print("Stats %s %s (%.1fs)" % (result["init"], "FAILED: " + result["error"].strip().split("\n")[-1] if result["error"] else "done", result["seconds"]))
+
+	return results, stats_results
+
+def main():
+
+	start = datetime.datetime.utcnow()
+	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
+
+	init_time = lambda s: datetime.datetime.strptime(s, "%Y%m%d%H")
+
+	parser = argparse.ArgumentParser(description="Convert and evaluate a range of NBM QPF inits, resuming from checkpoints")
+	parser.add_argument("start", type=init_time, help="first init: YYYYMMDDHH")
+	parser.add_argument("end", type=init_time, help="last init: YYYYMMDDHH")
+	parser.add_argument("--stride", type=int, default=1, help="hours between inits (default 1)")
+	parser.add_argument("--workers", type=int, default=workers, help="conversion worker processes (default $NBM_QPF_WORKERS or 4)")
+	parser.add_argument("--stats-workers", type=int, default=stats_workers, help="stats worker processes")
+	parser.add_argument("--data-dir", default=backfill_dir, help="root of the backfilled output and checkpoints")
+	parser.add_argument("--redo", action="store_true", help="ignore checkpoints and existing output")
+	parser.add_argument("--gate", action="store_true", help="only evaluate inits with 75%% of their hours (shouldProcess)")
+	parser.add_argument("--profile", action="store_true", help="profile this run with cProfile (also $NBM_QPF_PROFILE=1)")
+	args = parser.parse_args()
+
+	inits = []
+	dt = args.start
+	while dt <= args.end:
+		inits.append(dt)
+		dt += datetime.timedelta(hours=max(args.stride, 1))
+
+	startRun("backfill_nbm_qpf", profile=args.profile)
+	configure(args.data_dir, args.redo)
+
+	results, stats_results = backfill(inits, args.data_dir, args.workers, args.stats_workers, args.redo, args.gate)
+
+	printSummary(results)
+	print("Stats: %d inits evaluated, %d failed" % (len([r for r in stats_results if not r["error"]]), len([r for r in stats_results if r["error"]])))
+
+	end = datetime.datetime.utcnow()
+	print("\nScript completed at " + end.strftime("%a %b %d, %Y %H:%M:%S Z"))
+	diff_minute = (end-start).total_seconds()/60
+	print("Script execution: %.2f" % diff_minute + " minutes\n")
+
+	finishRun(start_init=args.start.strftime("%Y%m%d%H"), end_init=args.end.strftime("%Y%m%d%H"), stride=args.stride,
+		inits=len(inits), workers=args.workers, stats_workers=args.stats_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+#!/usr/local/anaconda3/envs/py37/bin/python
+
+"""-------------------------------------------------------------
+	Script Name: 	benchmark_nbm_qpf.py
+	Description: 	Time the NBM QPF conversion and stats stages on synthetic data
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, datetime, time, json, shutil, tempfile, argparse, platform, subprocess
+import numpy as np
+from osgeo import gdal, ogr, osr
+import process_nbm_qpf
+import find_nbm_qpf_stats
+from fire_mask_index import fireMask
+from fire_catalog import loadCatalog
+from qpf_stats_engine import fireQPFStats, readBlockMax, blockMaxPath
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+current_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+# results accumulate next to the pipeline's other run output, out of the source tree
+results_file = current_dir + "/data/nbm/benchmark_results.jsonl"
+
+# NBM CONUS 2.5 km Lambert conformal grid (scale 1.0)
+nbm_proj4 = "+proj=lcc +lat_0=25 +lat_1=25 +lat_2=25 +lon_0=-95 +x_0=0 +y_0=0 +R=6371200 +units=m +no_defs"
+nbm_shape = [1597, 2345]
+nbm_resolution = 2539.703
+nbm_lower_left = (-126.2766, 19.2290)
+
+# GRIB_ELEMENT of the filler bands around QPF01
+filler_elements = ["T", "TD", "RH", "WDIR", "WIND", "GUST", "SKY", "TMAX", "TMIN", "PoP01", "SnowAmt01", "IceAccum01", "VIS", "CIG", "QPF06"]
+
+# fires are placed inside the stats subregion (lon, lat)
+fire_bounds = [-124., 31., -103., 49.]
+buffer_meters = 16093.4
+states = ["az", "ca", "co", "id", "mt", "nm", "nv", "or", "ut", "wa", "wy"]
+
+# synthetic init time, the files carry no real dates
+bench_init = datetime.datetime(2020, 8, 20, 12)
+
+#-------------------------------------------------------
+# Synthetic NBM grid
+#------------------------------------------------------
+def nbmGrid(scale):
+	"""
+	this function will return the grid definition of the NBM CONUS grid with scale times the cells
+	over the same extent
+	"""
+	srs = osr.SpatialReference()
+	srs.ImportFromProj4(nbm_proj4)
+
+	geo = osr.SpatialReference()
+	geo.ImportFromEPSG(4326)
+	if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+		geo.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+	x0, y0, z0 = osr.CoordinateTransformation(geo, srs).TransformPoint(nbm_lower_left[0], nbm_lower_left[1])
+
+	rows, cols = int(round(nbm_shape[0] * scale)), int(round(nbm_shape[1] * scale))
+	res = nbm_resolution * nbm_shape[1] / cols
+
+	return {
+		"geotransform": [x0 - res / 2., res, 0., y0 + (rows - 0.5) * res, 0., -res],
+		"shape": [rows, cols],
+		"wkt": srs.ExportToWkt()
+	}
+
+#-------------------------------------------------------
+# Synthetic hourly QPF field
+#------------------------------------------------------
+def qpfField(grid, fhr, storms):
+	"""
+	this function will return a QPF01 field in mm: gaussian storm cells drifting east with the
+	forecast hour, mostly dry, with a nodata strip along the top edge
+	"""
+	rows, cols = grid["shape"]
+	yy, xx = np.mgrid[0:rows, 0:cols].astype(np.float32)
+	yy /= rows
+	xx /= cols
+
+	qpf = np.zeros((rows, cols), dtype=np.float32)
+
+	for y, x, radius, peak in storms:
+		dist2 = (yy - y) ** 2 + (xx - (x + 0.01 * fhr)) ** 2
+		qpf += peak * np.exp(-dist2 / (2 * radius ** 2))
+
+	qpf[qpf < 0.05] = 0.
+	qpf[:max(rows // 200, 1), :] = 9999.
+
+	return qpf
+
+#-------------------------------------------------------
+# Write an NBM-like multi-band file
+#------------------------------------------------------
+def writeSyntheticGrib(path, grid, qpf_mm, n_bands, qpf_band):
+	"""
+	this function will write a band-interleaved GeoTiff standing in for an NBM core Grib2 file:
+	n_bands bands tagged with GRIB_ELEMENT metadata, QPF01 at band qpf_band
+	"""
+	rows, cols = grid["shape"]
+
+	ds = gdal.GetDriverByName("GTiff").Create(path, cols, rows, n_bands, gdal.GDT_Float32,
+		options=["INTERLEAVE=BAND", "TILED=YES", "COMPRESS=DEFLATE"])
+	ds.SetGeoTransform(grid["geotransform"])
+	ds.SetProjection(grid["wkt"])
+
+	for b in range(1, n_bands + 1):
+		band = ds.GetRasterBand(b)
+		band.SetNoDataValue(9999.)
+
+		if b == qpf_band:
+			band.SetMetadata({ "GRIB_ELEMENT": "QPF01", "GRIB_UNIT": "[kg/(m^2)]", "GRIB_COMMENT": "Total precipitation [kg/(m^2)]" })
+			band.WriteArray(qpf_mm)
+		else:
+			band.SetMetadata({ "GRIB_ELEMENT": filler_elements[(b - 1) % len(filler_elements)] })
+			band.Fill(float(b))
+
+		band = None
+
+	ds = None
+
+#-------------------------------------------------------
+# Synthetic NBM run
+#------------------------------------------------------
+def makeInputs(nbm_dir, dt, grid, hours, n_bands, seed):
+	"""
+	this function will write hours synthetic NBM files of an init in the live directory layout
+	"""
+	rng = np.random.RandomState(seed)
+	storms = [(rng.uniform(0.2, 0.9), rng.uniform(0., 0.6), rng.uniform(0.01, 0.05), rng.uniform(2., 40.)) for i in range(12)]
+
+	nbm_path = nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+	os.makedirs(nbm_path, exist_ok=True)
+
+	for fhr in range(1, hours + 1):
+		nbm_file = "blend.t%02dz.core.f%03d.co.grib2" % (dt.hour, fhr)
+		writeSyntheticGrib(os.path.join(nbm_path, nbm_file), grid, qpfField(grid, fhr, storms), n_bands, 1 + (fhr * 7) % n_bands)
+
+#-------------------------------------------------------
+# Synthetic fire buffers and metadata
+#------------------------------------------------------
+def writeFire(buffer_dir, json_dir, name, props, lon, lat):
+	"""
+	this function will write a 10 mile buffer shapefile (EPSG:3857) and its geojson metadata
+	"""
+	geo = osr.SpatialReference()
+	geo.ImportFromEPSG(4326)
+	web = osr.SpatialReference()
+	web.ImportFromEPSG(3857)
+	if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+		geo.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		web.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+	x, y, z = osr.CoordinateTransformation(geo, web).TransformPoint(lon, lat)
+
+	# mercator meters grow with latitude
+	center = ogr.Geometry(ogr.wkbPoint)
+	center.AddPoint_2D(x, y)
+	buffer_geom = center.Buffer(buffer_meters / np.cos(np.radians(lat)), 16)
+
+	shp = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(os.path.join(buffer_dir, name + ".shp"))
+	lyr = shp.CreateLayer(name, web, ogr.wkbPolygon)
+	feat = ogr.Feature(lyr.GetLayerDefn())
+	feat.SetGeometry(buffer_geom)
+	lyr.CreateFeature(feat)
+	feat = None
+	shp = None
+
+	props = dict(props, Center_Lat=lat, Center_Lon=lon)
+	feature = { "type": "Feature", "properties": props, "geometry": json.loads(buffer_geom.ExportToJson()) }
+
+	with open(os.path.join(json_dir, name + ".geojson"), "w") as outfile:
+		json.dump({ "type": "FeatureCollection", "features": [feature] }, outfile)
+
+def makeFires(fire_dir, n_fires, seed, active_fraction=0.1):
+	"""
+	this function will write n_fires historical and active fires under fire_dir (once) and return
+	the fire sources in the layout the stats stage walks
+	"""
+	rng = np.random.RandomState(seed)
+
+	sources = [
+		("historical", fire_dir + "/buffer", fire_dir + "/qpf_threshold_geojson"),
+		("active", fire_dir + "/buffer_active", fire_dir + "/json_active")
+	]
+
+	if os.path.isdir(fire_dir):
+		return sources
+
+	for kind, buffer_dir, json_dir in sources:
+		os.makedirs(buffer_dir, exist_ok=True)
+		os.makedirs(json_dir, exist_ok=True)
+
+	for i in range(n_fires):
+		lon = rng.uniform(fire_bounds[0], fire_bounds[2])
+		lat = rng.uniform(fire_bounds[1], fire_bounds[3])
+		state = states[rng.randint(len(states))]
+		year = 2016 + rng.randint(5)
+		name = "bench%05d_%d_%s_10mi_buffer" % (i, year, state)
+
+		if rng.uniform() < active_fraction:
+			props = { "CreateDate": "%d/08/01" % year, "UnitID": "US" + state.upper(), "IncidentNa": "BENCH %05d" % i }
+			writeFire(sources[1][1], sources[1][2], name, props, lon, lat)
+		else:
+			props = { "Year": year, "State": state.upper(), "Name": "BENCH %05d" % i }
+			writeFire(sources[0][1], sources[0][2], name, props, lon, lat)
+
+	return sources
+
+#-------------------------------------------------------
+# Point the pipeline modules at a work directory
+#------------------------------------------------------
+def configure(work_dir, fire_sources, stats_grid):
+	"""
+	this function will set the directory and run options of the conversion and stats modules
+	"""
+	data_dir = work_dir + "/data/nbm"
+
+	process_nbm_qpf.nbm_dir = work_dir + "/nbm"
+	process_nbm_qpf.data_dir = data_dir
+	process_nbm_qpf.geotiff_dir = data_dir + "/geotiff"
+	process_nbm_qpf.images_dir = data_dir + "/images"
+	process_nbm_qpf.grib_index_dir = data_dir + "/grib_index"
+	process_nbm_qpf.remap_dir = data_dir + "/remap"
+	process_nbm_qpf.process_again = True
+	process_nbm_qpf.cube_products = False
+	process_nbm_qpf.use_run_state = False
+	process_nbm_qpf.native_products = (stats_grid == "native")
+
+	find_nbm_qpf_stats.fire_sources = fire_sources
+	find_nbm_qpf_stats.json_dir = fire_sources[0][2]
+	find_nbm_qpf_stats.data_dir = data_dir + "/json"
+	find_nbm_qpf_stats.nbm_data_dir = data_dir + "/geotiff"
+	find_nbm_qpf_stats.nbm_images_dir = data_dir + "/images"
+	find_nbm_qpf_stats.mask_index_dir = data_dir + "/mask_index"
+	find_nbm_qpf_stats.catalog_file = os.path.dirname(fire_sources[0][1]) + "/fire_catalog.pkl"
+	find_nbm_qpf_stats.process_again = True
+	find_nbm_qpf_stats.incremental = False
+	find_nbm_qpf_stats.use_cube = False
+	find_nbm_qpf_stats.use_run_state = False
+	find_nbm_qpf_stats.stats_grid = stats_grid
+
+	os.makedirs(find_nbm_qpf_stats.data_dir, exist_ok=True)
+
+#-------------------------------------------------------
+# Result records
+#------------------------------------------------------
+def gitCommit():
+	"""
+	this function will return the short commit hash of the working tree, or None outside git
+	"""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=current_dir, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def record(records, case, stage, seconds, items=1):
+	"""
+	this function will add a timing record of a stage to records and print it
+	"""
+	rec = dict(case, stage=stage, seconds=round(seconds, 4), items=items, per_item=round(seconds / max(items, 1), 5))
+	records.append(rec)
+	print("%-22s %9.3fs  %6d items  %8.4fs/item" % (stage, seconds, items, rec["per_item"]))
+
+#-------------------------------------------------------
+# Conversion stage
+#------------------------------------------------------
+def benchConversion(records, case, dt, hours, worker_counts):
+	"""
+	this function will time band lookup, warp, unit conversion and GeoTiff writes hour by hour,
+	then the whole conversion of the run for each worker count
+	"""
+	P = process_nbm_qpf
+	nbm_path = P.nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+	geotiff_path = P.geotiff_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
+	P.makeOutputDirs(dt)
+
+	timing = { k: 0. for k in ["band_lookup", "band_read", "warp", "unit_conversion", "geotiff_write"] }
+
+	# first hour builds the remap table
+	nbm_raster, lyr = P.openQPFBand(os.path.join(nbm_path, "blend.t%02dz.core.f001.co.grib2" % dt.hour))
+	start = time.time()
+	P.webQPF(nbm_raster, lyr)
+	record(records, case, "remap_build", time.time() - start)
+	nbm_raster = None
+
+	for fhr in range(1, hours + 1):
+		nbm_fullpath = os.path.join(nbm_path, "blend.t%02dz.core.f%03d.co.grib2" % (dt.hour, fhr))
+		tif_path = geotiff_path + "/bench.%03d.tif" % fhr
+
+		start = time.time()
+		nbm_raster, lyr = P.openQPFBand(nbm_fullpath)
+		timing["band_lookup"] += time.time() - start
+
+		start = time.time()
+		band = nbm_raster.GetRasterBand(lyr)
+		native_mm = band.ReadAsArray()
+		band = None
+		timing["band_read"] += time.time() - start
+
+		start = time.time()
+		qpf_mm, web_grid, in_nodata = P.webQPF(nbm_raster, lyr, native_mm)
+		timing["warp"] += time.time() - start
+
+		start = time.time()
+		qpf_in, out_nodata = P.convertToInches(qpf_mm, in_nodata)
+		timing["unit_conversion"] += time.time() - start
+
+		start = time.time()
+		P.writeGeoTiff(tif_path, qpf_in, web_grid, out_nodata)
+		P.writeBlockMax(tif_path, qpf_in, out_nodata)
+		timing["geotiff_write"] += time.time() - start
+
+		nbm_raster = None
+		os.remove(tif_path)
+		os.remove(blockMaxPath(tif_path))
+
+	for stage, seconds in timing.items():
+		record(records, case, stage, seconds, hours)
+
+	# whole run, serial and through the worker pool
+	for workers in worker_counts:
+		start = time.time()
+		if workers > 1:
+			results = P.convertParallel([dt], workers)
+		else:
+			results = P.convertToRaster(dt)
+		converted = len([r for r in results if r["status"] == "converted"])
+		record(records, dict(case, workers=workers), "convert_run", time.time() - start, converted)
+
+#-------------------------------------------------------
+# Stats stage
+#------------------------------------------------------
+def benchStats(records, case, dt):
+	"""
+	this function will time the fire catalog, fire masks, zonal stats and json write of a run,
+	then the whole stats run
+	"""
+	F = find_nbm_qpf_stats
+
+	nbm_paths, qpf_valid, missing = F.qpfSources(dt)
+	if len(nbm_paths) == 0:
+		print("No converted hours to run stats on")
+		return
+
+	grid = F.qpfGridDefinition(nbm_paths[0])
+
+	start = time.time()
+	catalog = loadCatalog(F.fire_sources, F.catalog_file)
+	record(records, case, "fire_catalog", time.time() - start, len(catalog["fire_id"]))
+
+	start = time.time()
+	masks = [fireMask(catalog["shp"][i], grid, F.mask_index_dir, reproject=(F.stats_grid == "native"), mtime=catalog["shp_mtime"][i]) for i in range(len(catalog["fire_id"]))]
+	record(records, case, "fire_masks", time.time() - start, len(masks))
+
+	nbm_directory = F.nbm_data_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
+	summaries = [readBlockMax(nbm_directory + "/" + F.qpfFileName(datetime.datetime.strptime(valid, "%Y%m%d%H"))) for valid in qpf_valid]
+	slots = [int((datetime.datetime.strptime(valid, "%Y%m%d%H") - dt).total_seconds() // 3600) for valid in qpf_valid]
+	default_valid = (dt + datetime.timedelta(hours=1)).strftime("%Y%m%d%H")
+
+	start = time.time()
+	fireQPFStats(nbm_paths, qpf_valid, masks, grid["shape"], default_valid, nodata=-9999)
+	record(records, case, "zonal_stats", time.time() - start, len(masks) * len(nbm_paths))
+
+	start = time.time()
+	fireQPFStats(nbm_paths, qpf_valid, masks, grid["shape"], default_valid, nodata=-9999, summaries=summaries,
+		slots=slots, windows=F.rolling_hours, thresholds=F.exceed_thresholds)
+	record(records, case, "zonal_stats_full", time.time() - start, len(masks) * len(nbm_paths))
+
+	start = time.time()
+	F.findMaxQPFAmount(dt)
+	record(records, case, "stats_run", time.time() - start, len(masks))
+
+	json_file = F.data_dir + "/nbm." + dt.strftime("%Y%m%d%H") + ".json"
+	if os.path.exists(json_file):
+		with open(json_file) as jfile:
+			precip_dict = json.load(jfile)
+
+		start = time.time()
+		with open(json_file, "w") as outfile:
+			json.dump(precip_dict, outfile, indent=4)
+		record(records, case, "json_write", time.time() - start, len(precip_dict))
+
+#-------------------------------------------------------
+# Save result records
+#------------------------------------------------------
+def saveResults(records, path):
+	"""
+	this function will append the records to a JSON lines file, one stage timing per line
+	"""
+	os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+	with open(path, "a") as outfile:
+		for rec in records:
+			outfile.write(json.dumps(rec, sort_keys=True) + "\n")
+
+	print("\nSaved %d results: %s" % (len(records), path))
+
+def main():
+
+	start = datetime.datetime.utcnow()
+	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
+
+	parser = argparse.ArgumentParser(description="Benchmark the NBM QPF conversion and stats stages on synthetic data")
+	parser.add_argument("--grid-scales", type=float, nargs="+", default=[0.25, 0.5, 1.0], help="NBM grid cells per axis relative to the 2.5 km grid")
+	parser.add_argument("--fires", type=int, nargs="+", default=[50, 500], help="synthetic fire counts")
+	parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="conversion worker counts")
+	parser.add_argument("--hours", type=int, default=6, help="forecast hours per run")
+	parser.add_argument("--bands", type=int, default=20, help="bands per synthetic NBM file")
+	parser.add_argument("--stats-grid", default="web", choices=["web", "native"], help="grid the stats are computed on")
+	parser.add_argument("--seed", type=int, default=0, help="random seed of the storms and fires")
+	parser.add_argument("--work-dir", default=None, help="directory for the synthetic data (default: a temporary directory)")
+	parser.add_argument("--keep", action="store_true", help="keep the synthetic data")
+	parser.add_argument("--output", default=results_file, help="JSON lines results file, appended to")
+	args = parser.parse_args()
+
+	work_root = args.work_dir or tempfile.mkdtemp(prefix="nbm_qpf_bench.")
+	os.makedirs(work_root, exist_ok=True)
+
+	run = {
+		"run": start.strftime("%Y%m%dT%H%M%SZ"),
+		"commit": gitCommit(),
+		"host": platform.node(),
+		"gdal": gdal.__version__,
+		"numpy": np.__version__,
+		"hours": args.hours,
+		"bands": args.bands,
+		"stats_grid": args.stats_grid
+	}
+
+	records = []
+
+	try:
+		for scale in args.grid_scales:
+
+			grid = nbmGrid(scale)
+			work_dir = "%s/grid_%g" % (work_root, scale)
+
+			print('\n#-------------------------------------------------------')
+			print("# Grid scale %g: %d x %d" % (scale, grid["shape"][1], grid["shape"][0]))
+			print('#------------------------------------------------------')
+
+			gen_start = time.time()
+			makeInputs(work_dir + "/nbm", bench_init, grid, args.hours, args.bands, args.seed)
+			print("Synthetic inputs written in %.1fs" % (time.time() - gen_start))
+
+			for n_fires in args.fires:
+
+				case = dict(run, grid_scale=scale, shape=grid["shape"], fires=n_fires, workers=1)
+				fire_sources = makeFires("%s/fires_%d" % (work_root, n_fires), n_fires, args.seed)
+				configure(work_dir, fire_sources, args.stats_grid)
+
+				print("\n%d fires" % n_fires)
+
+				# conversion does not depend on the fires, time it once per grid
+				if n_fires == args.fires[0]:
+					benchConversion(records, case, bench_init, args.hours, args.workers)
+
+				benchStats(records, case, bench_init)
+
+	finally:
+		saveResults(records, args.output)
+
+		if not args.keep and args.work_dir is None:
+			shutil.rmtree(work_root, ignore_errors=True)
+		else:
+			print("Synthetic data kept: %s" % work_root)
+
+	end = datetime.datetime.utcnow()
+	print("\nScript completed at " + end.strftime("%a %b %d, %Y %H:%M:%S Z"))
+	diff_minute = (end-start).total_seconds()/60
+	print("Script execution: %.2f" % diff_minute + " minutes\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""-------------------------------------------------------------
+	Script Name: 	data_retention.py
+	Description: 	Remove expired init directories and files of the NBM QPF products
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, re, shutil, datetime
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+
+# layouts: "dated" is <root>/YYYYMMDD/HH/, "flat" is <root>/<name>.YYYYMMDDHH.<ext> files
+date_pattern = re.compile(r"^\d{8}$")
+hour_pattern = re.compile(r"^\d{2}$")
+flat_pattern = re.compile(r"\.(\d{10})\.")
+
+#-------------------------------------------------------
+# Convert file size to useful units
+#------------------------------------------------------
+def convertBytes(num):
+	"""
+	this function will convert bytes to MB.... GB... etc
+	"""
+	for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+		if num < 1024.0:
+			return "%3.1f %s" % (num, x)
+		num /= 1024.0
+
+#-------------------------------------------------------
+# Check file size and return in useful units
+#------------------------------------------------------
+def fileSize(file_path):
+	"""
+	this function will return the file size
+	"""
+	if os.path.isfile(file_path):
+		file_info = os.stat(file_path)
+		return convertBytes(file_info.st_size)
+
+#-------------------------------------------------------
+# Bytes under a path
+#------------------------------------------------------
+def treeBytes(path):
+	"""
+	this function will return the bytes of a file or of every file under a directory
+	"""
+	if not os.path.isdir(path):
+		return os.path.getsize(path) if os.path.isfile(path) else 0
+
+	total = 0
+	stack = [path]
+
+	while stack:
+		for entry in os.scandir(stack.pop()):
+			if entry.is_dir(follow_symlinks=False):
+				stack.append(entry.path)
+			elif entry.is_file(follow_symlinks=False):
+				total += entry.stat(follow_symlinks=False).st_size
+
+	return total
+
+#-------------------------------------------------------
+# Init times of a product tree
+#------------------------------------------------------
+def _dirs(path, pattern):
+	try:
+		return sorted(entry.name for entry in os.scandir(path) if entry.is_dir(follow_symlinks=False) and pattern.match(entry.name))
+	except (IOError, OSError):
+		return []
+
+def expiredRuns(root, layout, cutoff):
+	"""
+	this function will return [(path, init time)] of what expired before cutoff under root; a date
+	directory whose last hour expired is returned whole, without listing its hours
+	"""
+	expired = []
+
+	if layout == "dated":
+		for date_dir in _dirs(root, date_pattern):
+			try:
+				dt_date = datetime.datetime.strptime(date_dir, "%Y%m%d")
+			except ValueError:
+				continue
+
+			if dt_date + datetime.timedelta(hours=23) < cutoff:
+				expired.append((os.path.join(root, date_dir), dt_date))
+			elif dt_date < cutoff:
+				for hour_dir in _dirs(os.path.join(root, date_dir), hour_pattern):
+					dt_init = dt_date + datetime.timedelta(hours=int(hour_dir))
+					if dt_init < cutoff:
+						expired.append((os.path.join(root, date_dir, hour_dir), dt_init))
+
+	elif layout == "flat":
+		try:
+			entries = [ entry for entry in os.scandir(root) if entry.is_file(follow_symlinks=False) ]
+		except (IOError, OSError):
+			entries = []
+
+		for entry in entries:
+			match = flat_pattern.search(entry.name)
+			if match is None:
+				continue
+			try:
+				dt_init = datetime.datetime.strptime(match.group(1), "%Y%m%d%H")
+			except ValueError:
+				continue
+			if dt_init < cutoff:
+				expired.append((entry.path, dt_init))
+
+	else:
+		raise ValueError("Unknown retention layout: %s" % layout)
+
+	return sorted(expired, key=lambda e: e[1])
+
+#-------------------------------------------------------
+# Remove what expired in every product
+#------------------------------------------------------
+def removeExpired(products, now=None, dry_run=False):
+	"""
+	this function will delete the expired init directories and files of products, given as
+	(name, root, layout, keep_hours), and return {name: {"removed", "bytes"}}
+	"""
+	now = now or datetime.datetime.utcnow()
+	report = {}
+
+	for name, root, layout, keep_hours in products:
+
+		cutoff = now - datetime.timedelta(hours=keep_hours)
+		report[name] = { "removed": 0, "bytes": 0 }
+
+		for path, dt_init in expiredRuns(root, layout, cutoff):
+			try:
+				size = treeBytes(path)
+				label = fileSize(path) or convertBytes(size)
+				if not dry_run:
+					if os.path.isdir(path):
+						shutil.rmtree(path)
+					else:
+						os.remove(path)
+			except (IOError, OSError) as err:
+				print("Unable to remove %s: %s" % (path, err))
+				continue
+
+			report[name]["removed"] += 1
+			report[name]["bytes"] += size
+			print("%s %s (%s)" % ("Would remove" if dry_run else "Removed", path, label))
+
+		print("%s: %d expired (older than %d hours), %s reclaimed" % (name, report[name]["removed"], keep_hours, convertBytes(report[name]["bytes"])))
+
+	return report
@@ -10,10 +10,19 @@
 #---------------------------------------------------------------
 # Import python packages
 #---------------------------------------------------------------
-import os, sys, datetime, time, string, json, shutil, traceback, re, glob
+import os, sys, datetime, time, string, json, shutil, traceback, re, glob, argparse
 from osgeo import gdal, ogr, osr
 import numpy as np
-from rasterstats import zonal_stats
+from fire_mask_index import gridDefinition, fireMask
+from qpf_stats_engine import fireQPFStats, readBlockMax, rollingNames, stat_names
+from qpf_cube import cubePath, cubeHours
+from fire_catalog import loadCatalog, fireMetadata
+from qpf_thresholds import threshold_mm, threshold_inch, precipCategory, precipCategories
+from pipeline_metrics import startRun, finishRun, addTime, addCount, timer, event
+from publish_outputs import publishOutputs, rsyncTransport
+from qpf_run_output import runPaths, writeCompactRun, readHeader, readCompactRun
+from data_retention import removeExpired
+from run_state import openState, knownInit, convertedHours, statsHours, recordStats, pendingStatsInits
 
 #-------------------------------------------------------
 # Global configuration options
@@ -30,360 +39,488 @@ web_dir = "/var/www/html/debrisflow/data"
 buffer_active_dir = current_dir + "/data/buffer_active"
 perim_active_dir = current_dir + "/data/perimeter_active"
 json_active_dir = current_dir + "/data/json_active"
+mask_index_dir = current_dir + "/data/nbm/mask_index"
+catalog_file = current_dir + "/data/nbm/fire_catalog.pkl"
+
+# (kind, buffer shapefiles, geojson metadata) walked into the fire catalog
+fire_sources = [("historical", buffer_dir, json_dir), ("active", buffer_active_dir, json_active_dir)]
 
 complete_count = 36
 process_again = True
 
+# run output older than this is removed (hours)
+keep_hours = 36
+
+# read hour counts and the inits to evaluate from the run-state store (written by process_nbm_qpf.py)
+# and record each run's stats status in it; inits it does not know fall back to the files
+use_run_state = True
+
+# only compute hours missing from a run's existing json output
+incremental = True
+
+# write the indented json (nbm.YYYYMMDDHH.json) and/or the compact output: a columnar npz,
+# a small header (.header.json) read by shouldProcess and a minified columnar json (.min.json)
+indented_json = True
+compact_output = True
+
+# skip dry fires and hours using the converter's per-hour block-max summaries
+use_blockmax = True
+
+# rolling accumulation windows (hours) added as qpf_max_3h, qpf_mean_3h, ... series
+rolling_hours = [3, 6, 12, 24]
+
+# thresholds (inches) of the hourly qpf_exceed fractions of buffer cells
+exceed_thresholds = threshold_inch
+
+# grid the stats are computed on: "web" (EPSG:3857 GeoTiffs) or "native" (NBM grid, buffers reprojected)
+stats_grid = os.environ.get("NBM_QPF_STATS_GRID", "web")
+
+# read a run's cube (one file, hours from its metadata) instead of hourly GeoTiffs when it exists
+use_cube = True
+
+# push only files whose content changed (per-destination hash manifest), all destinations at once,
+# instead of four serial full-tree rsyncs
+use_publisher = True
+publish_manifest = current_dir + "/data/nbm/publish_manifest.json"
+publish_targets = [
+	("dev_json", data_dir, rsyncTransport("chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/json/")),
+	("dev_images", nbm_images_dir, rsyncTransport("chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/images/")),
+	("www_json", data_dir, rsyncTransport("chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/json/")),
+	("www_images", nbm_images_dir, rsyncTransport("chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/images/"))
+]
+
 def maxPrecipCategory(val):
-	pcat = "00"
-	if val >= 2.54:
-		pcat = "01"
-	elif val >= 5.08:
-		pcat = "02"
-	elif val >= 7.62:
-		pcat = "03"
-	elif val >= 10.16:
-		pcat = "04"
-	elif val >= 12.7:
-		pcat = "05"
-	elif val >= 15.24:
-		pcat = "06"
-	elif val >= 17.78:
-		pcat = "07"
-	elif val >= 20.32:
-		pcat = "08"
-	elif val >= 22.86:
-		pcat = "09"
-	elif val >= 25.4:
-		pcat = "10"
-
-	return pcat
+	return precipCategory(val, threshold_mm)
 
 def maxPrecipCategoryInch(val):
-	pcat = "00"
-	if val >= 0.1:
-		pcat = "01"
-	elif val >= 0.2:
-		pcat = "02"
-	elif val >= 0.3:
-		pcat = "03"
-	elif val >= 0.4:
-		pcat = "04"
-	elif val >= 0.5:
-		pcat = "05"
-	elif val >= 0.6:
-		pcat = "06"
-	elif val >= 0.7:
-		pcat = "07"
-	elif val >= 0.8:
-		pcat = "08"
-	elif val >= 0.9:
-		pcat = "09"
-	elif val >= 1.0:
-		pcat = "10"
-
-	return pcat
+	return precipCategory(val, threshold_inch)
+
+#-------------------------------------------------------
+# Hourly QPF GeoTiff for the stats grid
+#------------------------------------------------------
+def qpfFileName(dt_valid):
+	"""
+	this function will return the hourly QPF GeoTiff name on the stats grid
+	"""
+	if stats_grid == "native":
+		return "nbm.qpf.native.%s.tif" % (dt_valid.strftime("%Y%m%d%H"))
+
+	return "nbm.qpf.%s.tif" % (dt_valid.strftime("%Y%m%d%H"))
+
+#-------------------------------------------------------
+# Hourly QPF rasters available for a run
+#------------------------------------------------------
+def qpfSources(dt):
+	"""
+	this function will return the available hourly QPF rasters of a run, their valid times and
+	the missing GeoTiffs; with a cube the hours come from its metadata in a single open
+	"""
+	nbm_directory = nbm_data_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
+	cube_file = cubePath(nbm_directory, dt, stats_grid == "native")
+
+	nbm_sources = []
+	qpf_valid = []
+	missing = []
+
+	if use_cube and os.path.exists(cube_file):
+
+		for fhr in cubeHours(cube_file):
+			if fhr <= complete_count:
+				nbm_sources.append((cube_file, fhr))
+				qpf_valid.append((dt + datetime.timedelta(hours=fhr)).strftime("%Y%m%d%H"))
+
+		return nbm_sources, qpf_valid, missing
+
+	for i in range(1,complete_count+1):
+
+		dt_valid = dt + datetime.timedelta(hours=i)
+		nbm_file = qpfFileName(dt_valid)
+		nbm_path = nbm_directory + "/" + nbm_file
+
+		if os.path.exists(nbm_path):
+			nbm_sources.append(nbm_path)
+			qpf_valid.append(dt_valid.strftime("%Y%m%d%H"))
+		else:
+			missing.append(nbm_path)
+
+	return nbm_sources, qpf_valid, missing
+
+def validHour(dt, valid):
+	"""
+	this function will return the forecast hour of a valid time (YYYYMMDDHH) of init dt
+	"""
+	return int((datetime.datetime.strptime(valid, "%Y%m%d%H") - dt).total_seconds() // 3600)
+
+#-------------------------------------------------------
+# Grid definition of the NBM QPF GeoTiffs
+#------------------------------------------------------
+def qpfGridDefinition(nbm_source):
+	"""
+	this function will return the grid definition of a QPF GeoTiff or cube
+	"""
+	nbm_path = nbm_source if isinstance(nbm_source, str) else nbm_source[0]
+	ds = gdal.Open(nbm_path, gdal.GA_ReadOnly)
+	grid = gridDefinition(ds)
+	ds = None
+
+	return grid
+
+#-------------------------------------------------------
+# Merge new hourly stats into a fire's previous output
+#------------------------------------------------------
+def mergeFireStats(fire_dict, valid, stats, run, n, previous=None):
+	"""
+	this function will fill the qpf series and run maxima of fire_dict from the stats of fire n,
+	merged in valid time order with the hours of its previous output, and return the run max
+	previous run maxima only change when a new hour beats them (compared at their stored precision)
+	"""
+	series = {}
+
+	if previous is not None:
+		for i, qpf_valid in enumerate(previous["qpf_valid"]):
+			series[qpf_valid] = [ previous["qpf_" + k][i] for k in stat_names ]
+
+	for i, qpf_valid in enumerate(valid):
+		series[qpf_valid] = [ round(float(stats[k][i,n]),2) for k in stat_names ]
+
+	order = sorted(series)
+
+	for j, k in enumerate(stat_names):
+		fire_dict["qpf_" + k] = [ series[qpf_valid][j] for qpf_valid in order ]
+	fire_dict["qpf_valid"] = order
+
+	# fraction of buffer cells reaching each threshold, per hour
+	if "exceed" in stats:
+
+		exceed = {}
+
+		if previous is not None:
+			exceed.update(zip(previous["qpf_valid"], previous["qpf_exceed"]))
+
+		for i, qpf_valid in enumerate(valid):
+			exceed[qpf_valid] = [ round(float(v),3) for v in stats["exceed"][i,n] ]
+
+		fire_dict["exceed_thresholds"] = list(exceed_thresholds)
+		fire_dict["qpf_exceed"] = [ exceed[qpf_valid] for qpf_valid in order ]
+
+	run_maxval = 0.
+
+	for k in stat_names:
+
+		run_val, run_time = float(run[k][0][n]), run[k][1][n]
+
+		# compare at the stored precision, a new hour that only ties the old maximum keeps the old hour
+		if previous is not None and not round(run_val, 2) > float(previous["run_qpf_" + k]["value"]):
+			run_val, run_time = float(previous["run_qpf_" + k]["value"]), previous["run_qpf_" + k]["valid"]
+
+		fire_dict["run_qpf_" + k] = { "valid" : run_time , "value" : "%0.2f" % run_val }
+
+		if k == "max":
+			run_maxval = run_val
+
+	return run_maxval
+
+#-------------------------------------------------------
+# Drop re-evaluated hours from a fire's previous output
+#------------------------------------------------------
+def dropHours(fire, hours):
+	"""
+	this function will return a fire's previous output without the valid times in hours (whose
+	sources changed), so their values are recomputed instead of merged, or None when a run
+	maximum sits on one of them and the fire needs a full recompute
+	"""
+	if any(fire["run_qpf_" + k]["valid"] in hours for k in stat_names):
+		return None
+
+	keep = [ i for i, qpf_valid in enumerate(fire["qpf_valid"]) if qpf_valid not in hours ]
+	series = ["qpf_valid", "qpf_exceed"] + [ "qpf_" + k for k in stat_names + rollingNames(rolling_hours) ]
+
+	fire = dict(fire)
+	for key in series:
+		if key in fire:
+			fire[key] = [ fire[key][i] for i in keep ]
+
+	return fire
+
+#-------------------------------------------------------
+# Merge new rolling accumulations into a fire's previous output
+#------------------------------------------------------
+def mergeRollingStats(fire_dict, valid, stats, n, default_valid, previous=None):
+	"""
+	this function will fill the rolling accumulation series of fire_dict along its qpf_valid,
+	taking the hours in valid from the stats of fire n and the rest from its previous output
+	incomplete windows are None; run maxima come from the merged series (ties keep the earliest hour)
+	"""
+	for k in rollingNames(rolling_hours):
+
+		series = {}
+
+		if previous is not None and ("qpf_" + k) in previous:
+			series.update(zip(previous["qpf_valid"], previous["qpf_" + k]))
+
+		for i, qpf_valid in enumerate(valid):
+			val = float(stats[k][i,n])
+			series[qpf_valid] = None if np.isnan(val) else round(val,2)
+
+		fire_dict["qpf_" + k] = [ series.get(qpf_valid) for qpf_valid in fire_dict["qpf_valid"] ]
+
+		run_val, run_time = 0., default_valid
+
+		for qpf_valid, val in zip(fire_dict["qpf_valid"], fire_dict["qpf_" + k]):
+			if val is not None and val > run_val:
+				run_val, run_time = val, qpf_valid
+
+		fire_dict["run_qpf_" + k] = { "valid" : run_time , "value" : "%0.2f" % run_val }
+
+#-------------------------------------------------------
+# Hours to read for new hours and their rolling windows
+#------------------------------------------------------
+def rollingHours(need, slots):
+	"""
+	this function will return the hours whose rolling windows include a needed hour, and every
+	hour those windows cover (indexes into slots, the forecast hour of each available hour)
+	"""
+	if len(rolling_hours) == 0:
+		return need, need
+
+	width = max(rolling_hours)
+	avail = { slot: i for i, slot in enumerate(slots) }
+
+	affected = set(slots[i] + k for i in need for k in range(width)) & set(avail)
+	load = set(t - k for t in affected for k in range(width)) & set(avail)
+
+	return tuple(sorted(avail[t] for t in affected)), tuple(sorted(avail[t] for t in load))
+
+#-------------------------------------------------------
+# Fires and their masks on the stats grid
+#------------------------------------------------------
+def loadFires(grid):
+	"""
+	this function will return (kind, file, fire_dict, mask) of the historical and active fires
+	of the shared catalog, with their masks on grid
+	"""
+	with timer("fire_catalog"):
+		catalog = loadCatalog(fire_sources, catalog_file)
+	fires = []
+
+	with timer("fire_masks"):
+		for i in range(len(catalog["fire_id"])):
+
+			try:
+				mask = fireMask(catalog["shp"][i], grid, mask_index_dir, reproject=(stats_grid == "native"), mtime=catalog["shp_mtime"][i])
+				fires.append((catalog["kind"][i], catalog["file"][i], fireMetadata(catalog, i), mask))
+
+			except Exception as err:
+				print(traceback.format_exc())
+				addCount("fires_skipped", reason="mask")
+				continue
+
+	return fires
+
+#-------------------------------------------------------
+# Fire dicts of a run's output
+#------------------------------------------------------
+def fireOutput(fires, run_maxvals, verbose=True):
+	"""
+	this function will pick the basin perimeter of every fire from its run max category and
+	return the fire dicts to save, without fires holding infinite values or no hours
+	"""
+	precip_dict = []
+
+	# threshold category of every fire's run max in one pass
+	run_categories = precipCategories(run_maxvals, threshold_inch)
+
+	for n, (kind, f, fire_dict, mask) in enumerate(fires):
+
+		name_array = f.split("_")
+		basin_json = "_".join(name_array[:3]).lower() + "_basin_60min_" + run_categories[n] + "in_probs.geojson"
+
+		if kind == "historical":
+			if os.path.exists(json_dir + "/" + basin_json):
+				fire_dict["perimeter"] = basin_json
+
+		chk_inf = np.isposinf(fire_dict["qpf_mean"])
+
+		if True not in chk_inf:
+
+			if len(fire_dict["qpf_max"]) > 0:
+				if verbose:
+					print("Fire: " + fire_dict["name"] + " (" + str(fire_dict["year"]) + ")")
+				precip_dict.append(fire_dict)
+
+		else:
+			print("Found Infinity -- Skipping %s" % fire_dict["name"])
+			addCount("fires_skipped", reason="infinity")
+
+	return precip_dict
+
+#-------------------------------------------------------
+# Write a run's output files
+#------------------------------------------------------
+def saveRunOutput(dt, precip_dict):
+	"""
+	this function will write the indented json and/or the compact output of a run
+	"""
+	run_paths = runPaths(data_dir, dt)
+
+	if len(precip_dict) > 0:
+		if indented_json:
+			print("\nSaving output: %s" % run_paths["json"])
+			with timer("json_write"):
+				tmp_file = "%s.%d.tmp" % (run_paths["json"], os.getpid())
+				with open(tmp_file, "w") as outfile:
+					json.dump(precip_dict, outfile,indent=4)
+				os.replace(tmp_file, run_paths["json"])
+			addCount("bytes_written", os.path.getsize(run_paths["json"]), format="json")
+
+		if compact_output:
+			print("Saving compact output: %s" % run_paths["npz"])
+			with timer("compact_write"):
+				writeCompactRun(run_paths, dt, precip_dict)
+			for key in ["npz", "header", "web"]:
+				addCount("bytes_written", os.path.getsize(run_paths[key]), format=key)
+
+		addCount("fires", len(precip_dict))
+	else:
+		print("No data to save: %s" % run_paths["json"])
 
 #-------------------------------------------------------
 # Evaluate NBM precip over fires
 #------------------------------------------------------
 def findMaxQPFAmount(dt):
 	"""
-    this function will loop through current forecast and evaluate max QPF over fire
-	and output to json file
+    this function will evaluate max QPF over every fire for the whole forecast in one pass
+	and output to json file, returning the forecast hours in the output
     """
 	print("\n#----------------------------------------------------")
 	print("# Evaluating NBM 1 Hour precip accumulation valid: %s" % dt.strftime("%b %d, %Y %H"))
 	print("#----------------------------------------------------\n")
 
 	precip_dict = []
+	evaluated = []
 
-	json_file = data_dir + "/nbm." + dt.strftime("%Y%m%d%H") + ".json"
+	run_paths = runPaths(data_dir, dt)
+	json_file = run_paths["json"]
+	header = readHeader(run_paths) if compact_output else None
 
-	if not os.path.exists(json_file) or process_again:
+	if not (os.path.exists(json_file) or header is not None) or process_again:
 
-		for root, dirs, files in os.walk(buffer_dir, topdown=True):
-			for f in files:
-				if f.endswith(".shp"):
-					
-					buffer_shp_path = os.path.join(root,f)
-					perim_file = f.replace("10mi_buffer","perimeter")
-					perim_shp_path = os.path.join(perim_dir,perim_file)
+		# hourly QPF available for this run
+		with timer("qpf_sources"):
+			nbm_paths, qpf_valid, missing = qpfSources(dt)
 
-					try:
-						# print("\nFound buffer shapefile: %s" % buffer_shp_path)
+		for nbm_path in missing:
+			print("Unable to find: %s" % nbm_path)
+		addCount("hours_missing", len(missing))
 
-						name_array = f.split("_")
+		if len(nbm_paths) > 0:
 
-						json_buffer = f.replace(".shp",".geojson")
-						json_fire = json_buffer.replace("10mi_buffer","perimeter")
-						
-						with open(os.path.join(json_dir,json_buffer)) as buffer_path:
-							buffer_info = json.load(buffer_path)
+			grid = qpfGridDefinition(nbm_paths[0])
+			fires = loadFires(grid)
 
-						fire_dict = {}
+			# previous output of this run, so only new hours are computed
+			previous = {}
 
-						fire_dict["year"] = buffer_info["features"][0]["properties"]["Year"]
-						fire_dict["state"] = buffer_info["features"][0]["properties"]["State"]
-						fire_dict["name"] = (buffer_info["features"][0]["properties"]["Name"]).title()
-						fire_dict["perimeter"] = json_fire
-						fire_dict["buffer"] = json_buffer
-						fire_dict["coordinates"] = [buffer_info["features"][0]["properties"]["Center_Lat"], buffer_info["features"][0]["properties"]["Center_Lon"]]
+			if incremental and header is not None and os.path.exists(run_paths["npz"]):
+				try:
+					with timer("compact_read"):
+						previous = { fire["buffer"]: fire for fire in readCompactRun(run_paths) }
+				except (IOError, ValueError, KeyError):
+					print("Unable to read previous compact output, recomputing: %s" % run_paths["npz"])
+					previous = {}
+
+			elif incremental and os.path.exists(json_file):
+				try:
+					with timer("json_read"), open(json_file) as jfile:
+						previous = { fire["buffer"]: fire for fire in json.load(jfile) }
+				except (ValueError, KeyError, TypeError):
+					print("Unable to read previous output, recomputing: %s" % json_file)
+					previous = {}
+
+			# group fires by the valid hours they still need
+			groups = {}
+
+			# previous output without the rolling series or exceedance fractions is recomputed in full
+			required_keys = [ "qpf_" + k for k in rollingNames(rolling_hours) ] + ["qpf_exceed"]
+			previous = { buffer: fire for buffer, fire in previous.items() if all(k in fire for k in required_keys)
+				and fire.get("exceed_thresholds") == list(exceed_thresholds) }
+
+			# hours the store no longer has as evaluated (reconverted after their source changed)
+			# are recomputed, not merged
+			if use_run_state and len(previous) > 0 and knownInit(openState(), dt.strftime("%Y%m%d%H")):
+				stats_done = set(statsHours(openState(), dt.strftime("%Y%m%d%H")))
+				stale = set(valid for valid in qpf_valid if validHour(dt, valid) not in stats_done)
+
+				if len(stale) > 0:
+					print("Recomputing %d re-converted fcst hours" % len(stale))
+					previous = { buffer: dropHours(fire, stale) for buffer, fire in previous.items() }
+					previous = { buffer: fire for buffer, fire in previous.items() if fire is not None }
+
+			for n, fire in enumerate(fires):
+				done = set(previous[fire[2]["buffer"]]["qpf_valid"]) if fire[2]["buffer"] in previous else set()
+				need = tuple(i for i, valid in enumerate(qpf_valid) if valid not in done)
+				groups.setdefault(need, []).append(n)
+
+			# block-max summaries of each hour, when the converter wrote them
+			summaries = None
+
+			if use_blockmax:
+				nbm_directory = nbm_data_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
+				summaries = [ readBlockMax(nbm_directory + "/" + qpfFileName(datetime.datetime.strptime(valid, "%Y%m%d%H"))) for valid in qpf_valid ]
+
+			# forecast hour of each available valid time, the rolling window axis
+			qpf_slots = [ validHour(dt, valid) for valid in qpf_valid ]
+
+			# every fire x every needed hour in a single pass per group
+			default_valid = (dt + datetime.timedelta(hours=1)).strftime("%Y%m%d%H")
+			run_maxvals = [0.] * len(fires)
+
+			for need, members in groups.items():
+
+				# new hours plus the earlier hours their rolling windows reach back to
+				affected, load = rollingHours(need, qpf_slots)
+				load_valid = [qpf_valid[i] for i in load]
+
+				if len(need) > 0:
+					print("Computing %d fcst hours (%d read) for %d fires" % (len(need), len(load), len(members)))
+
+				load_summaries = [summaries[i] for i in load] if summaries is not None else None
+
+				group_start = time.time()
+
+				with timer("zonal_stats"):
+					stats, run = fireQPFStats([nbm_paths[i] for i in load], load_valid, [fires[n][3] for n in members], grid["shape"], default_valid,
+						nodata=-9999, summaries=load_summaries, slots=[qpf_slots[i] for i in load], windows=rolling_hours, thresholds=exceed_thresholds)
+
+				group_seconds = time.time() - group_start
+				addCount("fire_hours_computed", len(need) * len(members))
+				addCount("fire_hours_read", len(load) * len(members))
+				addCount("fire_hours_reused", (len(qpf_valid) - len(need)) * len(members))
+
+				if summaries is not None:
+					addCount("hours_dry", len([i for i in load if summaries[i] is not None and not (summaries[i]["blockmax"] > 0).any()]))
+
+				event("stats_group", init=dt.strftime("%Y%m%d%H"), fires=len(members), hours=len(need), hours_read=len(load), seconds=round(group_seconds, 4),
+					seconds_per_fire=round(group_seconds / max(len(members), 1), 6), seconds_per_hour=round(group_seconds / max(len(load), 1), 6))
+
+				# rolling windows are only complete for the affected hours of this read
+				rows = [load.index(i) for i in affected]
+				rolling = { k: stats[k][rows] for k in rollingNames(rolling_hours) }
+
+				for j, n in enumerate(members):
+					previous_fire = previous.get(fires[n][2]["buffer"])
+					run_maxvals[n] = mergeFireStats(fires[n][2], load_valid, stats, run, j, previous_fire)
+					mergeRollingStats(fires[n][2], [qpf_valid[i] for i in affected], rolling, j, default_valid, previous_fire)
+
+			precip_dict = fireOutput(fires, run_maxvals)
+
+		saveRunOutput(dt, precip_dict)
 
-						nbm_directory = nbm_data_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
-	
-						fire_dict["qpf_max"] = []
-						fire_dict["qpf_mean"] = []
-						fire_dict["qpf_range"] = []
-						fire_dict["qpf_sum"] = []
-						fire_dict["qpf_valid"] = []
-
-						# initialize full run variables
-						run_maxval = 0
-						run_meanval = 0
-						run_rangeval = 0
-						run_sumval = 0
-
-						for i in range(1,37):
-
-							dt_init = dt + datetime.timedelta(hours=i)
-							
-							if i == 1:
-								if i == 1:
-									run_maxtime = dt_init.strftime("%Y%m%d%H")
-									run_meantime = dt_init.strftime("%Y%m%d%H")
-									run_rangetime = dt_init.strftime("%Y%m%d%H")
-									run_sumtime = dt_init.strftime("%Y%m%d%H")
-									
-							nbm_file = "nbm.qpf.%s.tif" % (dt_init.strftime("%Y%m%d%H"))
-							nbm_path = nbm_directory + "/" + nbm_file
-
-							if os.path.exists(nbm_path):
-														
-								# Calculate overlapping area for buffer and NBM
-								stats = zonal_stats(buffer_shp_path,nbm_path,nodata=-9999,stats=['max','mean','range','sum'])
-								
-								# Summarize PRATE by polygon
-								maxval = 0
-								meanval = 0
-								rangeval = 0
-								sumval = 0
-
-								if stats[0] and stats[0]['sum'] is not None:
-									if stats[0]['max'] > 0:
-										maxval = stats[0]['max']
-									if stats[0]['mean'] > 0:
-										meanval = stats[0]['mean']
-									if stats[0]['range'] > 0:
-										rangeval = stats[0]['range']
-									if stats[0]['sum'] > 0:
-										sumval = stats[0]['sum']
-
-								if maxval > run_maxval:
-									run_maxval = maxval
-									run_maxtime = dt_init.strftime("%Y%m%d%H")
-
-								if meanval > run_meanval:
-									run_meanval = meanval
-									run_meantime = dt_init.strftime("%Y%m%d%H")
-
-								if rangeval > run_rangeval:
-									run_rangeval = rangeval
-									run_rangetime = dt_init.strftime("%Y%m%d%H")
-
-								if sumval > run_sumval:
-									run_sumval = sumval
-									run_sumtime = dt_init.strftime("%Y%m%d%H")
-
-								# print("Max in: " + str(maxval))
-								fire_dict["qpf_max"].append( round(maxval,2) )
-								fire_dict["qpf_mean"].append( round(meanval,2) )
-								fire_dict["qpf_range"].append( round(rangeval,2) )
-								fire_dict["qpf_sum"].append( round(sumval,2) )
-								fire_dict["qpf_valid"].append( dt_init.strftime("%Y%m%d%H") )
-
-							else:
-								print("Unable to find: %s" % nbm_path)
-
-						if os.path.exists(json_dir + "/" + "_".join(name_array[:3]).lower() + "_basin_60min_" + maxPrecipCategoryInch(run_maxval) + "in_probs.geojson"):
-							fire_dict["perimeter"] = "_".join(name_array[:3]).lower() + "_basin_60min_" + maxPrecipCategoryInch(run_maxval) + "in_probs.geojson"
-
-						fire_dict["run_qpf_max"] = { "valid" : run_maxtime , "value" : "%0.2f" % run_maxval }
-						fire_dict["run_qpf_mean"] = { "valid" : run_meantime , "value" : "%0.2f" % run_meanval }
-						fire_dict["run_qpf_range"] = { "valid" : run_rangetime , "value" : "%0.2f" % run_rangeval }
-						fire_dict["run_qpf_sum"] = { "valid" : run_sumtime , "value" : "%0.2f" % run_sumval }
-						
-						chk_inf = np.isposinf(fire_dict["qpf_mean"])
-
-						if True not in chk_inf:
-
-							if len(fire_dict["qpf_max"]) > 0:
-								print("Fire: " + fire_dict["name"] + " (" + str(fire_dict["year"]) + ")")
-								precip_dict.append(fire_dict)
-
-						else:
-							print("Found Infinity -- Skipping %s" % fire_dict["name"])
-
-					except Exception as err:
-						print(traceback.format_exc())
-						continue
-
-		print("\n#----------------------------------------------------")
-		print("# Processing active fire perimeters")
-		print("#----------------------------------------------------\n")
-
-		# check active fires	
-		for root, dirs, files in os.walk(buffer_active_dir, topdown=True):
-			for f in files:
-				if f.endswith(".shp"):
-					
-					buffer_shp_path = os.path.join(root,f)
-					perim_file = f.replace("10mi_buffer","perimeter")
-					perim_shp_path = os.path.join(perim_active_dir,perim_file)
-
-					try:
-						# print("\nFound buffer shapefile: %s" % buffer_shp_path)
-
-						name_array = f.split("_")
-
-						json_buffer = f.replace(".shp",".geojson")
-						json_fire = json_buffer.replace("10mi_buffer","perimeter")
-						
-						with open(os.path.join(json_active_dir,json_buffer)) as buffer_path:
-							buffer_info = json.load(buffer_path)
-
-						fire_dict = {}
-
-						create_dt = buffer_info["features"][0]["properties"]["CreateDate"]
-						create_dt_array = create_dt.split("/")
-						unit_id = buffer_info["features"][0]["properties"]["UnitID"]
-
-						fire_dict["year"] = create_dt_array[0]
-						if unit_id is not None:
-							fire_dict["state"] = unit_id[-2:]
-						else:
-							fire_dict["state"] = ""
-
-						fire_dict["name"] = (buffer_info["features"][0]["properties"]["IncidentNa"]).title()
-						fire_dict["perimeter"] = "active/" + json_fire
-						fire_dict["buffer"] = "active/" + json_buffer
-						fire_dict["coordinates"] = [buffer_info["features"][0]["properties"]["Center_Lat"], buffer_info["features"][0]["properties"]["Center_Lon"]]
-
-						nbm_directory = nbm_data_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
-	
-						fire_dict["qpf_max"] = []
-						fire_dict["qpf_mean"] = []
-						fire_dict["qpf_range"] = []
-						fire_dict["qpf_sum"] = []
-						fire_dict["qpf_valid"] = []
-
-						# initialize full run variables
-						run_maxval = 0
-						run_meanval = 0
-						run_rangeval = 0
-						run_sumval = 0
-
-						add_dict = True
-
-						for i in range(1,complete_count+1):
-
-							dt_init = dt + datetime.timedelta(hours=i)
-							
-							if i == 1:
-								if i == 1:
-									run_maxtime = dt_init.strftime("%Y%m%d%H")
-									run_meantime = dt_init.strftime("%Y%m%d%H")
-									run_rangetime = dt_init.strftime("%Y%m%d%H")
-									run_sumtime = dt_init.strftime("%Y%m%d%H")
-									
-							nbm_file = "nbm.qpf.%s.tif" % (dt_init.strftime("%Y%m%d%H"))
-							nbm_path = nbm_directory + "/" + nbm_file
-
-							if os.path.exists(nbm_path):
-														
-								# Calculate overlapping area for buffer and NBM
-								stats = zonal_stats(buffer_shp_path,nbm_path,nodata=-9999,stats=['max','mean','range','sum'])
-
-								if stats[0] and stats[0]['sum'] is not None:
-									if np.isinf(float(stats[0]['mean'])):
-										add_dict = False
-									if np.isinf(float(stats[0]['sum'])):
-										add_dict = False
-								
-								# Summarize PRATE by polygon
-								maxval = 0
-								meanval = 0
-								rangeval = 0
-								sumval = 0
-
-								if stats[0] and stats[0]['sum'] is not None:
-									if stats[0]['max'] > 0:
-										maxval = stats[0]['max']
-									if stats[0]['mean'] > 0:
-										meanval = stats[0]['mean']
-									if stats[0]['range'] > 0:
-										rangeval = stats[0]['range']
-									if stats[0]['sum'] > 0:
-										sumval = stats[0]['sum']
-
-								if maxval > run_maxval:
-									run_maxval = maxval
-									run_maxtime = dt_init.strftime("%Y%m%d%H")
-
-								if meanval > run_meanval:
-									run_meanval = meanval
-									run_meantime = dt_init.strftime("%Y%m%d%H")
-
-								if rangeval > run_rangeval:
-									run_rangeval = rangeval
-									run_rangetime = dt_init.strftime("%Y%m%d%H")
-
-								if sumval > run_sumval:
-									run_sumval = sumval
-									run_sumtime = dt_init.strftime("%Y%m%d%H")
-
-								# print("Max in: " + str(maxval))
-								fire_dict["qpf_max"].append( round(maxval,2) )
-								fire_dict["qpf_mean"].append( round(meanval,2) )
-								fire_dict["qpf_range"].append( round(rangeval,2) )
-								fire_dict["qpf_sum"].append( round(sumval,2) )
-								fire_dict["qpf_valid"].append( dt_init.strftime("%Y%m%d%H") )
-
-							else:
-								print("Unable to find: %s" % nbm_path)
-
-						# if os.path.exists(json_active_dir + "/" + "_".join(name_array[:3]).lower() + "_basin_60min_" + maxPrecipCategoryInch(run_maxval) + "in_probs.geojson"):
-						# 	fire_dict["perimeter"] = "_".join(name_array[:3]).lower() + "_basin_60min_" + maxPrecipCategoryInch(run_maxval) + "in_probs.geojson"
-
-						fire_dict["run_qpf_max"] = { "valid" : run_maxtime , "value" : "%0.2f" % run_maxval }
-						fire_dict["run_qpf_mean"] = { "valid" : run_meantime , "value" : "%0.2f" % run_meanval }
-						fire_dict["run_qpf_range"] = { "valid" : run_rangetime , "value" : "%0.2f" % run_rangeval }
-						fire_dict["run_qpf_sum"] = { "valid" : run_sumtime , "value" : "%0.2f" % run_sumval }
-						
-						chk_inf = np.isposinf(fire_dict["qpf_mean"])
-
-						if True not in chk_inf:
-
-							if len(fire_dict["qpf_max"]) > 0:
-								print("Fire: " + fire_dict["name"] + " (" + str(fire_dict["year"]) + ")")
-								precip_dict.append(fire_dict)
-
-						else:
-							print("Found Infinity -- Skipping %s" % fire_dict["name"])
-
-					except Exception as err:
-						print(traceback.format_exc())
-						continue			
-
-		# Write output to file
 		if len(precip_dict) > 0:
-			print("\nSaving output: %s" % json_file)
-			with open(json_file, "w") as outfile:
-				json.dump(precip_dict, outfile,indent=4)
-		else:
-			print("No data to save: %s" % json_file)
+			evaluated = qpf_slots
 	else:
 		print("QPF output already exists for %sZ" % dt.strftime("%b %d, %Y %H"))
+		addCount("runs_skipped", reason="exists")
 
 	os.system("/usr/bin/chmod -R 755 %s" % data_dir)	
 
@@ -391,6 +528,8 @@ def findMaxQPFAmount(dt):
 	# print("# Finished generating NBM 15-min accumulation output.")
 	# print("#----------------------------------------------------\n")
 
+	return evaluated
+
 #-------------------------------------------------------
 # Check if most of run is available before processing
 #------------------------------------------------------
@@ -398,33 +537,39 @@ def shouldProcess(dt_input):
 
 	res = { "proceed": False , "reason": "N/A" }
 
-	tiff_count = 0
-	nbm_directory = nbm_data_dir + "/" + dt_input.strftime("%Y%m%d") + "/" + dt_input.strftime("%H")
+	init = dt_input.strftime("%Y%m%d%H")
+	conn = openState() if use_run_state else None
 
-	for i in range(1,complete_count+1):
-	
-		dt_chk = dt_input + datetime.timedelta(hours=i)
-									
-		nbm_file = "nbm.qpf.%s.tif" % (dt_chk.strftime("%Y%m%d%H"))
-		nbm_path = nbm_directory + "/" + nbm_file
-
-		if os.path.exists(nbm_path):
-			tiff_count += 1
+	# hour counts from the run-state store in indexed queries
+	if conn is not None and knownInit(conn, init):
+		tiff_count = len([fhr for fhr in convertedHours(conn, init) if fhr <= complete_count])
+	else:
+		conn = None
+		nbm_sources, qpf_valid, missing = qpfSources(dt_input)
+		tiff_count = len(nbm_sources)
 
 	if tiff_count >= (complete_count * 0.75):
 		res["proceed"] = True
 
 	if res["proceed"]:
 
-		json_file = data_dir + "/nbm." + dt_input.strftime("%Y%m%d%H") + ".json"
+		run_paths = runPaths(data_dir, dt_input)
+		header = readHeader(run_paths) if compact_output else None
 		file_count = 0
 
-		if os.path.exists(json_file):
+		stats_hours = statsHours(conn, init) if conn is not None else []
 
-			with open(json_file) as jfile:
-				data = json.load(jfile)
-			
-			file_count = len(data[0]["qpf_valid"])
+		if len(stats_hours) > 0 or header is not None or os.path.exists(run_paths["json"]):
+
+			# the store or the header holds the completeness count, no need to parse the whole run
+			if len(stats_hours) > 0:
+				file_count = len(stats_hours)
+			elif header is not None:
+				file_count = header["complete"]
+			else:
+				with open(run_paths["json"]) as jfile:
+					data = json.load(jfile)
+				file_count = len(data[0]["qpf_valid"])
 
 			if file_count < tiff_count and process_again:
 				res["proceed"] = True
@@ -441,123 +586,166 @@ def shouldProcess(dt_input):
 #------------------------------------------------------
 def removeOldData():
 	"""
-	this function will remove data older than keep_hours hours
+	this function will remove run output older than keep_hours hours
 	"""
-	keep_hours = 36
-
 	print('\n#-------------------------------------------------------')
 	print("# Removing data older than %d hours" % keep_hours)
 	print('#------------------------------------------------------')
 
-	now = datetime.datetime.utcnow()
+	report = removeExpired([("json", data_dir, "flat", keep_hours)])
+
+	addCount("retention_removed", report["json"]["removed"], product="json")
+	addCount("retention_bytes", report["json"]["bytes"], product="json")
+
+#-------------------------------------------------------
+# Push output to the web servers
+#------------------------------------------------------
+def publishData():
+	"""
+	this function will publish the json and image output, changed files only with the publisher
+	"""
+	if use_publisher:
+
+		print("\nPublishing changed data to web...")
+		with timer("publish"):
+			published = publishOutputs(publish_targets, publish_manifest)
+
+		for name, result in published.items():
+			addTime("publish_target", result["seconds"], target=name)
+			addCount("files_published", result["changed"], target=name)
+			addCount("files_unpublished", result["deleted"], target=name)
+			if result["error"] is not None:
+				addCount("publish_failures", target=name)
 
-	print("\nLooking for old QPF output...")
-	for hr in range(keep_hours+1, 169):
-		dt_remove = now - datetime.timedelta(hours=hr)
+	else:
 
-		json_file = "%s/nbm.%s.json" % (data_dir, dt_remove.strftime("%Y%m%d%H"))
+		print("\nRsyncing data to web...")
+		rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/json/" % (data_dir)
+		with timer("rsync", target="dev_json"):
+			os.system(rsync_cmd)
+		rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/images/" % nbm_images_dir
+		with timer("rsync", target="dev_images"):
+			os.system(rsync_cmd)
 
-		if os.path.exists(json_file):
-			print("Removing json file: %s" % json_file)
-			os.remove(json_file)				
+		rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/json/" % (data_dir)
+		with timer("rsync", target="www_json"):
+			os.system(rsync_cmd)
+		rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/images/" % nbm_images_dir
+		with timer("rsync", target="www_images"):
+			os.system(rsync_cmd)
 
 
+#-------------------------------------------------------
+# Evaluate one init if it is ready
+#------------------------------------------------------
+def processRun(dt_init):
+	"""
+	this function will evaluate an init when shouldProcess passes and record its stats status,
+	returning whether it was evaluated
+	"""
+	result = shouldProcess(dt_init)
+
+	if not result["proceed"]:
+		addCount("runs_skipped", reason=result["reason"].split(" (")[0])
+		print("\n##########################################################")
+		print("## ")
+		print("## Do not process run valid: %s" % dt_init.strftime("%Y-%m-%d %HZ"))
+		print("## Reason: %s" % result["reason"])
+		print("## ")
+		print("##########################################################\n")
+		return False
+
+	evaluateRun(dt_init)
+	return True
+
+def evaluateRun(dt_init):
+	"""
+	this function will evaluate an init and record its stats status in the run-state store
+	"""
+	init = dt_init.strftime("%Y%m%d%H")
+	run_start = time.time()
+
+	try:
+		with timer("run_stats", init=init):
+			evaluated = findMaxQPFAmount(dt_init)
+	except Exception as err:
+		if use_run_state:
+			conn = openState()
+			recordStats(conn, init, convertedHours(conn, init), "failed", error=traceback.format_exc())
+		raise
+
+	if use_run_state and len(evaluated) > 0:
+		recordStats(openState(), init, evaluated, "done", round(time.time() - run_start, 3))
+
 def main():
 	
 	start = datetime.datetime.utcnow()
 	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
 
-	if len(sys.argv) > 1:
+	parser = argparse.ArgumentParser(description="Compute NBM QPF stats for every fire buffer")
+	parser.add_argument("init", nargs="*", type=int, help="custom init time: YYYY MM DD HH")
+	parser.add_argument("--profile", action="store_true", help="profile this run with cProfile (also $NBM_QPF_PROFILE=1)")
+	args = parser.parse_args()
+
+	startRun("find_nbm_qpf_stats", profile=args.profile)
+
+	dt_inits = []
+
+	# inits with converted hours not yet in their output, from one indexed query
+	pending = pendingStatsInits(openState(), limit=7) if use_run_state and len(args.init) == 0 else []
 
-		init_yr = int(sys.argv[1])
-		init_mo = int(sys.argv[2])
-		init_dy = int(sys.argv[3])
-		init_hr = int(sys.argv[4])
+	if len(args.init) > 0:
+
+		init_yr, init_mo, init_dy, init_hr = args.init[:4]
 		dt_start = datetime.datetime(init_yr, init_mo, init_dy, init_hr, 0)		
 
 		for lookback in range(0, 6):
-	
-			dt_init = dt_start - datetime.timedelta(hours=lookback)
+			dt_inits.append(dt_start - datetime.timedelta(hours=lookback))
 
-			try:
-					
-				result = shouldProcess(dt_init)
-				
-				if result["proceed"]:
-					findMaxQPFAmount(dt_init)
-				else:
-					print("\n##########################################################")
-					print("## ")
-					print("## Do not process run valid: %s" % dt_init.strftime("%Y-%m-%d %HZ"))
-					print("## Reason: %s" % result["reason"])
-					print("## ")
-					print("##########################################################\n")
-				
-			except Exception as err:
-				print(traceback.format_exc())
-				continue
+	elif len(pending) > 0:
+
+		for init in pending:
+			dt_inits.append(datetime.datetime.strptime(init, "%Y%m%d%H"))
 
 	else:
 
 		json_files = glob.glob(nbm_images_dir + "/*.json")
 		json_files.sort(reverse=True)
 
-		count = 0
+		for path in json_files[:7]:
 
-		for path in json_files:
+			path_array = path.split("/")
+			filename = path_array[-1:][0]
+			file_array = filename.split(".")
+			dt_string = file_array[1]
+			dt_year = int(dt_string[0:4])
+			dt_month = int(dt_string[4:6])
+			dt_day = int(dt_string[6:8])
+			dt_hour = int(dt_string[8:10])
 
-			if count < 7:
-				
-				path_array = path.split("/")
-				filename = path_array[-1:][0]
-				file_array = filename.split(".")
-				dt_string = file_array[1]
-				dt_year = int(dt_string[0:4])
-				dt_month = int(dt_string[4:6])
-				dt_day = int(dt_string[6:8])
-				dt_hour = int(dt_string[8:10])
+			dt_inits.append(datetime.datetime(dt_year, dt_month, dt_day, dt_hour))
 
-				dt_init = datetime.datetime(dt_year, dt_month, dt_day, dt_hour)
+	for dt_init in dt_inits:
 
-				# dt_init = datetime.datetime(2020,10,30,0,0)
+		try:
+			processRun(dt_init)
+		except Exception as err:
+			print(traceback.format_exc())
+			continue
+
+	# a custom date reprocesses old inits, which retention would delete again
+	if len(args.init) == 0:
+		with timer("remove_old_data"):
+			removeOldData()
+
+	publishData()
 
-				try:
-					
-					result = shouldProcess(dt_init)
-					
-					if result["proceed"]:
-						findMaxQPFAmount(dt_init)
-					else:
-						print("\n##########################################################")
-						print("## ")
-						print("## Do not process run valid: %s" % dt_init.strftime("%Y-%m-%d %HZ"))
-						print("## Reason: %s" % result["reason"])
-						print("## ")
-						print("##########################################################\n")
-					
-				except Exception as err:
-					print(traceback.format_exc())
-					continue
-
-			count += 1	
-
-	removeOldData()
-
-	print("\nRsyncing data to web...")
-	rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/json/" % (data_dir)
-	os.system(rsync_cmd)
-	rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/dev/html/wrh/debrisflow/qpf/data/nbm/images/" % nbm_images_dir
-	os.system(rsync_cmd)
-
-	rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/json/" % (data_dir)
-	os.system(rsync_cmd)
-	rsync_cmd = "/usr/bin/rsync --delete --update -azvh %s/ chad.kahler@rsync3:/export/vhosts/www/html/wrh/debrisflow/qpf/data/nbm/images/" % nbm_images_dir
-	os.system(rsync_cmd)
-	
 	end = datetime.datetime.utcnow()
 	print("\nScript completed at " + end.strftime("%a %b %d, %Y %H:%M:%S Z"))
 	diff_minute = (end-start).total_seconds()/60
 	print("Script execution: %.2f" % diff_minute + " minutes\n")
 
+	finishRun()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,213 @@
+"""-------------------------------------------------------------
+	Script Name: 	fire_catalog.py
+	Description: 	Cached catalog of historical and active fire buffers
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json, pickle, traceback
+from osgeo import ogr
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+catalog_version = 2
+
+# output metadata columns, in the order they appear in the json
+meta_columns = ["year", "state", "name", "perimeter", "buffer", "coordinates"]
+catalog_columns = ["fire_id", "kind", "file", "shp", "shp_mtime", "srs", "bbox", "geometry"] + meta_columns
+
+# in-memory copy of every catalog loaded this process
+_catalog_cache = {}
+
+#-------------------------------------------------------
+# Read historical fire metadata
+#------------------------------------------------------
+def historicalFire(f, json_dir):
+	"""
+	this function will build the output metadata of a historical fire from its geojson
+	"""
+	json_buffer = f.replace(".shp",".geojson")
+	json_fire = json_buffer.replace("10mi_buffer","perimeter")
+
+	with open(os.path.join(json_dir,json_buffer)) as buffer_path:
+		buffer_info = json.load(buffer_path)
+
+	fire_dict = {}
+
+	fire_dict["year"] = buffer_info["features"][0]["properties"]["Year"]
+	fire_dict["state"] = buffer_info["features"][0]["properties"]["State"]
+	fire_dict["name"] = (buffer_info["features"][0]["properties"]["Name"]).title()
+	fire_dict["perimeter"] = json_fire
+	fire_dict["buffer"] = json_buffer
+	fire_dict["coordinates"] = [buffer_info["features"][0]["properties"]["Center_Lat"], buffer_info["features"][0]["properties"]["Center_Lon"]]
+
+	return fire_dict
+
+#-------------------------------------------------------
+# Read active fire metadata
+#------------------------------------------------------
+def activeFire(f, json_dir):
+	"""
+	this function will build the output metadata of an active fire from its geojson
+	"""
+	json_buffer = f.replace(".shp",".geojson")
+	json_fire = json_buffer.replace("10mi_buffer","perimeter")
+
+	with open(os.path.join(json_dir,json_buffer)) as buffer_path:
+		buffer_info = json.load(buffer_path)
+
+	fire_dict = {}
+
+	create_dt = buffer_info["features"][0]["properties"]["CreateDate"]
+	create_dt_array = create_dt.split("/")
+	unit_id = buffer_info["features"][0]["properties"]["UnitID"]
+
+	fire_dict["year"] = create_dt_array[0]
+	if unit_id is not None:
+		fire_dict["state"] = unit_id[-2:]
+	else:
+		fire_dict["state"] = ""
+
+	fire_dict["name"] = (buffer_info["features"][0]["properties"]["IncidentNa"]).title()
+	fire_dict["perimeter"] = "active/" + json_fire
+	fire_dict["buffer"] = "active/" + json_buffer
+	fire_dict["coordinates"] = [buffer_info["features"][0]["properties"]["Center_Lat"], buffer_info["features"][0]["properties"]["Center_Lon"]]
+
+	return fire_dict
+
+#-------------------------------------------------------
+# Read the buffer geometry of a fire
+#------------------------------------------------------
+def readBuffer(shp_path):
+	"""
+	this function will return the first buffer feature as (wkb, bbox, srs wkt)
+	"""
+	shp = ogr.Open(shp_path)
+	lyr = shp.GetLayer(0)
+	geom = lyr.GetNextFeature().GetGeometryRef()
+
+	minx, maxx, miny, maxy = geom.GetEnvelope()
+	srs = lyr.GetSpatialRef()
+
+	return bytes(geom.ExportToWkb()), (minx, miny, maxx, maxy), (srs.ExportToWkt() if srs is not None else "")
+
+#-------------------------------------------------------
+# File sizes and modification times the catalog depends on
+#------------------------------------------------------
+def treeStamp(path, stamp):
+	"""
+	this function will add (size, mtime_ns) of every file under path to stamp, from directory
+	listings only
+	"""
+	for entry in os.scandir(path):
+		if entry.is_dir():
+			treeStamp(entry.path, stamp)
+		else:
+			info = entry.stat()
+			stamp[entry.path] = (info.st_size, info.st_mtime_ns)
+
+def catalogStamp(sources):
+	"""
+	this function will return the size and mtime of every buffer and geojson file, so adding,
+	removing or overwriting any of them in place rebuilds the catalog
+	"""
+	stamp = { "version": catalog_version }
+
+	for kind, buffer_dir, json_dir in sources:
+		for path in [buffer_dir, json_dir]:
+			if os.path.exists(path):
+				treeStamp(path, stamp)
+			else:
+				stamp[path] = None
+
+	return stamp
+
+#-------------------------------------------------------
+# Build the catalog from the buffer and geojson trees
+#------------------------------------------------------
+def buildCatalog(sources):
+	"""
+	this function will walk each (kind, buffer_dir, json_dir) source once and return a columnar
+	table of every fire's id, kind, metadata, centroid, bbox and buffer geometry
+	"""
+	catalog = { k: [] for k in catalog_columns }
+
+	for kind, buffer_dir, json_dir in sources:
+		for root, dirs, files in os.walk(buffer_dir, topdown=True):
+			for f in sorted(files):
+				if f.endswith(".shp"):
+
+					shp_path = os.path.join(root,f)
+
+					try:
+						if kind == "active":
+							fire_dict = activeFire(f, json_dir)
+						else:
+							fire_dict = historicalFire(f, json_dir)
+
+						wkb, bbox, srs = readBuffer(shp_path)
+
+					except Exception as err:
+						print(traceback.format_exc())
+						continue
+
+					catalog["fire_id"].append(fire_dict["buffer"])
+					catalog["kind"].append(kind)
+					catalog["file"].append(f)
+					catalog["shp"].append(shp_path)
+					catalog["shp_mtime"].append(os.stat(shp_path).st_mtime)
+					catalog["srs"].append(srs)
+					catalog["bbox"].append(bbox)
+					catalog["geometry"].append(wkb)
+					for k in meta_columns:
+						catalog[k].append(fire_dict[k])
+
+	return catalog
+
+#-------------------------------------------------------
+# Load (or build and save) the fire catalog
+#------------------------------------------------------
+def loadCatalog(sources, cache_file):
+	"""
+	this function will return the fire catalog from its cache file, rebuilding it when any
+	buffer or geojson file changed
+	"""
+	stamp = catalogStamp(sources)
+
+	if cache_file in _catalog_cache and _catalog_cache[cache_file]["stamp"] == stamp:
+		return _catalog_cache[cache_file]["catalog"]
+
+	cached = None
+
+	if os.path.exists(cache_file):
+		try:
+			with open(cache_file, "rb") as infile:
+				cached = pickle.load(infile)
+		except Exception:
+			cached = None
+
+	if cached is None or cached["stamp"] != stamp:
+
+		print("Building fire catalog: %s" % cache_file)
+		cached = { "stamp": stamp, "catalog": buildCatalog(sources) }
+
+		os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+		tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+		with open(tmp_file, "wb") as outfile:
+			pickle.dump(cached, outfile, protocol=4)
+		os.replace(tmp_file, cache_file)
+
+	_catalog_cache[cache_file] = cached
+
+	return cached["catalog"]
+
+#-------------------------------------------------------
+# Output metadata of one catalog row
+#------------------------------------------------------
+def fireMetadata(catalog, i):
+	"""
+	this function will return a fresh output dict with the metadata of catalog row i
+	"""
+	return { k: (list(catalog[k][i]) if k == "coordinates" else catalog[k][i]) for k in meta_columns }
@@ -0,0 +1,188 @@
+"""-------------------------------------------------------------
+	Script Name: 	fire_mask_index.py
+	Description: 	Cached fire buffer to NBM grid cell index
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json, hashlib
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+index_version = 2
+
+# in-memory copy of every index loaded this process
+_mask_cache = {}
+
+#-------------------------------------------------------
+# Describe the grid a raster sits on
+#------------------------------------------------------
+def gridDefinition(ds):
+	"""
+	this function will return the geotransform, shape and projection of a gdal dataset
+	"""
+	return {
+		"geotransform": [float(v) for v in ds.GetGeoTransform()],
+		"shape": [ds.RasterYSize, ds.RasterXSize],
+		"wkt": ds.GetProjection()
+	}
+
+#-------------------------------------------------------
+# Build the cache key for a buffer on a grid
+#------------------------------------------------------
+def indexKey(shp_path, grid, reproject=False, mtime=None):
+	"""
+	this function will hash the grid definition with the shapefile path and mtime
+	a known mtime (e.g. from the fire catalog) saves the stat call
+	"""
+	shp_path = os.path.realpath(shp_path)
+	key = {
+		"version": index_version,
+		"geotransform": grid["geotransform"],
+		"shape": grid["shape"],
+		"wkt": grid["wkt"],
+		"shp": shp_path,
+		"mtime": mtime if mtime is not None else os.stat(shp_path).st_mtime,
+		"reproject": bool(reproject)
+	}
+	return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+#-------------------------------------------------------
+# Pixel window covering an envelope
+#------------------------------------------------------
+def envelopeWindow(envelope, grid):
+	"""
+	this function will return the (row0, col0, row1, col1) window of the grid covering an envelope
+	"""
+	minx, maxx, miny, maxy = envelope
+	gt = grid["geotransform"]
+	rows, cols = grid["shape"]
+
+	col0 = int(np.floor((minx - gt[0]) / gt[1]))
+	col1 = int(np.ceil((maxx - gt[0]) / gt[1]))
+	row0 = int(np.floor((maxy - gt[3]) / gt[5]))
+	row1 = int(np.ceil((miny - gt[3]) / gt[5]))
+
+	col0, col1 = max(col0, 0), min(col1, cols)
+	row0, row1 = max(row0, 0), min(row1, rows)
+
+	return (row0, col0, max(row0, row1), max(col0, col1))
+
+#-------------------------------------------------------
+# Rasterize a geometry into a window of the grid
+#------------------------------------------------------
+def burnWindow(geom, grid, window):
+	"""
+	this function will burn a geometry into a MEM raster covering window (pixel centers only)
+	"""
+	gt = grid["geotransform"]
+	row0, col0, row1, col1 = window
+
+	mem = gdal.GetDriverByName("MEM").Create("", col1 - col0, row1 - row0, 1, gdal.GDT_Byte)
+	mem.SetGeoTransform([gt[0] + col0 * gt[1], gt[1], 0., gt[3] + row0 * gt[5], 0., gt[5]])
+	mem.SetProjection(grid["wkt"])
+
+	lyr_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+	lyr = lyr_ds.CreateLayer("buffer", geom_type=geom.GetGeometryType())
+	feat = ogr.Feature(lyr.GetLayerDefn())
+	feat.SetGeometry(geom)
+	lyr.CreateFeature(feat)
+
+	gdal.RasterizeLayer(mem, [1], lyr, burn_values=[1])
+
+	return mem.GetRasterBand(1).ReadAsArray().astype(bool)
+
+#-------------------------------------------------------
+# Transform a geometry into the grid projection
+#------------------------------------------------------
+def toGridSRS(geom, src_srs, grid):
+	"""
+	this function will transform a geometry from src_srs into the projection of the grid
+	"""
+	dst_srs = osr.SpatialReference()
+	dst_srs.ImportFromWkt(grid["wkt"])
+
+	if src_srs is None or src_srs.IsSame(dst_srs):
+		return geom
+
+	src_srs = src_srs.Clone()
+
+	# keep x/y as lon/lat (or easting/northing) with GDAL 3 axis order rules
+	if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+		src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+		dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+	geom.Transform(osr.CoordinateTransformation(src_srs, dst_srs))
+
+	return geom
+
+#-------------------------------------------------------
+# Rasterize the buffer polygon onto the grid
+#------------------------------------------------------
+def rasterizeBuffer(shp_path, grid, reproject=False):
+	"""
+	this function will return the flat grid cell indices inside the first buffer feature
+	with reproject the buffer is transformed into the grid projection first, otherwise it is
+	assumed to share it (as rasterstats does)
+	"""
+	rows, cols = grid["shape"]
+
+	shp = ogr.Open(shp_path)
+	lyr = shp.GetLayer(0)
+	feat = lyr.GetNextFeature()
+	geom = feat.GetGeometryRef().Clone()
+
+	if reproject:
+		geom = toGridSRS(geom, lyr.GetSpatialRef(), grid)
+
+	window = envelopeWindow(geom.GetEnvelope(), grid)
+	row0, col0, row1, col1 = window
+
+	mask = {
+		"index": np.zeros(0, dtype=np.int64),
+		"window": np.array(window, dtype=np.int64)
+	}
+
+	if row1 > row0 and col1 > col0:
+
+		# pixel-center rule, same cells rasterstats uses
+		inside = burnWindow(geom, grid, window)
+		win_rows, win_cols = np.nonzero(inside)
+		mask["index"] = ((win_rows + row0) * cols + (win_cols + col0)).astype(np.int64)
+
+	return mask
+
+#-------------------------------------------------------
+# Load (or build and save) the index for a buffer
+#------------------------------------------------------
+def fireMask(shp_path, grid, cache_dir, reproject=False, mtime=None):
+	"""
+	this function will return the cached cell index of a buffer shapefile, building it if needed
+	"""
+	key = indexKey(shp_path, grid, reproject, mtime)
+
+	if key in _mask_cache:
+		return _mask_cache[key]
+
+	cache_file = os.path.join(cache_dir, key + ".npz")
+
+	if os.path.exists(cache_file):
+		with np.load(cache_file) as data:
+			mask = { k: data[k] for k in data.files }
+	else:
+		mask = rasterizeBuffer(shp_path, grid, reproject)
+
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir, exist_ok=True)
+
+		tmp_file = "%s.%d.tmp.npz" % (cache_file[:-4], os.getpid())
+		np.savez(tmp_file, **mask)
+		os.replace(tmp_file, cache_file)
+
+	_mask_cache[key] = mask
+
+	return mask
@@ -0,0 +1,266 @@
+"""-------------------------------------------------------------
+	Script Name: 	grib_inventory.py
+	Description: 	Cached GRIB2 message index for byte-range reads
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json, hashlib
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+inventory_version = 1
+
+# GRIB2 code table 4.4 units in hours
+time_unit_hours = { 0: 1./60, 1: 1., 2: 24., 10: 3., 11: 6., 12: 12., 13: 1./3600 }
+
+# (discipline, category, number) -> element base name, GDAL NDFD style
+element_names = { (0, 1, 8): "QPF" }
+
+# levels and probability limits are decoded from scaled integers, compare them to within this
+match_tolerance = 1e-6
+
+#-------------------------------------------------------
+# Helpers for GRIB2 integers
+#------------------------------------------------------
+def _uint(b):
+	return int.from_bytes(b, "big")
+
+def _sint(b):
+	"""
+	GRIB2 signed integers are sign and magnitude, not two's complement
+	"""
+	val = int.from_bytes(b, "big")
+	sign_bit = 1 << (8 * len(b) - 1)
+	if val & sign_bit:
+		return -(val & ~sign_bit)
+	return val
+
+def _hours(unit, value):
+	return value * time_unit_hours.get(unit, 1.)
+
+#-------------------------------------------------------
+# Decode the product definition section
+#------------------------------------------------------
+def decodeProduct(sec4):
+	"""
+	this function will pull parameter, level, forecast time, percentile and probability
+	fields out of a GRIB2 section 4
+	"""
+	template = _uint(sec4[7:9])
+
+	field = {
+		"template": template,
+		"category": sec4[9],
+		"number": sec4[10],
+		"fcst_hours": _hours(sec4[17], _uint(sec4[18:22])),
+		"level_type": sec4[22],
+		"level_value": _sint(sec4[24:28]) * 10 ** -_sint(sec4[23:24]),
+		"stat_hours": None,
+		"percentile": None,
+		"prob_type": None,
+		"prob_lower": None,
+		"prob_upper": None
+	}
+
+	# statistically processed over a time range (accumulations)
+	if template == 8:
+		field["stat_hours"] = _hours(sec4[48], _uint(sec4[49:53]))
+	elif template == 9:
+		field["stat_hours"] = _hours(sec4[61], _uint(sec4[62:66]))
+	elif template == 10:
+		field["stat_hours"] = _hours(sec4[49], _uint(sec4[50:54]))
+
+	# probability templates
+	if template in (5, 9):
+		field["prob_type"] = sec4[36]
+		field["prob_lower"] = _sint(sec4[38:42]) * 10 ** -_sint(sec4[37:38])
+		field["prob_upper"] = _sint(sec4[43:47]) * 10 ** -_sint(sec4[42:43])
+
+	# percentile templates
+	if template in (6, 10):
+		field["percentile"] = sec4[34]
+
+	return field
+
+#-------------------------------------------------------
+# Element name for a decoded field
+#------------------------------------------------------
+def elementName(discipline, field):
+	"""
+	this function will name a field like GDAL's GRIB_ELEMENT (QPF01, QPF06, ...)
+	"""
+	name = element_names.get((discipline, field["category"], field["number"]), "D%d_C%d_N%d" % (discipline, field["category"], field["number"]))
+
+	if field["stat_hours"] is not None:
+		name = "%s%02d" % (name, int(round(field["stat_hours"])))
+
+	return name
+
+#-------------------------------------------------------
+# Walk the messages of a GRIB2 file
+#------------------------------------------------------
+def scanMessages(grib_path):
+	"""
+	this function will walk the GRIB2 messages of a file reading only section headers,
+	sections 1 and 4, and seeking past the grid and data sections
+	"""
+	messages = []
+
+	with open(grib_path, "rb") as f:
+
+		offset = 0
+
+		while True:
+
+			f.seek(offset)
+			sec0 = f.read(16)
+
+			if len(sec0) < 16 or sec0[:4] != b"GRIB":
+				break
+			if sec0[7] != 2:
+				raise ValueError("Not a GRIB2 message at offset %d in %s" % (offset, grib_path))
+
+			discipline = sec0[6]
+			length = _uint(sec0[8:16])
+			ref_time = None
+			fields = []
+
+			pos = offset + 16
+			while pos < offset + length:
+				f.seek(pos)
+				head = f.read(5)
+
+				if head[:4] == b"7777":
+					break
+
+				sec_len, sec_num = _uint(head[:4]), head[4]
+
+				if sec_num == 1:
+					sec1 = head + f.read(sec_len - 5)
+					ref_time = "%04d%02d%02d%02d%02d" % (_uint(sec1[12:14]), sec1[14], sec1[15], sec1[16], sec1[17])
+				elif sec_num == 4:
+					sec4 = head + f.read(sec_len - 5)
+					field = decodeProduct(sec4)
+					field["element"] = elementName(discipline, field)
+					fields.append(field)
+
+				pos += sec_len
+
+			for field in fields:
+				msg = { "offset": offset, "length": length, "discipline": discipline, "ref_time": ref_time, "n_fields": len(fields) }
+				msg.update(field)
+				messages.append(msg)
+
+			offset += length
+
+	return messages
+
+#-------------------------------------------------------
+# Location of the cached inventory for a file
+#------------------------------------------------------
+def inventoryPath(grib_path, cache_dir=None):
+	"""
+	this function will return the inventory path, next to the file or in cache_dir
+	"""
+	if cache_dir is None:
+		return grib_path + ".inv.json"
+
+	# NBM file names repeat across dates, so hash the full path like cfgrib .idx files
+	path_hash = hashlib.sha1(os.path.realpath(grib_path).encode("utf-8")).hexdigest()[:5]
+	return os.path.join(cache_dir, "%s.%s.inv.json" % (os.path.basename(grib_path), path_hash))
+
+#-------------------------------------------------------
+# Load (or build and save) the inventory of a file
+#------------------------------------------------------
+def loadInventory(grib_path, cache_dir=None):
+	"""
+	this function will return the message inventory of a GRIB2 file, rebuilding it when
+	the file size or mtime changed
+	"""
+	info = os.stat(grib_path)
+	inv_path = inventoryPath(grib_path, cache_dir)
+
+	if os.path.exists(inv_path):
+		try:
+			with open(inv_path) as inv_file:
+				inv = json.load(inv_file)
+			if inv["version"] == inventory_version and inv["size"] == info.st_size and inv["mtime"] == info.st_mtime:
+				return inv
+		except (ValueError, KeyError):
+			pass
+
+	inv = {
+		"version": inventory_version,
+		"source": os.path.realpath(grib_path),
+		"size": info.st_size,
+		"mtime": info.st_mtime,
+		"messages": scanMessages(grib_path)
+	}
+
+	os.makedirs(os.path.dirname(os.path.abspath(inv_path)), exist_ok=True)
+	tmp_path = "%s.%d.tmp" % (inv_path, os.getpid())
+	with open(tmp_path, "w") as inv_file:
+		json.dump(inv, inv_file)
+	os.replace(tmp_path, inv_path)
+
+	return inv
+
+#-------------------------------------------------------
+# Find messages in an inventory
+#------------------------------------------------------
+def matchField(msg, element, match):
+	"""
+	this function will check a message has element and every match key equal, numbers that are
+	decoded from scaled integers (levels, probability limits) to within match_tolerance
+	"""
+	if msg["element"] != element:
+		return False
+
+	for key, value in match.items():
+		found = msg.get(key)
+		if isinstance(value, float) and isinstance(found, (int, float)):
+			if abs(found - value) > match_tolerance:
+				return False
+		elif found != value:
+			return False
+
+	return True
+
+def findMessage(inv, element, **match):
+	"""
+	this function will return the last message with element and every match key equal,
+	the same band a linear scan of GRIB_ELEMENT would end on
+	"""
+	found = None
+
+	for msg in inv["messages"]:
+		if matchField(msg, element, match):
+			found = msg
+
+	return found
+
+def findMessages(inv, fields):
+	"""
+	this function will look up several fields in one pass over an inventory
+	fields maps name to (element, match), the result maps the names found to their last message
+	"""
+	found = {}
+
+	for msg in inv["messages"]:
+		for name, (element, match) in fields.items():
+			if matchField(msg, element, match):
+				found[name] = msg
+
+	return found
+
+#-------------------------------------------------------
+# GDAL path reading only one message
+#------------------------------------------------------
+def subfilePath(grib_path, msg):
+	"""
+	this function will return a /vsisubfile/ path covering only the bytes of one message
+	"""
+	return "/vsisubfile/%d_%d,%s" % (msg["offset"], msg["length"], grib_path)
@@ -0,0 +1,124 @@
+"""-------------------------------------------------------------
+	Script Name: 	nbm_remap.py
+	Description: 	Cached NBM grid to web grid remap table
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json, hashlib
+import numpy as np
+from osgeo import gdal
+from fire_mask_index import gridDefinition
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+remap_version = 1
+
+# in-memory copy of every table loaded this process
+_remap_cache = {}
+
+#-------------------------------------------------------
+# Reproject to the web grid
+#------------------------------------------------------
+def webWarp(src_ds, bounds):
+	"""
+	this function will reproject a dataset to EPSG:4326 cut to bounds, then to EPSG:3857 in memory
+	"""
+	## REPROJECT AND CUT OUT SUBREGION (lazy, nothing is read yet)
+	proj_vrt = gdal.Warp("", src_ds, format="VRT", dstSRS='EPSG:4326', outputBounds=bounds, outputBoundsSRS='EPSG:4326')
+
+	## THIS REPROJECTION IS ONLY FOR WEB PURPOSES -- COULD IGNORE
+	return gdal.Warp("", proj_vrt, format="MEM", dstSRS='EPSG:3857')
+
+#-------------------------------------------------------
+# Cache key of a source grid and target
+#------------------------------------------------------
+def remapKey(src_grid, bounds):
+	"""
+	this function will hash the source grid definition with the target bounds
+	"""
+	key = {
+		"version": remap_version,
+		"geotransform": src_grid["geotransform"],
+		"shape": src_grid["shape"],
+		"wkt": src_grid["wkt"],
+		"bounds": list(bounds),
+		"resampling": "near"
+	}
+	return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+#-------------------------------------------------------
+# Build the remap table of a source grid
+#------------------------------------------------------
+def buildRemap(src_grid, bounds):
+	"""
+	this function will warp a raster of source pixel indexes through the same warp as the data,
+	giving the source pixel GDAL's nearest neighbour picks for every web pixel (-1 outside the source)
+	"""
+	rows, cols = src_grid["shape"]
+
+	index_ds = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Int32)
+	index_ds.SetGeoTransform(src_grid["geotransform"])
+	index_ds.SetProjection(src_grid["wkt"])
+
+	band = index_ds.GetRasterBand(1)
+	band.SetNoDataValue(-1)
+	band.WriteArray(np.arange(rows * cols, dtype=np.int32).reshape(rows, cols))
+	band = None
+
+	web_ds = webWarp(index_ds, bounds)
+	lut = web_ds.GetRasterBand(1).ReadAsArray().astype(np.int32)
+
+	return lut, gridDefinition(web_ds)
+
+#-------------------------------------------------------
+# Load (or build and save) the remap table of a source grid
+#------------------------------------------------------
+def loadRemap(src_ds, remap_dir, bounds):
+	"""
+	this function will return the memory-mapped remap table and web grid definition for src_ds
+	"""
+	src_grid = gridDefinition(src_ds)
+	key = remapKey(src_grid, bounds)
+
+	if key in _remap_cache:
+		return _remap_cache[key]
+
+	lut_file = os.path.join(remap_dir, key + ".npy")
+	grid_file = os.path.join(remap_dir, key + ".json")
+
+	if not (os.path.exists(lut_file) and os.path.exists(grid_file)):
+
+		lut, web_grid = buildRemap(src_grid, bounds)
+
+		os.makedirs(remap_dir, exist_ok=True)
+
+		tmp_file = "%s.%d.tmp.npy" % (lut_file[:-4], os.getpid())
+		np.save(tmp_file, lut)
+		os.replace(tmp_file, lut_file)
+
+		tmp_file = "%s.%d.tmp" % (grid_file, os.getpid())
+		with open(tmp_file, "w") as outfile:
+			json.dump(web_grid, outfile)
+		os.replace(tmp_file, grid_file)
+
+	with open(grid_file) as infile:
+		web_grid = json.load(infile)
+
+	remap = { "lut": np.load(lut_file, mmap_mode="r"), "grid": web_grid }
+	_remap_cache[key] = remap
+
+	return remap
+
+#-------------------------------------------------------
+# Reproject an array with the remap table
+#------------------------------------------------------
+def applyRemap(values, lut, nodata=None):
+	"""
+	this function will gather source values onto the web grid in one fancy-index
+	web pixels outside the source get nodata (0 without one, like gdal.Warp)
+	"""
+	fill = nodata if nodata is not None else 0
+	return np.append(values.ravel(), np.array([fill], dtype=values.dtype))[lut]
@@ -0,0 +1,191 @@
+"""-------------------------------------------------------------
+	Script Name: 	pipeline_metrics.py
+	Description: 	Stage timers, counters and profiling for the NBM QPF scripts
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, json, time, datetime, contextlib, cProfile
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+current_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+# JSON lines logs and cProfile dumps
+metrics_dir = os.environ.get("NBM_QPF_METRICS_DIR", current_dir + "/data/nbm/metrics")
+
+# node_exporter textfile collector directory, None to skip the .prom file
+textfile_dir = os.environ.get("NBM_QPF_TEXTFILE_DIR", metrics_dir)
+
+# profile every run with cProfile (or per run with --profile)
+profile_runs = os.environ.get("NBM_QPF_PROFILE", "0") == "1"
+
+metric_prefix = "nbm_qpf"
+
+# the current run of this process
+_run = { "script": None, "run": None, "start": None, "profiler": None }
+_timers = {}
+_counters = {}
+
+#-------------------------------------------------------
+# Start and finish a run
+#------------------------------------------------------
+def startRun(script, profile=False):
+	"""
+	this function will reset the timers and counters for a run of script, and start cProfile
+	when profile (or NBM_QPF_PROFILE=1) is set
+	"""
+	_timers.clear()
+	_counters.clear()
+
+	_run["script"] = script
+	_run["start"] = time.time()
+	_run["run"] = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+	_run["profiler"] = None
+
+	if profile or profile_runs:
+		_run["profiler"] = cProfile.Profile()
+		_run["profiler"].enable()
+
+def finishRun(**fields):
+	"""
+	this function will write the run summary to the JSON lines log, the Prometheus textfile and
+	the cProfile dump; metrics must never break a run, so failures are only printed
+	"""
+	if _run["script"] is None:
+		return
+
+	seconds = time.time() - _run["start"]
+
+	try:
+		if _run["profiler"] is not None:
+			_run["profiler"].disable()
+			os.makedirs(metrics_dir, exist_ok=True)
+			prof_file = os.path.join(metrics_dir, "%s.%s.prof" % (_run["script"], _run["run"]))
+			_run["profiler"].dump_stats(prof_file)
+			print("Profile saved: %s" % prof_file)
+
+		summary = dict(fields, seconds=round(seconds, 3),
+			timers=[ dict(dict(labels), name=name, seconds=round(t[0], 4), calls=t[1]) for (name, labels), t in sorted(_timers.items()) ],
+			counters=[ dict(dict(labels), name=name, value=v) for (name, labels), v in sorted(_counters.items()) ])
+		event("run", **summary)
+
+		if textfile_dir is not None:
+			writeTextfile(seconds)
+
+	except Exception as err:
+		print("Unable to save metrics: %s" % err)
+
+	_run["script"] = None
+
+#-------------------------------------------------------
+# Timers and counters
+#------------------------------------------------------
+def _key(name, labels):
+	return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def addTime(name, seconds, calls=1, **labels):
+	"""
+	this function will add seconds (and calls) to the timer of a stage
+	"""
+	t = _timers.setdefault(_key(name, labels), [0., 0])
+	t[0] += seconds
+	t[1] += calls
+
+def addCount(name, value=1, **labels):
+	"""
+	this function will add value to a counter
+	"""
+	key = _key(name, labels)
+	_counters[key] = _counters.get(key, 0) + value
+
+@contextlib.contextmanager
+def timer(name, **labels):
+	"""
+	this function will time the block it wraps into the timer of a stage
+	"""
+	start = time.time()
+	try:
+		yield
+	finally:
+		addTime(name, time.time() - start, **labels)
+
+@contextlib.contextmanager
+def timed(stages, name):
+	"""
+	this function will add the seconds of the block it wraps to stages[name], for work done in a
+	worker process that reports back through its result record
+	"""
+	start = time.time()
+	try:
+		yield
+	finally:
+		stages[name] = stages.get(name, 0.) + time.time() - start
+
+#-------------------------------------------------------
+# JSON lines log
+#------------------------------------------------------
+def event(kind, **fields):
+	"""
+	this function will append one JSON line (per-hour, per-group or run records) to the daily log
+	"""
+	if _run["script"] is None:
+		return
+
+	rec = dict(fields, event=kind, script=_run["script"], run=_run["run"], time=datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+	try:
+		os.makedirs(metrics_dir, exist_ok=True)
+		log_file = os.path.join(metrics_dir, "%s.%s.jsonl" % (_run["script"], datetime.datetime.utcnow().strftime("%Y%m%d")))
+		with open(log_file, "a") as outfile:
+			outfile.write(json.dumps(rec, sort_keys=True, default=str) + "\n")
+	except (IOError, OSError) as err:
+		print("Unable to log metrics: %s" % err)
+
+#-------------------------------------------------------
+# Prometheus textfile collector output
+#------------------------------------------------------
+def _labels(script, labels):
+	pairs = [("script", script)] + list(labels)
+	return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+def writeTextfile(seconds):
+	"""
+	this function will write the last run's timers and counters as Prometheus gauges, renamed into
+	place so the collector never reads a partial file
+	"""
+	script = _run["script"]
+	lines = []
+
+	lines.append("# HELP %s_run_seconds Duration of the last run." % metric_prefix)
+	lines.append("# TYPE %s_run_seconds gauge" % metric_prefix)
+	lines.append("%s_run_seconds%s %.3f" % (metric_prefix, _labels(script, []), seconds))
+	lines.append("# HELP %s_last_run_timestamp_seconds Unix time the last run finished." % metric_prefix)
+	lines.append("# TYPE %s_last_run_timestamp_seconds gauge" % metric_prefix)
+	lines.append("%s_last_run_timestamp_seconds%s %d" % (metric_prefix, _labels(script, []), time.time()))
+
+	lines.append("# HELP %s_stage_seconds Seconds spent in each stage during the last run." % metric_prefix)
+	lines.append("# TYPE %s_stage_seconds gauge" % metric_prefix)
+	for (name, labels), t in sorted(_timers.items()):
+		lines.append("%s_stage_seconds%s %.4f" % (metric_prefix, _labels(script, [("stage", name)] + list(labels)), t[0]))
+
+	lines.append("# HELP %s_stage_calls Times each stage ran during the last run." % metric_prefix)
+	lines.append("# TYPE %s_stage_calls gauge" % metric_prefix)
+	for (name, labels), t in sorted(_timers.items()):
+		lines.append("%s_stage_calls%s %d" % (metric_prefix, _labels(script, [("stage", name)] + list(labels)), t[1]))
+
+	for name in sorted(set(name for name, labels in _counters)):
+		lines.append("# HELP %s_%s Counter from the last run." % (metric_prefix, name))
+		lines.append("# TYPE %s_%s gauge" % (metric_prefix, name))
+		for (cname, labels), v in sorted(_counters.items()):
+			if cname == name:
+				lines.append("%s_%s%s %s" % (metric_prefix, name, _labels(script, labels), v))
+
+	os.makedirs(textfile_dir, exist_ok=True)
+	prom_file = os.path.join(textfile_dir, "%s_%s.prom" % (metric_prefix, script))
+	tmp_file = "%s.%d.tmp" % (prom_file, os.getpid())
+	with open(tmp_file, "w") as outfile:
+		outfile.write("\n".join(lines) + "\n")
+	os.replace(tmp_file, prom_file)
@@ -10,8 +10,18 @@
 #---------------------------------------------------------------
 # Import python packages
 #---------------------------------------------------------------
-import os, sys, datetime, time, shutil, traceback, pycurl, json
+import os, sys, datetime, time, shutil, traceback, pycurl, json, argparse
+import concurrent.futures
 from osgeo import gdal
+import numpy as np
+from grib_inventory import loadInventory, findMessages, subfilePath
+from fire_mask_index import gridDefinition
+from nbm_remap import webWarp, loadRemap, applyRemap
+from qpf_cube import cubePath, cubeHours, writeCubeHour
+from qpf_stats_engine import writeBlockMax
+from pipeline_metrics import startRun, finishRun, addTime, addCount, timer, timed, event
+from data_retention import convertBytes, fileSize, removeExpired
+from run_state import openState, recordSources, claimHours, recordConversions, sourceChanged, pruneState
  
 #-------------------------------------------------------
 # Global configuration options
@@ -21,17 +31,457 @@ nbm_dir = "/nas/stid/data/nbm"
 data_dir = current_dir + "/data/nbm"
 geotiff_dir = data_dir + "/geotiff"
 images_dir = data_dir + "/images"
+grib_index_dir = data_dir + "/grib_index"
+remap_dir = data_dir + "/remap"
 
 #-------------------------------------------------------
 # Global configuration options
 #-------------------------------------------------------
 num_hrs = 36
+mm_to_inch = 0.0393701
+subregion_bounds = [-128.,25.,-100.,55.]
+# reproject with the cached nearest neighbour remap table instead of gdal.Warp
+use_remap = True
+
+# products written per forecast hour: native NBM grid (only read when the stats run on it,
+# same NBM_QPF_STATS_GRID setting as find_nbm_qpf_stats.py) and EPSG:3857 (web)
+native_products = os.environ.get("NBM_QPF_STATS_GRID", "web") == "native"
+web_products = True
+
+# Grib2 fields extracted per forecast hour, all looked up in one pass over the file's inventory and
+# each decoded once, then reprojected and converted like QPF01 onto the native and web grids
+#	name:     GeoTiffs nbm.<name>.<valid>.tif (web) and nbm.<name>.native.<valid>.tif
+#	element:  GRIB_ELEMENT (QPF01, QPF06, ...)
+#	match:    inventory fields telling fields of one element apart: level_type/level_value,
+#	          percentile, prob_type and prob_lower/prob_upper (the threshold, mm)
+#	scale:    factor to output units, rounded to 0.01 (mm_to_inch for amounts, 1. for probability %)
+#	fhr_step: only forecast hours that are multiples of this carry the field (default 1)
+# the first product is the hourly QPF the fire stats, cubes and images are built from
+grib_products = [
+	{ "name": "qpf", "element": "QPF01", "match": { "percentile": None, "prob_type": None }, "scale": mm_to_inch },
+	# { "name": "qpf06", "element": "QPF06", "match": { "percentile": None, "prob_type": None }, "scale": mm_to_inch, "fhr_step": 6 },
+	# { "name": "qpf06.p90", "element": "QPF06", "match": { "percentile": 90 }, "scale": mm_to_inch, "fhr_step": 6 },
+	# { "name": "pqpf06.0p25in", "element": "QPF06", "match": { "prob_type": 1, "prob_upper": 6.35 }, "scale": 1., "fhr_step": 6 },
+]
+
+# GeoTiffs are tiled, deflated and stored as int16 hundredths of an inch
+tif_blocksize = 256
+quantize_scale = 0.01
+quantize_nodata = -32768
+
+# also write the hourly QPF of each init into one multi-band cube per grid, band by band as
+# each hour is converted
+cube_products = False
 # dt = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
 # dt_datestring = dt.strftime("%Y%m%d")
 process_again = False
 files = []
 
+# init directories older than these are removed (hours), one scan per product tree
+keep_geotiff_hours = 48
+keep_images_hours = 48
+retention_products = [
+	("geotiff", geotiff_dir, "dated", keep_geotiff_hours),
+	("images", images_dir, "dated", keep_images_hours)
+]
+
+# decide which hours to convert from the run-state store (source size/mtime, status, retries)
+# instead of checking every hour's GeoTiffs
+use_run_state = True
+
+# parallel conversion (--workers overrides NBM_QPF_WORKERS)
+workers = int(os.environ.get("NBM_QPF_WORKERS", 1))
+gdal_cache_mb = int(os.environ.get("NBM_QPF_GDAL_CACHE_MB", 256))
+
+#-------------------------------------------------------
+# Open the product fields of an NBM Grib2 file
+#------------------------------------------------------
+def hourProducts(fhr):
+	"""
+	this function will return the entries of grib_products carried by a forecast hour
+	"""
+	return [ product for product in grib_products if fhr % product.get("fhr_step", 1) == 0 ]
+
+def openGribBands(nbm_fullpath, products=None, info=None):
+	"""
+	this function will return {name: (dataset, band)} of the product fields found in a Grib2 file
+	one pass over the cached inventory finds every field and each is opened reading only its
+	message; otherwise the file is opened once and its band metadata scanned once for all of them
+	info (a dict) gets the lookup used and the bytes it reads
+	"""
+	if products is None:
+		products = grib_products
+	if info is None:
+		info = {}
+
+	try:
+		inv = loadInventory(nbm_fullpath, grib_index_dir)
+		found = findMessages(inv, { p["name"]: (p["element"], p["match"]) for p in products })
+	except (IOError, ValueError, KeyError, IndexError):
+		inv, found = None, {}
+
+	bands = {}
+
+	for name, msg in found.items():
+		if msg["n_fields"] == 1:
+			raster = gdal.Open(subfilePath(nbm_fullpath, msg), gdal.GA_ReadOnly)
+
+			# make sure GDAL agrees with the inventory before trusting it
+			if raster is not None and raster.RasterCount == 1 and raster.GetRasterBand(1).GetMetadataItem("GRIB_ELEMENT") == msg["element"]:
+				bands[name] = (raster, 1)
+
+	if len(found) > 0 and len(bands) == len(found):
+		info["lookup"], info["bytes"] = "inventory", sum(msg["length"] for msg in found.values())
+		return bands
+
+	info["lookup"], info["bytes"] = "scan", os.path.getsize(nbm_fullpath)
+
+	nbm_raster = gdal.Open(nbm_fullpath, gdal.GA_ReadOnly)
+	bands = {}
+
+	# inventory fields are in band order, without one only fields with no match values can be told apart
+	by_band = inv is not None and len(inv["messages"]) == nbm_raster.RasterCount
+
+	for lyr in range(1,nbm_raster.RasterCount+1):
+		meta = nbm_raster.GetRasterBand(lyr).GetMetadata()
+
+		## EXTRACT PRODUCT PARAMETERS
+		for p in products:
+			if meta['GRIB_ELEMENT'] != p["element"]:
+				continue
+			if by_band and p["name"] in found:
+				if found[p["name"]] is inv["messages"][lyr-1]:
+					bands[p["name"]] = (nbm_raster, lyr)
+			elif all(value is None for value in p["match"].values()):
+				bands[p["name"]] = (nbm_raster, lyr)
+
+	return bands
+
+def openQPFBand(nbm_fullpath, info=None):
+	"""
+	this function will return (dataset, band) of the hourly QPF field (the first product),
+	band None without it
+	"""
+	bands = openGribBands(nbm_fullpath, grib_products[:1], info)
+	return bands.get(grib_products[0]["name"], (None, None))
+
+#-------------------------------------------------------
+# Extract and reproject the QPF band in memory
+#------------------------------------------------------
+def webQPF(nbm_raster, lyr, qpf_mm=None):
+	"""
+	this function will reproject one GRIB band to the web grid, returning (values, grid, nodata)
+	with the cached remap table, or through a VRT and gdal.Warp when use_remap is off
+	qpf_mm can pass band values that were already decoded
+	"""
+	band = nbm_raster.GetRasterBand(lyr)
+	in_nodata = band.GetNoDataValue()
+
+	if use_remap:
+		if qpf_mm is None:
+			qpf_mm = band.ReadAsArray()
+		remap = loadRemap(nbm_raster, remap_dir, subregion_bounds)
+		return applyRemap(qpf_mm, remap["lut"], in_nodata), remap["grid"], in_nodata
+
+	band_vrt = gdal.Translate("", nbm_raster, format="VRT", bandList=[lyr])
+	web_ds = webWarp(band_vrt, subregion_bounds)
+
+	return web_ds.GetRasterBand(1).ReadAsArray(), gridDefinition(web_ds), in_nodata
+
+#-------------------------------------------------------
+# Convert QPF from mm to inches
+#------------------------------------------------------
+def convertUnits(values, in_nodata, scale):
+	"""
+	this function will scale values to output units rounded to 0.01, like gdal_calc round_((A*scale),2)
+	"""
+	# gdal_calc writes the largest value of the data type as nodata
+	out_nodata = float(np.finfo(values.dtype).max) if values.dtype.kind == "f" else in_nodata
+
+	converted = np.round(values * scale, 2)
+	if in_nodata is not None:
+		converted[values == in_nodata] = out_nodata
+
+	return converted, out_nodata
+
+def convertToInches(qpf_mm, in_nodata):
+	"""
+	this function will convert mm to inches rounded to 0.01, like gdal_calc round_((A*0.0393701),2)
+	"""
+	return convertUnits(qpf_mm, in_nodata, mm_to_inch)
+
+#-------------------------------------------------------
+# Quantize QPF to stored integers
+#------------------------------------------------------
+def quantizeQPF(array, nodata=None):
+	"""
+	this function will return the int16 multiples of quantize_scale stored in the GeoTiffs,
+	missing cells as quantize_nodata
+	"""
+	missing = ~np.isfinite(array)
+	if nodata is not None:
+		missing |= (array == nodata)
+
+	quantized = np.clip(np.rint(np.where(missing, 0., array) / quantize_scale), -32767, 32767).astype(np.int16)
+	quantized[missing] = quantize_nodata
+
+	return quantized
+
+#-------------------------------------------------------
+# Write an array as a GeoTiff on a grid
 #------------------------------------------------------
+def writeGeoTiff(path, array, grid, nodata=None):
+	"""
+	this function will write a single band tiled, compressed GeoTiff (COG layout with overviews) on a grid
+	values are stored as integers of quantize_scale with the scale in the band metadata
+	the file is written under a temporary name and renamed so readers never see a partial GeoTiff
+	"""
+	tmp_path = "%s.%d.part" % (path, os.getpid())
+	rows, cols = grid["shape"]
+
+	quantized = quantizeQPF(array, nodata)
+
+	mem = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Int16)
+	mem.SetGeoTransform(grid["geotransform"])
+	mem.SetProjection(grid["wkt"])
+
+	band = mem.GetRasterBand(1)
+	band.SetNoDataValue(quantize_nodata)
+	band.SetScale(quantize_scale)
+	band.SetOffset(0.)
+	band.WriteArray(quantized)
+	band = None
+
+	if gdal.GetDriverByName("COG") is not None:
+		out = gdal.GetDriverByName("COG").CreateCopy(tmp_path, mem, options=["COMPRESS=DEFLATE", "PREDICTOR=2", "BLOCKSIZE=%d" % tif_blocksize, "OVERVIEWS=AUTO", "RESAMPLING=NEAREST"])
+	else:
+		mem.BuildOverviews("NEAREST", [2, 4, 8, 16])
+		out = gdal.GetDriverByName("GTiff").CreateCopy(tmp_path, mem, options=["TILED=YES", "BLOCKXSIZE=%d" % tif_blocksize, "BLOCKYSIZE=%d" % tif_blocksize, "COMPRESS=DEFLATE", "PREDICTOR=2", "COPY_SRC_OVERVIEWS=YES"])
+
+	out = None
+	mem = None
+
+	os.replace(tmp_path, path)
+
+#-------------------------------------------------------
+# Decode one GRIB2 file to every product on every grid
+#------------------------------------------------------
+def decodeQPF(nbm_fullpath, stages=None, info=None, products=None):
+	"""
+	this function will decode each product field of a GRIB2 file once and return
+	{(name, grid): (values, grid definition, nodata)} for the native and web grids, or None
+	when none of the fields are in the file
+	products defaults to grib_products, stages (a dict) gets the seconds of each step and info
+	the band lookup used
+	"""
+	if products is None:
+		products = grib_products
+	if stages is None:
+		stages = {}
+
+	with timed(stages, "band_lookup"):
+		bands = openGribBands(nbm_fullpath, products, info)
+
+	if len(bands) == 0:
+		return None
+
+	decoded = {}
+
+	for p in products:
+		if p["name"] not in bands:
+			continue
+
+		nbm_raster, lyr = bands[p["name"]]
+
+		## DECODE ONCE AND CONVERT ON THE NATIVE NBM GRID
+		band = nbm_raster.GetRasterBand(lyr)
+		with timed(stages, "grib_decode"):
+			native_mm = band.ReadAsArray()
+
+		if native_products:
+			with timed(stages, "unit_conversion"):
+				values, out_nodata = convertUnits(native_mm, band.GetNoDataValue(), p["scale"])
+			decoded[(p["name"], "native")] = (values, gridDefinition(nbm_raster), out_nodata)
+
+		band = None
+
+		## REPROJECT, CUT OUT SUBREGION AND CONVERT IN MEMORY
+		if web_products:
+			with timed(stages, "warp"):
+				web_mm, web_grid, in_nodata = webQPF(nbm_raster, lyr, native_mm)
+			with timed(stages, "unit_conversion"):
+				values, out_nodata = convertUnits(web_mm, in_nodata, p["scale"])
+			decoded[(p["name"], "web")] = (values, web_grid, out_nodata)
+
+	bands = None
+	nbm_raster = None
+
+	return decoded
+
+#-------------------------------------------------------
+# Make output directories for an init time
+#------------------------------------------------------
+def makeOutputDirs(dt):
+	"""
+	this function will make the geotiff and image directories for an init time
+	"""
+	date_dir = dt.strftime("%Y%m%d")
+	hour_dir = dt.strftime("%H")
+
+	# make geotiff and image directories if they don't exist
+	os.makedirs(geotiff_dir + "/" + date_dir + "/" + hour_dir, exist_ok=True)
+	os.makedirs(images_dir + "/" + date_dir + "/" + hour_dir, exist_ok=True)
+
+#-------------------------------------------------------
+# Input and output files of a forecast hour
+#------------------------------------------------------
+def gribPath(dt, fhr):
+	"""
+	this function will return the NBM Grib2 file of a forecast hour
+	"""
+	nbm_path = nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+	return os.path.join(nbm_path, "blend.t%02dz.core.f%03d.co.grib2" % (int(dt.strftime("%H")), fhr))
+
+def hourTifs(dt, fhr):
+	"""
+	this function will return {(name, grid): GeoTiff path} of the enabled products of a forecast hour
+	"""
+	geotiff_path = geotiff_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H")
+	fcst_time = dt + datetime.timedelta(hours=fhr)
+
+	hour_tifs = {}
+	for p in hourProducts(fhr):
+		if web_products:
+			hour_tifs[(p["name"], "web")] = geotiff_path + "/nbm.%s.%s.tif" % (p["name"], fcst_time.strftime("%Y%m%d%H"))
+		if native_products:
+			hour_tifs[(p["name"], "native")] = geotiff_path + "/nbm.%s.native.%s.tif" % (p["name"], fcst_time.strftime("%Y%m%d%H"))
+
+	return hour_tifs
+
+def cubeFile(dt, native=False):
+	"""
+	this function will return the cube of an init on the native or web grid
+	"""
+	return cubePath(geotiff_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H"), dt, native)
+
+def hourConverted(dt, fhr):
+	"""
+	this function will check every output of a forecast hour exists: its GeoTiffs and, with
+	cube_products, its band of each cube
+	"""
+	if not all(os.path.exists(out_tif) for out_tif in hourTifs(dt, fhr).values()):
+		return False
+
+	if cube_products:
+		for native, enabled in [(False, web_products), (True, native_products)]:
+			if enabled and fhr not in cubeHours(cubeFile(dt, native)):
+				return False
+
+	return True
+
+#-------------------------------------------------------
+# Write the outputs of one product hour
+#------------------------------------------------------
+def writeProduct(dt, fhr, product, out_tif, values, grid, nodata):
+	"""
+	this function will write the GeoTiff and block-max summary of one product hour and, with
+	cube_products, the hourly QPF into its band of the init's cube
+	"""
+	writeGeoTiff(out_tif, values, grid, nodata)
+	writeBlockMax(out_tif, values, nodata)
+
+	name, grid_name = product
+	if cube_products and name == grib_products[0]["name"]:
+		writeCubeHour(cubeFile(dt, grid_name == "native"), dt, fhr, quantizeQPF(values, nodata), grid, quantize_nodata, quantize_scale)
+
+#-------------------------------------------------------
+# Forecast hours of an init to convert
+#------------------------------------------------------
+def gribSources(dt):
+	"""
+	this function will return {fhr: (size, mtime_ns)} of the Grib2 files of an init, from one directory listing
+	"""
+	nbm_path = nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+	names = { os.path.basename(gribPath(dt, fhr)): fhr for fhr in range(1,37) }
+	sources = {}
+
+	for entry in os.scandir(nbm_path):
+		if entry.name in names:
+			info = entry.stat()
+			sources[names[entry.name]] = (info.st_size, info.st_mtime_ns)
+
+	return sources
+
+def initJobs(dt):
+	"""
+	this function will return the forecast hours of an init to convert: with the run-state store the
+	new, changed and retryable hours (claimed for this process), otherwise every hour
+	"""
+	if not use_run_state or process_again:
+		return list(range(1,37))
+
+	conn = openState()
+	recordSources(conn, dt.strftime("%Y%m%d%H"), gribSources(dt))
+
+	return claimHours(conn, dt.strftime("%Y%m%d%H"))
+
+#-------------------------------------------------------
+# Reproject, Re-Calculate and Convert one forecast hour
+#------------------------------------------------------
+def convertHour(dt, fhr):
+	"""
+	this function will convert one forecast hour of an init to GeoTiffs (and cube bands)
+	and return a result record with status and timing
+	"""
+	hr_start = time.time()
+	result = { "init": dt.strftime("%Y%m%d%H"), "fhr": fhr, "status": "converted", "seconds": 0., "error": None,
+		"stages": {}, "lookup": None, "bytes_read": 0, "bytes_written": 0 }
+	stages = result["stages"]
+
+	hour_tifs = hourTifs(dt, fhr)
+
+	# a Grib2 file replaced since its GeoTiffs were written is converted over them
+	changed = use_run_state and sourceChanged(openState(), result["init"], fhr)
+
+	if process_again or changed or not hourConverted(dt, fhr):
+
+		nbm_fullpath = gribPath(dt, fhr)
+
+		if os.path.exists(nbm_fullpath):
+
+			print("Processing fcst hour: %d " % fhr)
+
+			try:
+
+				info = {}
+				products = decodeQPF(nbm_fullpath, stages, info, hourProducts(fhr))
+				result["lookup"], result["bytes_read"] = info.get("lookup"), info.get("bytes", 0)
+
+				for product, (values, grid, out_nodata) in sorted((products or {}).items()):
+					out_tif = hour_tifs[product]
+					with timed(stages, "geotiff_write"):
+						writeProduct(dt, fhr, product, out_tif, values, grid, out_nodata)
+					result["bytes_written"] += os.path.getsize(out_tif)
+
+				# other products are still written when the hourly QPF is missing
+				if not any(name == grib_products[0]["name"] for name, grid in (products or {})):
+					result["status"] = "no_qpf"
+
+			except Exception as err:
+				result["status"] = "failed"
+				result["error"] = traceback.format_exc()
+		else:
+			print("NBM Grib2 file not available for fcst hour: %d" % fhr)
+			result["status"] = "missing"
+	else:
+		print("NBM GeoTiff already exists for fcst hour: %d" % fhr)
+		result["status"] = "exists"
+
+	result["seconds"] = time.time() - hr_start
+
+	return result
+
+#-------------------------------------------------------
 # Reproject, Re-Calculate and Convert as NetCDF
 #------------------------------------------------------
 def convertToRaster(dt):
@@ -39,159 +489,196 @@ def convertToRaster(dt):
     this function reproject, re-calculate, and convert to netcdf
     """
 
-	date_dir = dt.strftime("%Y%m%d")
-	hour_dir = dt.strftime("%H")
-
-	nbm_path = nbm_dir + "/" + date_dir + "/" + hour_dir + "Z"
-	geotiff_path = geotiff_dir + "/" + date_dir + "/" + hour_dir
+	nbm_path = nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+	results = []
 
 	if os.path.exists(nbm_path):
 
 		print("\nConverting NBM Grib2 files to GeoTiffs...")
 
-		# make geotiff directories if they don't exist
-		if not os.path.exists(geotiff_dir + "/" + date_dir):
-			os.makedirs(geotiff_dir + "/" + date_dir)
-		if not os.path.exists(geotiff_dir + "/" + date_dir + "/" + hour_dir):
-			os.makedirs(geotiff_dir + "/" + date_dir + "/" + hour_dir)
-		
-		# make image directories if they don't exist
-		if not os.path.exists(images_dir + "/" + date_dir):
-			os.makedirs(images_dir + "/" + date_dir)
-		if not os.path.exists(images_dir + "/" + date_dir + "/" + hour_dir):
-			os.makedirs(images_dir + "/" + date_dir + "/" + hour_dir)
-
-		for fhr in range(1,37):
-
-			fcst_time = dt + datetime.timedelta(hours=fhr)
-			final_tif = geotiff_path + "/nbm.qpf.%s.tif" % fcst_time.strftime("%Y%m%d%H")
-
-			if not os.path.exists(final_tif) or process_again:
-
-				nbm_file = "blend.t%02dz.core.f%03d.co.grib2" % (int(dt.strftime("%H")), fhr)
-				nbm_fullpath = os.path.join(nbm_path, nbm_file)
-
-				if os.path.exists(nbm_fullpath):
-
-					print("Processing fcst hour: %d " % fhr)
-
-					try:
-
-						nbm_raster = gdal.Open(nbm_fullpath, gdal.GA_ReadOnly)
-						
-						for lyr in range(1,nbm_raster.RasterCount+1):
-							qpf = nbm_raster.GetRasterBand(lyr)
-							meta = qpf.GetMetadata()
-							
-							## EXTRACT QPF PARAMETER
-							if meta['GRIB_ELEMENT'] == "QPF01":
-
-								tmp_geotiff = os.path.join(geotiff_path, "nbm.qpf.%s.tmp.tif" % fcst_time.strftime("%Y%m%d%H"))
-								cmd = "/home/chad.kahler/anaconda3/envs/py37/bin/gdal_translate -b %d %s -of GTiff %s > /dev/null 2>&1" % (lyr, nbm_fullpath, tmp_geotiff)
-								os.system(cmd)
-
-								if os.path.exists(tmp_geotiff):
-									
-									## REPROJECT AND CUT OUT SUBREGION
-									proj_geotiff = tmp_geotiff.replace("tmp","proj")
-									gdal.Warp(proj_geotiff, tmp_geotiff, dstSRS='EPSG:4326', outputBounds=[-128.,25.,-100.,55.], outputBoundsSRS='EPSG:4326')
-									# cmd_proj = "/home/chad.kahler/anaconda3/envs/py37/bin/gdalwarp -overwrite %s %s -te -128. 25. -100. 55. -t_srs EPSG:4326 > /dev/null 2>&1" % (tmp_geotiff, proj_geotiff)
-									# os.system(cmd_proj)
-
-									if os.path.exists(proj_geotiff):
-
-										## THIS REPROJECTION IS ONLY FOR WEB PURPOSES -- COULD IGNORE
-										proj2_geotiff = proj_geotiff.replace("proj","proj2")
-										gdal.Warp(proj2_geotiff, proj_geotiff, dstSRS='EPSG:3857')
-										# cmd_proj2 = "/home/chad.kahler/anaconda3/envs/py37/bin/gdalwarp -overwrite %s %s -t_srs EPSG:3857 > /dev/null 2>&1" % (proj_geotiff, proj2_geotiff)
-										# os.system(cmd_proj2)
-
-										if os.path.exists(proj2_geotiff):
-
-											## CONVERT TO INCHES
-											cmd = "/home/chad.kahler/anaconda3/envs/py37/bin/gdal_calc.py -A " + proj2_geotiff + " --outfile=" + final_tif + " --calc='round_((A*0.0393701),2)' --quiet --overwrite"
-											os.system(cmd)
-
-											if os.path.exists(final_tif):
-												# print("Successfully created: %s" % calculated_tif)
-												if os.path.exists(tmp_geotiff):
-													os.remove(tmp_geotiff)
-												if os.path.exists(proj_geotiff):
-													os.remove(proj_geotiff)
-												if os.path.exists(proj2_geotiff):
-													os.remove(proj2_geotiff)
-					except Exception as err:
-						print(traceback.format_exc())
-						continue								
-				else:
-					print("NBM Grib2 file not available for fcst hour: %d" % fhr)
-			else:
-				print("NBM GeoTiff already exists for fcst hour: %d" % fhr)
+		makeOutputDirs(dt)
+
+		for fhr in initJobs(dt):
+			results.append(convertHour(dt, fhr))
 	else:
 		print("\nNBM Grib2 data not available for %sZ" % dt.strftime("%b %d, %Y, %H"))
 
+	return results
+
 #-------------------------------------------------------
-# Convert file size to useful units
+# Worker process setup
 #------------------------------------------------------
-def convertBytes(num):
-    """
-    this function will convert bytes to MB.... GB... etc
-    """
-    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
-        if num < 1024.0:
-            return "%3.1f %s" % (num, x)
-        num /= 1024.0
+def initWorker():
+	"""
+	this function will cap the GDAL block cache of a worker process
+	"""
+	gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
 
 #-------------------------------------------------------
-# Check file size and return in useful units
+# Convert many init times across a worker pool
 #------------------------------------------------------
-def fileSize(file_path):
-    """
-    this function will return the file size
-    """
-    if os.path.isfile(file_path):
-        file_info = os.stat(file_path)
-        return convertBytes(file_info.st_size)
+def convertParallel(dt_inits, workers):
+	"""
+	this function will spread (init, fhr) conversions across a bounded process pool
+	"""
+	jobs = []
+
+	for dt_init in dt_inits:
+		nbm_path = nbm_dir + "/" + dt_init.strftime("%Y%m%d") + "/" + dt_init.strftime("%H") + "Z"
+
+		if os.path.exists(nbm_path):
+			makeOutputDirs(dt_init)
+			jobs.extend([(dt_init, fhr) for fhr in initJobs(dt_init)])
+		else:
+			print("\nNBM Grib2 data not available for %sZ" % dt_init.strftime("%b %d, %Y, %H"))
+
+	print("\nConverting %d NBM Grib2 files to GeoTiffs with %d workers..." % (len(jobs), workers))
+
+	results = []
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initWorker) as pool:
+		futures = { pool.submit(convertHour, dt_init, fhr): (dt_init, fhr) for dt_init, fhr in jobs }
+
+		for future in concurrent.futures.as_completed(futures):
+			dt_init, fhr = futures[future]
+			try:
+				results.append(future.result())
+			except Exception as err:
+				results.append({ "init": dt_init.strftime("%Y%m%d%H"), "fhr": fhr, "status": "failed", "seconds": 0., "error": traceback.format_exc() })
+
+	return results
+
+#-------------------------------------------------------
+# Summarize conversion results
+#------------------------------------------------------
+def printSummary(results):
+	"""
+	this function will print per-status counts, timing and failures of the conversion jobs
+	"""
+	print('\n#-------------------------------------------------------')
+	print("# Conversion summary")
+	print('#------------------------------------------------------')
+
+	for status in ["converted", "exists", "missing", "no_qpf", "failed"]:
+		jobs = [r for r in results if r["status"] == status]
+		if len(jobs) > 0:
+			seconds = [r["seconds"] for r in jobs]
+			print("%-10s %4d jobs  total %7.1fs  mean %5.2fs  max %5.2fs" % (status, len(jobs), sum(seconds), sum(seconds)/len(jobs), max(seconds)))
+
+	for r in sorted(results, key=lambda r: (r["init"], r["fhr"])):
+		if r["status"] == "failed":
+			print("FAILED %s f%03d: %s" % (r["init"], r["fhr"], r["error"].strip().split("\n")[-1]))
+
+#-------------------------------------------------------
+# Record conversion results in the run metrics
+#------------------------------------------------------
+def recordMetrics(results):
+	"""
+	this function will add the stage timings, statuses and bytes of every conversion job
+	(measured in whichever process ran it) to the run metrics, one log line per job
+	"""
+	for r in results:
+		addCount("hours", status=r["status"])
+		addTime("convert_hour", r["seconds"], status=r["status"])
+
+		for stage, seconds in r.get("stages", {}).items():
+			addTime(stage, seconds)
+
+		addCount("bytes_read", r.get("bytes_read", 0))
+		addCount("bytes_written", r.get("bytes_written", 0))
+
+		if r.get("lookup") is not None:
+			addCount("band_lookups", lookup=r["lookup"])
+
+		error = r["error"].strip().split("\n")[-1] if r["error"] else None
+		event("convert_hour", init=r["init"], fhr=r["fhr"], status=r["status"], seconds=round(r["seconds"], 4),
+			stages={ k: round(v, 4) for k, v in r.get("stages", {}).items() }, bytes_read=r.get("bytes_read", 0),
+			bytes_written=r.get("bytes_written", 0), error=error)
+
+#-------------------------------------------------------
+# Remove expired geotiff and image directories
+#------------------------------------------------------
+def removeOldData():
+	"""
+	this function will remove the init directories older than their product's keep window
+	"""
+	print('\n#-------------------------------------------------------')
+	print("# Removing expired NBM GeoTiffs and images")
+	print('#------------------------------------------------------')
+
+	report = removeExpired(retention_products)
+
+	if use_run_state:
+		keep_hours = max(keep for name, root, layout, keep in retention_products)
+		before = (datetime.datetime.utcnow() - datetime.timedelta(hours=keep_hours)).strftime("%Y%m%d%H")
+		print("Removed %d expired run-state rows" % pruneState(openState(), before))
+
+	for name, res in report.items():
+		addCount("retention_removed", res["removed"], product=name)
+		addCount("retention_bytes", res["bytes"], product=name)
 
 def main():
 
 	start = datetime.datetime.utcnow()
 	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
 
+	parser = argparse.ArgumentParser(description="Convert NBM QPF Grib2 files to GeoTiffs")
+	parser.add_argument("init", nargs="*", type=int, help="custom init time: YYYY MM DD HH")
+	parser.add_argument("--workers", type=int, default=workers, help="worker processes for (init, fhr) jobs (default $NBM_QPF_WORKERS or 1)")
+	parser.add_argument("--profile", action="store_true", help="profile this run with cProfile (also $NBM_QPF_PROFILE=1)")
+	args = parser.parse_args()
 
-	if len(sys.argv) > 1:
-
-		init_yr = int(sys.argv[1])
-		init_mo = int(sys.argv[2])
-		init_dy = int(sys.argv[3])
-		init_hr = int(sys.argv[4])
-		dt_start = datetime.datetime(init_yr, init_mo, init_dy, init_hr, 0)		
+	startRun("process_nbm_qpf", profile=args.profile)
 
-		for lookback in range(0, 6):
+	dt_inits = []
 
-			dt_init = dt_start - datetime.timedelta(hours=lookback)
+	if len(args.init) > 0:
 
-			print('\n#-------------------------------------------------------')
-			print("# +++ CUSTOM DATE+++ ")
-			print("# Processing NBM QPF initialized: %sZ" % dt_init.strftime("%b %d, %Y %H"))
-			print('#------------------------------------------------------')
+		init_yr, init_mo, init_dy, init_hr = args.init[:4]
+		dt_start = datetime.datetime(init_yr, init_mo, init_dy, init_hr, 0)		
 
-			convertToRaster(dt_init)
-			
+		for lookback in range(0, 6):
+			dt_inits.append(dt_start - datetime.timedelta(hours=lookback))
 
 	else:
 
 		for lookback in range(1,7):
 		
 			dt_start = datetime.datetime.utcnow() - datetime.timedelta(hours=lookback)
-			dt_init = dt_start.replace(minute=0,second=0)
+			dt_inits.append(dt_start.replace(minute=0,second=0,microsecond=0))
+
+	if args.workers > 1:
+
+		results = convertParallel(dt_inits, args.workers)
+
+	else:
+
+		results = []
+
+		for dt_init in dt_inits:
 
 			print('\n#-------------------------------------------------------')
+			if len(args.init) > 0:
+				print("# +++ CUSTOM DATE+++ ")
 			print("# Processing NBM QPF initialized: %sZ" % dt_init.strftime("%b %d, %Y %H"))
 			print('#------------------------------------------------------')
 
-			convertToRaster(dt_init)
+			results.extend(convertToRaster(dt_init))
 
+	printSummary(results)
+	recordMetrics(results)
+
+	if use_run_state:
+		with timer("run_state"):
+			recordConversions(openState(), results)
+
+	# a custom date reprocesses old inits, which retention would delete again
+	if len(args.init) == 0:
+		try:
+			with timer("remove_old_data"):
+				removeOldData()
+		except Exception as err:
+			print(traceback.format_exc())
 
 	os.system("/usr/bin/chmod -R 755 %s" % images_dir)
 
@@ -200,5 +687,7 @@ def main():
 	diff_minute = (end-start).total_seconds()/60
 	print("Script execution: %.2f" % diff_minute + " minutes\n")
 
+	finishRun(inits=[dt_init.strftime("%Y%m%d%H") for dt_init in dt_inits], workers=args.workers)
+
 if __name__ == "__main__":
     main()
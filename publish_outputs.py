@@ -0,0 +1,275 @@
+"""-------------------------------------------------------------
+	Script Name: 	publish_outputs.py
+	Description: 	Push only changed output files to web destinations
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json, gzip, shutil, hashlib, fcntl, subprocess, tempfile, traceback, time
+import concurrent.futures
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+manifest_version = 1
+
+# pre-gzipped copies (<file>.gz) are written for these suffixes
+gzip_suffixes = [".json", ".geojson", ".csv", ".txt", ".svg"]
+
+# seconds before a destination's push is given up (retried next pass); targets push at once,
+# so a run waits at most this long (plus push_grace) however many hosts are slow
+push_timeout = 120
+push_grace = 5
+
+rsync_cmd = "/usr/bin/rsync"
+
+#-------------------------------------------------------
+# Content hash of a file
+#------------------------------------------------------
+def fileHash(path):
+	"""
+	this function will return the sha1 of a file's content
+	"""
+	sha = hashlib.sha1()
+	with open(path, "rb") as infile:
+		for chunk in iter(lambda: infile.read(1 << 20), b""):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+#-------------------------------------------------------
+# Walk an output tree
+#------------------------------------------------------
+def scanTree(root):
+	"""
+	this function will return {relative path: (size, mtime_ns)} of every file under root,
+	skipping the derived .gz copies and temporary files
+	"""
+	files = {}
+	stack = [root]
+
+	while stack:
+		path = stack.pop()
+		try:
+			entries = list(os.scandir(path))
+		except (IOError, OSError):
+			continue
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				stack.append(entry.path)
+			elif entry.is_file() and not entry.name.endswith((".gz", ".tmp", ".part")):
+				info = entry.stat()
+				files[os.path.relpath(entry.path, root)] = (info.st_size, info.st_mtime_ns)
+
+	return files
+
+def hashTree(root, previous):
+	"""
+	this function will return {relative path: {size, mtime_ns, sha1}} of root, hashing only
+	files whose size or mtime differ from previous
+	"""
+	current = {}
+
+	for rel, (size, mtime_ns) in scanTree(root).items():
+		old = previous.get(rel)
+		if old is not None and old["size"] == size and old["mtime_ns"] == mtime_ns:
+			current[rel] = old
+		else:
+			try:
+				current[rel] = { "size": size, "mtime_ns": mtime_ns, "sha1": fileHash(os.path.join(root, rel)) }
+			except (IOError, OSError):
+				continue
+
+	return current
+
+#-------------------------------------------------------
+# Pre-gzipped copies for web serving
+#------------------------------------------------------
+def gzipPath(rel):
+	return rel + ".gz"
+
+def writeGzip(root, rel):
+	"""
+	this function will write <file>.gz next to a file (fixed gzip mtime, so equal content gives
+	equal bytes) and return its relative path, or None for suffixes that are not gzipped
+	"""
+	if not rel.endswith(tuple(gzip_suffixes)):
+		return None
+
+	src = os.path.join(root, rel)
+	dst = os.path.join(root, gzipPath(rel))
+	tmp = "%s.%d.tmp" % (dst, os.getpid())
+
+	with open(src, "rb") as infile, open(tmp, "wb") as raw:
+		with gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) as outfile:
+			shutil.copyfileobj(infile, outfile)
+	os.replace(tmp, dst)
+
+	return gzipPath(rel)
+
+#-------------------------------------------------------
+# Transports
+#------------------------------------------------------
+def rsyncTransport(dest, options=None):
+	"""
+	this function will return a transport pushing a list of files with one rsync call,
+	--files-from so only they are looked at and --delete-missing-args for removed files
+	"""
+	def push(root, changed, deleted):
+		with tempfile.NamedTemporaryFile("w", suffix=".files", delete=False) as listfile:
+			listfile.write("\n".join(changed + deleted) + "\n")
+		try:
+			cmd = [rsync_cmd, "-az", "--files-from=" + listfile.name, "--delete-missing-args"] + (options or []) + [root.rstrip("/") + "/", dest]
+			subprocess.run(cmd, check=True, timeout=push_timeout, stdout=subprocess.DEVNULL)
+		finally:
+			os.remove(listfile.name)
+
+	return { "kind": "rsync", "dest": dest, "push": push }
+
+def localTransport(dest):
+	"""
+	this function will return a transport copying files into a local directory
+	(tests, or a web root on the same host)
+	"""
+	def push(root, changed, deleted):
+		for rel in changed:
+			out_path = os.path.join(dest, rel)
+			os.makedirs(os.path.dirname(out_path), exist_ok=True)
+			tmp_path = "%s.%d.tmp" % (out_path, os.getpid())
+			shutil.copy2(os.path.join(root, rel), tmp_path)
+			os.replace(tmp_path, out_path)
+		for rel in deleted:
+			if os.path.exists(os.path.join(dest, rel)):
+				os.remove(os.path.join(dest, rel))
+
+	return { "kind": "local", "dest": dest, "push": push }
+
+#-------------------------------------------------------
+# Manifest of what each destination has
+#------------------------------------------------------
+def loadManifest(manifest_file):
+	"""
+	this function will return the publish manifest: hashed files per root and the hashes each
+	target was last pushed successfully
+	"""
+	if os.path.exists(manifest_file):
+		try:
+			with open(manifest_file) as infile:
+				manifest = json.load(infile)
+			if manifest.get("version") == manifest_version:
+				return manifest
+		except (IOError, ValueError):
+			print("Unable to read publish manifest, republishing: %s" % manifest_file)
+
+	return { "version": manifest_version, "roots": {}, "targets": {} }
+
+def saveManifest(manifest, manifest_file):
+	os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+	tmp_file = "%s.%d.tmp" % (manifest_file, os.getpid())
+	with open(tmp_file, "w") as outfile:
+		json.dump(manifest, outfile)
+	os.replace(tmp_file, manifest_file)
+
+#-------------------------------------------------------
+# Publish changed files to every target
+#------------------------------------------------------
+def targetChanges(files, published):
+	"""
+	this function will return the (changed, deleted) relative paths of a target, with the
+	.gz copies that travel with them
+	"""
+	changed, deleted = [], []
+
+	for rel in sorted(files):
+		if published.get(rel) != files[rel]["sha1"]:
+			changed.append(rel)
+			if files[rel].get("gzip"):
+				changed.append(gzipPath(rel))
+
+	for rel in sorted(published):
+		if rel not in files:
+			deleted.extend([rel, gzipPath(rel)])
+
+	return changed, deleted
+
+def publishOutputs(targets, manifest_file):
+	"""
+	this function will push the files that changed since each target's last successful push,
+	all targets at once; targets are (name, root, transport) and a failed or slow target only
+	keeps its own changes pending for the next pass
+	returns {name: {"changed", "deleted", "seconds", "error"}}
+	"""
+	results = {}
+	os.makedirs(os.path.dirname(os.path.abspath(manifest_file)), exist_ok=True)
+
+	with open(manifest_file + ".lock", "w") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+		manifest = loadManifest(manifest_file)
+
+		# hash each root once, gzip what changed locally
+		trees = {}
+
+		for root in sorted(set(root for name, root, transport in targets)):
+
+			previous = manifest["roots"].get(root, {})
+			files = hashTree(root, previous)
+
+			for rel, entry in files.items():
+				old = previous.get(rel)
+				gz_exists = os.path.exists(os.path.join(root, gzipPath(rel)))
+				if old is None or old["sha1"] != entry["sha1"] or (old.get("gzip") and not gz_exists):
+					entry["gzip"] = writeGzip(root, rel) is not None
+				else:
+					entry["gzip"] = old.get("gzip", False)
+
+			for rel in previous:
+				if rel not in files and os.path.exists(os.path.join(root, gzipPath(rel))):
+					os.remove(os.path.join(root, gzipPath(rel)))
+
+			trees[root] = files
+			manifest["roots"][root] = files
+
+		saveManifest(manifest, manifest_file)
+
+		def pushTarget(name, root, transport):
+			start = time.time()
+			published = manifest["targets"].get(name, {})
+			changed, deleted = targetChanges(trees[root], published)
+			result = { "changed": len(changed), "deleted": len(deleted), "seconds": 0., "error": None }
+
+			if len(changed) + len(deleted) > 0:
+				try:
+					transport["push"](root, changed, deleted)
+				except Exception as err:
+					result["error"] = traceback.format_exc().strip().split("\n")[-1]
+
+			result["seconds"] = time.time() - start
+			return result
+
+		start = time.time()
+		pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(targets), 1))
+		futures = { pool.submit(pushTarget, name, root, transport): (name, root) for name, root, transport in targets }
+
+		done, late = concurrent.futures.wait(futures, timeout=push_timeout + push_grace)
+
+		# a target still pushing is reported failed and keeps its changes pending, the run does not wait on it
+		pool.shutdown(wait=False)
+
+		for future in futures:
+			name, root = futures[future]
+
+			if future in done:
+				results[name] = future.result()
+			else:
+				results[name] = { "changed": 0, "deleted": 0, "seconds": time.time() - start, "error": "timed out after %ds" % push_timeout }
+
+			if results[name]["error"] is None:
+				manifest["targets"][name] = { rel: entry["sha1"] for rel, entry in trees[root].items() }
+
+			print("Published %-12s %5d changed %5d deleted  %6.1fs%s" % (name, results[name]["changed"], results[name]["deleted"],
+				results[name]["seconds"], "  FAILED: " + results[name]["error"] if results[name]["error"] else ""))
+
+		saveManifest(manifest, manifest_file)
+
+	return results
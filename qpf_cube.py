@@ -0,0 +1,116 @@
+"""-------------------------------------------------------------
+	Script Name: 	qpf_cube.py
+	Description: 	Per-init NBM QPF cube (one band per forecast hour)
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, datetime, fcntl, contextlib
+from osgeo import gdal
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+cube_hours = 36
+cube_blocksize = 256
+
+#-------------------------------------------------------
+# Cube file of an init time
+#------------------------------------------------------
+def cubePath(geotiff_path, dt, native=False):
+	"""
+	this function will return the cube GeoTiff path of an init time
+	"""
+	if native:
+		return geotiff_path + "/nbm.qpf.native.cube.%s.tif" % dt.strftime("%Y%m%d%H")
+
+	return geotiff_path + "/nbm.qpf.cube.%s.tif" % dt.strftime("%Y%m%d%H")
+
+#-------------------------------------------------------
+# Lock a cube while it is read or written
+#------------------------------------------------------
+@contextlib.contextmanager
+def cubeLock(cube_path, exclusive=False):
+	"""
+	this function will hold the lock file of a cube for the block it wraps: shared for readers,
+	exclusive for the writer, so a band being written is never read half done
+	"""
+	with open(cube_path + ".lock", "a") as lock_file:
+		fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+		yield
+
+#-------------------------------------------------------
+# Forecast hours already in a cube
+#------------------------------------------------------
+def readHours(cube_path):
+	ds = gdal.Open(cube_path, gdal.GA_ReadOnly)
+	if ds is None:
+		return []
+
+	complete = ds.GetMetadataItem("COMPLETE_HOURS") or ""
+	ds = None
+
+	return [int(fhr) for fhr in complete.split(",") if fhr != ""]
+
+def cubeHours(cube_path):
+	"""
+	this function will return the forecast hours written to a cube, from its metadata only
+	"""
+	if not os.path.exists(cube_path):
+		return []
+
+	with cubeLock(cube_path):
+		return readHours(cube_path)
+
+#-------------------------------------------------------
+# Create an empty cube on a grid
+#------------------------------------------------------
+def createCube(cube_path, grid, dt, nodata, scale):
+	"""
+	this function will create a sparse, tiled, band-interleaved int16 cube with one band per forecast
+	hour so every (hour, y, x) tile is its own compressed chunk
+	"""
+	rows, cols = grid["shape"]
+	tmp_path = "%s.%d.part" % (cube_path, os.getpid())
+
+	options = ["TILED=YES", "BLOCKXSIZE=%d" % cube_blocksize, "BLOCKYSIZE=%d" % cube_blocksize,
+		"COMPRESS=DEFLATE", "PREDICTOR=2", "INTERLEAVE=BAND", "SPARSE_OK=TRUE"]
+
+	cube = gdal.GetDriverByName("GTiff").Create(tmp_path, cols, rows, cube_hours, gdal.GDT_Int16, options=options)
+	cube.SetGeoTransform(grid["geotransform"])
+	cube.SetProjection(grid["wkt"])
+	cube.SetMetadataItem("NBM_INIT", dt.strftime("%Y%m%d%H"))
+	cube.SetMetadataItem("COMPLETE_HOURS", "")
+
+	for fhr in range(1, cube_hours+1):
+		band = cube.GetRasterBand(fhr)
+		band.SetNoDataValue(nodata)
+		band.SetScale(scale)
+		band.SetOffset(0.)
+		band.SetMetadataItem("FORECAST_HOUR", str(fhr))
+		band.SetMetadataItem("VALID_TIME", (dt + datetime.timedelta(hours=fhr)).strftime("%Y%m%d%H"))
+		band = None
+
+	cube = None
+	os.replace(tmp_path, cube_path)
+
+#-------------------------------------------------------
+# Write one forecast hour into a cube
+#------------------------------------------------------
+def writeCubeHour(cube_path, dt, fhr, quantized, grid, nodata, scale):
+	"""
+	this function will write the quantized int16 values of a forecast hour into its band of the
+	init's cube, creating the cube on the first hour, and mark the hour complete
+	"""
+	with cubeLock(cube_path, exclusive=True):
+
+		if not os.path.exists(cube_path):
+			createCube(cube_path, grid, dt, nodata, scale)
+
+		cube = gdal.Open(cube_path, gdal.GA_Update)
+		cube.GetRasterBand(fhr).WriteArray(quantized)
+
+		complete = set(int(h) for h in (cube.GetMetadataItem("COMPLETE_HOURS") or "").split(",") if h != "") | set([fhr])
+		cube.SetMetadataItem("COMPLETE_HOURS", ",".join(str(h) for h in sorted(complete)))
+		cube = None
@@ -0,0 +1,208 @@
+"""-------------------------------------------------------------
+	Script Name: 	qpf_run_output.py
+	Description: 	Compact columnar fire x hour x stat output of a run
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, json
+import numpy as np
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+output_version = 1
+
+# fire metadata stored as columns
+meta_keys = ["year", "state", "name", "perimeter", "buffer"]
+
+# series are stored as int32 hundredths, exceedance fractions as int16 thousandths
+missing_value = np.iinfo(np.int32).min
+missing_fraction = np.iinfo(np.int16).min
+
+#-------------------------------------------------------
+# Files of a run
+#------------------------------------------------------
+def runPaths(data_dir, dt):
+	"""
+	this function will return the paths of a run's indented json, columnar npz, header and web json
+	"""
+	base = data_dir + "/nbm." + dt.strftime("%Y%m%d%H")
+	return { "json": base + ".json", "npz": base + ".npz", "header": base + ".header.json", "web": base + ".min.json" }
+
+def _replace(path, write):
+	tmp_path = "%s.%d.tmp" % (path, os.getpid())
+	write(tmp_path)
+	os.replace(tmp_path, path)
+
+def _hundredths(values):
+	return np.array([missing_value if v is None else int(round(float(v) * 100)) for v in values], dtype=np.int32)
+
+def _fromHundredths(values):
+	return [ None if v == missing_value else int(v) / 100 for v in values ]
+
+#-------------------------------------------------------
+# Write the compact output of a run
+#------------------------------------------------------
+def writeCompactRun(paths, dt, precip_dict):
+	"""
+	this function will write the fires of a run as fire x hour x stat arrays (npz), a small header
+	with the shared valid times and completeness, and a minified columnar json for the web
+	"""
+	valid = sorted(set(v for fire in precip_dict for v in fire["qpf_valid"]))
+	index = { v: i for i, v in enumerate(valid) }
+	nfires, nhours = len(precip_dict), len(valid)
+
+	first = precip_dict[0] if nfires > 0 else {}
+	series_keys = [ k for k in first if k.startswith("qpf_") and k not in ("qpf_valid", "qpf_exceed") ]
+	run_keys = [ k for k in first if k.startswith("run_qpf_") ]
+	thresholds = first.get("exceed_thresholds", [])
+
+	series = np.full((nfires, nhours, len(series_keys)), missing_value, dtype=np.int32)
+	present = np.zeros((nfires, nhours), dtype=bool)
+	exceed = np.full((nfires, nhours, len(thresholds)), missing_fraction, dtype=np.int16)
+	run_value = np.zeros((nfires, len(run_keys)), dtype=np.int32)
+	run_valid = np.zeros((nfires, len(run_keys)), dtype="U10")
+
+	for n, fire in enumerate(precip_dict):
+		cols = [ index[v] for v in fire["qpf_valid"] ]
+		present[n, cols] = True
+		for j, k in enumerate(series_keys):
+			series[n, cols, j] = _hundredths(fire[k])
+		if len(thresholds) > 0 and "qpf_exceed" in fire:
+			exceed[n, cols] = np.rint(np.array(fire["qpf_exceed"], dtype=np.float64).reshape(len(cols), len(thresholds)) * 1000).astype(np.int16)
+		for j, k in enumerate(run_keys):
+			run_value[n, j] = int(round(float(fire[k]["value"]) * 100))
+			run_valid[n, j] = fire[k]["valid"]
+
+	columns = {
+		"valid": np.array(valid, dtype="U10"),
+		"series_keys": np.array(series_keys),
+		"run_keys": np.array(run_keys),
+		"thresholds": np.array(thresholds, dtype=np.float64),
+		"series": series,
+		"present": present,
+		"exceed": exceed,
+		"run_value": run_value,
+		"run_valid": run_valid,
+		"coordinates": np.array([ fire["coordinates"] for fire in precip_dict ], dtype=np.float64).reshape(nfires, 2)
+	}
+	for k in meta_keys:
+		columns["meta_" + k] = np.array([ str(fire[k]) for fire in precip_dict ])
+
+	def writeNPZ(tmp_path):
+		with open(tmp_path, "wb") as outfile:
+			np.savez_compressed(outfile, **columns)
+	_replace(paths["npz"], writeNPZ)
+
+	# completeness is the fewest hours any fire has, what shouldProcess compares
+	header = {
+		"version": output_version,
+		"init": dt.strftime("%Y%m%d%H"),
+		"valid": valid,
+		"complete": int(present.sum(axis=1).min()) if nfires > 0 else 0,
+		"fires": nfires,
+		"series_keys": series_keys,
+		"run_keys": run_keys,
+		"exceed_thresholds": thresholds,
+		"npz": os.path.basename(paths["npz"])
+	}
+
+	def writeHeader(tmp_path):
+		with open(tmp_path, "w") as outfile:
+			json.dump(header, outfile)
+	_replace(paths["header"], writeHeader)
+
+	writeWebJSON(paths, columns, header)
+
+	return header
+
+#-------------------------------------------------------
+# Minified columnar json for the web
+#------------------------------------------------------
+def writeWebJSON(paths, columns, header):
+	"""
+	this function will write the run as minified columnar json: shared valid times once, one
+	column per metadata field and one fire x hour list per stat (null where missing)
+	"""
+	series = columns["series"]
+
+	web = {
+		"version": output_version,
+		"init": header["init"],
+		"valid": header["valid"],
+		"exceed_thresholds": header["exceed_thresholds"],
+		"fires": { k: columns["meta_" + k].tolist() for k in meta_keys },
+		"qpf": {},
+		"run": {}
+	}
+	web["fires"]["coordinates"] = columns["coordinates"].tolist()
+
+	for j, k in enumerate(header["series_keys"]):
+		web["qpf"][k[len("qpf_"):]] = [ _fromHundredths(row) for row in series[:, :, j] ]
+
+	if len(header["exceed_thresholds"]) > 0:
+		web["qpf"]["exceed"] = [ [ None if not p else (row / 1000.).tolist() for row, p in zip(fire, present) ]
+			for fire, present in zip(columns["exceed"], columns["present"]) ]
+
+	for j, k in enumerate(header["run_keys"]):
+		web["run"][k[len("run_qpf_"):]] = { "value": (columns["run_value"][:, j] / 100.).tolist(), "valid": columns["run_valid"][:, j].tolist() }
+
+	def writeWeb(tmp_path):
+		with open(tmp_path, "w") as outfile:
+			json.dump(web, outfile, separators=(",", ":"))
+	_replace(paths["web"], writeWeb)
+
+#-------------------------------------------------------
+# Read the compact output of a run
+#------------------------------------------------------
+def readHeader(paths):
+	"""
+	this function will return the header of a run, or None without one
+	"""
+	if not os.path.exists(paths["header"]):
+		return None
+
+	try:
+		with open(paths["header"]) as infile:
+			header = json.load(infile)
+		return header if header.get("version") == output_version else None
+	except (IOError, ValueError):
+		return None
+
+def readCompactRun(paths):
+	"""
+	this function will rebuild the fire dicts of the indented json from the npz of a run
+	"""
+	with np.load(paths["npz"]) as data:
+		columns = { k: data[k] for k in data.files }
+
+	valid = columns["valid"].tolist()
+	series_keys = columns["series_keys"].tolist()
+	run_keys = columns["run_keys"].tolist()
+	thresholds = columns["thresholds"].tolist()
+
+	precip_dict = []
+
+	for n in range(columns["present"].shape[0]):
+		cols = np.nonzero(columns["present"][n])[0]
+
+		fire = { k: columns["meta_" + k][n].item() for k in meta_keys }
+		fire["year"] = int(fire["year"]) if fire["year"].isdigit() else fire["year"]
+		fire["coordinates"] = columns["coordinates"][n].tolist()
+
+		for j, k in enumerate(series_keys):
+			fire[k] = _fromHundredths(columns["series"][n, cols, j])
+		fire["qpf_valid"] = [ valid[i] for i in cols ]
+
+		if len(thresholds) > 0:
+			fire["exceed_thresholds"] = thresholds
+			fire["qpf_exceed"] = (columns["exceed"][n, cols] / 1000.).tolist()
+
+		for j, k in enumerate(run_keys):
+			fire[k] = { "valid": columns["run_valid"][n, j].item(), "value": "%0.2f" % (columns["run_value"][n, j] / 100.) }
+
+		precip_dict.append(fire)
+
+	return precip_dict
@@ -0,0 +1,474 @@
+"""-------------------------------------------------------------
+	Script Name: 	qpf_stats_engine.py
+	Description: 	Vectorized NBM QPF statistics for every fire and hour
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, contextlib
+import numpy as np
+from osgeo import gdal
+from qpf_thresholds import exceedanceFractions
+from qpf_cube import cubeLock
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+stat_names = ["max", "mean", "range", "sum"]
+
+# tile size of the per-hour block-max summaries
+blockmax_size = 64
+
+# per-fire reductions of the rolling multi-hour accumulations
+rolling_stat_names = ["max", "mean"]
+
+#-------------------------------------------------------
+# Concatenate fire masks into labeled segments
+#------------------------------------------------------
+def fireSegments(masks, shape):
+	"""
+	this function will concatenate the fire cell indexes into one array of segments
+	cropped to the window covering every fire
+	"""
+	counts = np.array([m["index"].size for m in masks], dtype=np.int64)
+	starts = np.zeros(len(masks), dtype=np.int64)
+	starts[1:] = np.cumsum(counts)[:-1]
+
+	if counts.sum() > 0:
+		cells = np.concatenate([m["index"] for m in masks]).astype(np.int64)
+	else:
+		cells = np.zeros(0, dtype=np.int64)
+
+	rows, cols = np.divmod(cells, shape[1])
+
+	if cells.size > 0:
+		window = (int(rows.min()), int(cols.min()), int(rows.max()) + 1, int(cols.max()) + 1)
+	else:
+		window = (0, 0, 0, 0)
+
+	return {
+		"cells": (rows - window[0]) * (window[3] - window[1]) + (cols - window[1]),
+		"labels": np.repeat(np.arange(len(masks)), counts),
+		"starts": starts,
+		"counts": counts,
+		"window": window
+	}
+
+#-------------------------------------------------------
+# Tile-aligned reads covering every fire
+#------------------------------------------------------
+def qpfReads(masks, block, window):
+	"""
+	this function will return (row0, col0, row1, col1) reads of the raster blocks intersecting
+	each fire's bounding box, merging adjacent blocks in a block row into one read
+	"""
+	bx, by = block
+	tiles = set()
+
+	for m in masks:
+		if m["index"].size == 0:
+			continue
+		r0, c0, r1, c1 = [int(v) for v in m["window"]]
+		for tr in range(r0 // by, (r1 - 1) // by + 1):
+			for tc in range(c0 // bx, (c1 - 1) // bx + 1):
+				tiles.add((tr, tc))
+
+	reads = []
+
+	for tr, tc in sorted(tiles):
+		if reads and reads[-1][0] == tr and reads[-1][2] == tc:
+			reads[-1][2] = tc + 1
+		else:
+			reads.append([tr, tc, tc + 1])
+
+	# clip to the window covering every fire cell
+	row0, col0, row1, col1 = window
+	windows = []
+
+	for tr, tc0, tc1 in reads:
+		r0, r1 = max(tr * by, row0), min((tr + 1) * by, row1)
+		c0, c1 = max(tc0 * bx, col0), min(tc1 * bx, col1)
+		if r1 > r0 and c1 > c0:
+			windows.append((r0, c0, r1, c1))
+
+	return windows
+
+#-------------------------------------------------------
+# Read QPF values from a band
+#------------------------------------------------------
+def readQPF(band, window, nodata=None):
+	"""
+	this function will read a window of a QPF band in inches, undoing integer quantization
+	quantized nodata cells are returned as nodata
+	"""
+	row0, col0, row1, col1 = window
+	raw = band.ReadAsArray(col0, row0, col1 - col0, row1 - row0)
+
+	scale = band.GetScale()
+	if scale is None or (scale == 1. and not band.GetOffset()):
+		return raw.astype(np.float64)
+
+	# divide by 1/scale so hundredths decode to the same floats as round(x, 2)
+	inv_scale = 1. / scale
+	if inv_scale == round(inv_scale):
+		values = raw / round(inv_scale)
+	else:
+		values = raw * scale
+	values = values + (band.GetOffset() or 0.)
+
+	band_nodata = band.GetNoDataValue()
+	if band_nodata is not None and nodata is not None:
+		values[raw == band_nodata] = nodata
+
+	return values
+
+#-------------------------------------------------------
+# Load hourly QPF rasters into one (hour, y, x) cube
+#------------------------------------------------------
+def loadQPFCube(paths, window, reads, nodata=None):
+	"""
+	this function will read the fire blocks of every hourly raster into a single array
+	covering window; cells outside the reads are left at zero
+	paths are hourly GeoTiffs or (cube path, band) pairs, each file is opened once and cube files
+	are read under their shared lock
+	reads holds the list of block reads of each hour, hours without reads are not opened
+	"""
+	row0, col0, row1, col1 = window
+	cube = np.zeros((len(paths), row1 - row0, col1 - col0), dtype=np.float64)
+
+	if cube.size == 0:
+		return cube
+
+	datasets = {}
+
+	with contextlib.ExitStack() as locks:
+
+		for i, source in enumerate(paths):
+			if len(reads[i]) == 0:
+				continue
+			path, band_num = (source, 1) if isinstance(source, str) else source
+			if path not in datasets:
+				if not isinstance(source, str):
+					locks.enter_context(cubeLock(path))
+				datasets[path] = gdal.Open(path, gdal.GA_ReadOnly)
+			band = datasets[path].GetRasterBand(band_num)
+			for r0, c0, r1, c1 in reads[i]:
+				cube[i, r0 - row0:r1 - row0, c0 - col0:c1 - col0] = readQPF(band, (r0, c0, r1, c1), nodata)
+			band = None
+
+		datasets = None
+
+	return cube
+
+#-------------------------------------------------------
+# Segmented reductions over fire cells
+#------------------------------------------------------
+def reduceCells(values, segments, nodata=None):
+	"""
+	this function will reduce (hour, cell) values to (hour, fire) max/mean/range/sum
+	fires without valid cells are NaN, matching zonal_stats returning None
+	"""
+	nhours, nfires = values.shape[0], segments["counts"].size
+	stats = { k: np.full((nhours, nfires), np.nan) for k in stat_names }
+
+	# reduceat needs strictly increasing offsets, so empty fires are left as NaN
+	filled = np.nonzero(segments["counts"] > 0)[0]
+	if filled.size == 0 or nhours == 0:
+		return stats
+	starts = segments["starts"][filled]
+
+	valid = ~np.isnan(values)
+	if nodata is not None:
+		valid &= (values != nodata)
+
+	count = np.add.reduceat(valid, starts, axis=1, dtype=np.int64)
+	vmax = np.maximum.reduceat(np.where(valid, values, -np.inf), starts, axis=1)
+	vmin = np.minimum.reduceat(np.where(valid, values, np.inf), starts, axis=1)
+	vsum = np.add.reduceat(np.where(valid, values, 0.), starts, axis=1)
+
+	with np.errstate(invalid="ignore", divide="ignore"):
+		empty = count == 0
+		stats["max"][:, filled] = np.where(empty, np.nan, vmax)
+		stats["mean"][:, filled] = np.where(empty, np.nan, vsum / count)
+		stats["range"][:, filled] = np.where(empty, np.nan, vmax - vmin)
+		stats["sum"][:, filled] = np.where(empty, np.nan, vsum)
+
+	return stats
+
+#-------------------------------------------------------
+# Run-level maxima over the hour axis
+#------------------------------------------------------
+def runMaxima(stats, valid, default_valid):
+	"""
+	this function will return the run max of each stat and the valid time it occurred
+	ties keep the earliest hour and an all-zero run reports default_valid
+	"""
+	run = {}
+
+	for k in stat_names:
+		hourly = stats[k]
+		if hourly.shape[0] == 0:
+			values = np.zeros(hourly.shape[1])
+			times = [default_valid] * hourly.shape[1]
+		else:
+			idx = np.argmax(hourly, axis=0)
+			values = hourly[idx, np.arange(hourly.shape[1])]
+			times = [valid[i] if v > 0 else default_valid for i, v in zip(idx, values)]
+		run[k] = (values, times)
+
+	return run
+
+#-------------------------------------------------------
+# Rolling multi-hour accumulations
+#------------------------------------------------------
+def rollingNames(windows):
+	"""
+	this function will return the stat names of the rolling accumulations (max_3h, mean_3h, ...)
+	"""
+	return [ "%s_%dh" % (k, w) for w in windows for k in rolling_stat_names ]
+
+def rollingStats(values, slots, segments, windows, nodata=None):
+	"""
+	this function will reduce the accumulation of every cell over the w hours ending at each hour
+	to per-fire max/mean, from one prefix sum along the forecast hour (slot) axis
+	windows missing a forecast hour are NaN, cells with nodata in a window are left out of it
+	"""
+	nhours, nfires = values.shape[0], segments["counts"].size
+	stats = { k: np.full((nhours, nfires), np.nan) for k in rollingNames(windows) }
+
+	filled = np.nonzero(segments["counts"] > 0)[0]
+	if filled.size == 0 or nhours == 0:
+		return stats
+	starts = segments["starts"][filled]
+
+	valid = ~np.isnan(values)
+	if nodata is not None:
+		valid &= (values != nodata)
+
+	# row t + 1 holds the sums through slot t, row 0 is all zeros
+	slots = np.asarray(slots, dtype=np.int64)
+	nslots = int(slots.max()) + 1
+
+	acc = np.zeros((nslots + 1, values.shape[1]))
+	acc[slots + 1] = np.where(valid, values, 0.)
+	np.cumsum(acc, axis=0, out=acc)
+
+	bad = np.zeros((nslots + 1, values.shape[1]), dtype=np.int32)
+	bad[slots + 1] = ~valid
+	np.cumsum(bad, axis=0, out=bad)
+
+	present = np.zeros(nslots + 1, dtype=np.int64)
+	present[slots + 1] = 1
+	present = np.cumsum(present)
+
+	for w in windows:
+
+		lo = slots + 1 - w
+		complete = (lo >= 0) & (present[slots + 1] - present[np.maximum(lo, 0)] == w)
+		rows = np.nonzero(complete)[0]
+
+		if rows.size == 0:
+			continue
+
+		hi, lo = slots[rows] + 1, lo[rows]
+		total = acc[hi] - acc[lo]
+		ok = (bad[hi] - bad[lo]) == 0
+
+		count = np.add.reduceat(ok, starts, axis=1, dtype=np.int64)
+		vmax = np.maximum.reduceat(np.where(ok, total, -np.inf), starts, axis=1)
+		vsum = np.add.reduceat(np.where(ok, total, 0.), starts, axis=1)
+
+		with np.errstate(invalid="ignore", divide="ignore"):
+			empty = count == 0
+			vmax = np.where(empty, np.nan, vmax)
+			vmean = np.where(empty, np.nan, vsum / count)
+
+		# clamped to zero like the hourly stats, prefix differences can leave -1e-17
+		for k, v in (("max", vmax), ("mean", vmean)):
+			stats["%s_%dh" % (k, w)][np.ix_(rows, filled)] = np.where(np.isnan(v) | (v > 0), v, 0.)
+
+	return stats
+
+#-------------------------------------------------------
+# Block-max summary of an hourly QPF grid
+#------------------------------------------------------
+def blockMaxPath(tif_path):
+	"""
+	this function will return the block-max summary path of an hourly QPF GeoTiff
+	"""
+	return tif_path[:-4] + ".blockmax.npz"
+
+def blockMax(values, nodata=None, block=blockmax_size):
+	"""
+	this function will return the max |QPF| of every block x block tile, nodata counted as zero
+	"""
+	rows, cols = values.shape
+	ny, nx = -(-rows // block), -(-cols // block)
+
+	valid = np.isfinite(values)
+	if nodata is not None:
+		valid &= (values != nodata)
+
+	padded = np.zeros((ny * block, nx * block), dtype=np.float32)
+	padded[:rows, :cols] = np.where(valid, np.abs(values), 0.)
+
+	return padded.reshape(ny, block, nx, block).max(axis=(1, 3))
+
+def writeBlockMax(tif_path, values, nodata=None, block=blockmax_size):
+	"""
+	this function will save the block-max summary next to an hourly QPF GeoTiff
+	"""
+	out_path = blockMaxPath(tif_path)
+	tmp_path = "%s.%d.tmp.npz" % (out_path[:-4], os.getpid())
+
+	np.savez(tmp_path, blockmax=blockMax(values, nodata, block), block=np.array(block))
+	os.replace(tmp_path, out_path)
+
+def readBlockMax(tif_path):
+	"""
+	this function will return the block-max summary of an hourly QPF GeoTiff, or None without one
+	"""
+	summary_path = blockMaxPath(tif_path)
+
+	if not os.path.exists(summary_path):
+		return None
+
+	with np.load(summary_path) as data:
+		return { "blockmax": data["blockmax"], "block": int(data["block"]) }
+
+#-------------------------------------------------------
+# Fires touching any wet tile
+#------------------------------------------------------
+def wetFires(summary, masks):
+	"""
+	this function will flag the fires whose bounding box covers a tile with non-zero QPF
+	using a summed-area table, so each fire costs four lookups
+	"""
+	wet = summary["blockmax"] > 0
+	block = summary["block"]
+
+	sat = np.zeros((wet.shape[0] + 1, wet.shape[1] + 1), dtype=np.int64)
+	sat[1:, 1:] = wet.cumsum(axis=0).cumsum(axis=1)
+
+	flags = np.zeros(len(masks), dtype=bool)
+
+	for n, m in enumerate(masks):
+		if m["index"].size == 0:
+			continue
+		r0, c0, r1, c1 = [int(v) for v in m["window"]]
+		tr0, tc0 = min(r0 // block, wet.shape[0]), min(c0 // block, wet.shape[1])
+		tr1, tc1 = min((r1 - 1) // block + 1, wet.shape[0]), min((c1 - 1) // block + 1, wet.shape[1])
+		flags[n] = (sat[tr1, tc1] - sat[tr0, tc1] - sat[tr1, tc0] + sat[tr0, tc0]) > 0
+
+	return flags
+
+#-------------------------------------------------------
+# Every fire x every hour in a single pass
+#------------------------------------------------------
+def fireQPFStats(paths, valid, masks, shape, default_valid, nodata=-9999, summaries=None, slots=None, windows=(), thresholds=None):
+	"""
+	this function will compute the hourly and run-level QPF stats of every fire
+	hourly stats are clamped to zero like the original scalar loop
+	paths are hourly GeoTiffs or (cube path, band) pairs
+	summaries are optional block-max summaries per hour: fires with only dry tiles get exact
+	zeros without reading (nodata cells stay nodata), and entirely dry hours are not opened at all
+	with the forecast hour (slot) of each path, rolling accumulations over windows (in hours)
+	are added to the hourly stats as max_3h, mean_3h, ... (no run maxima)
+	with thresholds, the (hour, fire, threshold) fractions of cells reaching each are added as exceed
+	"""
+	segments = fireSegments(masks, shape)
+	nhours = len(paths)
+
+	block = [shape[1], 1]
+	if nhours > 0:
+		path, band_num = (paths[0], 1) if isinstance(paths[0], str) else paths[0]
+		ds = gdal.Open(path, gdal.GA_ReadOnly)
+		block = ds.GetRasterBand(band_num).GetBlockSize()
+		ds = None
+
+	wet = np.ones((nhours, len(masks)), dtype=bool)
+	if summaries is not None:
+		for i, summary in enumerate(summaries):
+			if summary is not None:
+				wet[i] = wetFires(summary, masks)
+
+	all_reads = qpfReads(masks, block, segments["window"])
+	reads = []
+
+	for i in range(nhours):
+		if wet[i].all():
+			reads.append(all_reads)
+		elif wet[i].any():
+			reads.append(qpfReads([masks[n] for n in np.nonzero(wet[i])[0]], block, segments["window"]))
+		else:
+			reads.append([])
+
+	# read only the hours with a wet fire, the rest stay zero
+	wet_hours = np.nonzero(wet.any(axis=1))[0]
+	values = np.zeros((nhours, segments["cells"].size))
+
+	if wet_hours.size > 0:
+		cube = loadQPFCube([paths[i] for i in wet_hours], segments["window"], [reads[i] for i in wet_hours], nodata)
+		values[wet_hours] = cube.reshape(cube.shape[0], -1)[:, segments["cells"]]
+
+	# skipped fire-hours take the grid's nodata cells (the same every hour) so that rolling windows
+	# and exceedance fractions leave them out like they do in a read hour
+	dry = ~wet[:, segments["labels"]]
+
+	if dry.any():
+		read_all = np.nonzero(wet.all(axis=1))[0]
+		if read_all.size > 0:
+			pattern = values[read_all[0]]
+		else:
+			cube = loadQPFCube(paths[:1], segments["window"], [all_reads], nodata)
+			pattern = cube.reshape(1, -1)[0, segments["cells"]]
+		missing = np.isnan(pattern) | (pattern == nodata)
+		values[dry & missing[np.newaxis, :]] = nodata
+
+	return valueStats(values, valid, segments, default_valid, nodata, slots, windows, thresholds, wet)
+
+#-------------------------------------------------------
+# Fire cell values of an in-memory grid
+#------------------------------------------------------
+def gridCells(array, segments):
+	"""
+	this function will return the values of every fire cell (in segment order) of a full 2-D grid
+	"""
+	row0, col0, row1, col1 = segments["window"]
+	return np.asarray(array, dtype=np.float64)[row0:row1, col0:col1].ravel()[segments["cells"]]
+
+#-------------------------------------------------------
+# Stats of (hour, cell) values already in memory
+#------------------------------------------------------
+def valueStats(values, valid, segments, default_valid, nodata=-9999, slots=None, windows=(), thresholds=None, wet=None):
+	"""
+	this function will compute the hourly and run-level stats of every fire from the (hour, cell)
+	values of its segments, as returned by fireQPFStats; wet flags the (hour, fire) pairs that
+	can be non-zero, other pairs are zero without being reduced
+	"""
+	nhours, nfires = values.shape[0], segments["counts"].size
+
+	if wet is None:
+		wet = np.ones((nhours, nfires), dtype=bool)
+
+	# reduce only the hours with a wet fire, the rest stay zero
+	wet_hours = np.nonzero(wet.any(axis=1))[0]
+	stats = { k: np.zeros((nhours, nfires)) for k in stat_names }
+
+	if wet_hours.size > 0:
+		wet_stats = reduceCells(values[wet_hours], segments, nodata)
+
+		for k in stat_names:
+			stats[k][wet_hours] = np.where(wet_stats[k] > 0, wet_stats[k], 0.)
+			stats[k][~wet] = 0.
+
+	run = runMaxima(stats, valid, default_valid)
+
+	if slots is not None and len(windows) > 0:
+		stats.update(rollingStats(values, slots, segments, windows, nodata))
+
+	if thresholds is not None:
+		stats["exceed"] = exceedanceFractions(values, segments, thresholds, nodata)
+
+	return stats, run
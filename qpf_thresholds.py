@@ -0,0 +1,59 @@
+"""-------------------------------------------------------------
+	Script Name: 	qpf_thresholds.py
+	Description: 	Vectorized QPF threshold categories and exceedance fractions
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import numpy as np
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+# category n is reached at threshold n (01 = 0.1 in / 2.54 mm ... 10 = 1.0 in / 25.4 mm)
+threshold_mm = [2.54, 5.08, 7.62, 10.16, 12.7, 15.24, 17.78, 20.32, 22.86, 25.4]
+threshold_inch = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+#-------------------------------------------------------
+# Threshold categories of an array of values
+#------------------------------------------------------
+def precipCategories(values, thresholds):
+	"""
+	this function will return the two digit category ("00", "01", ...) of every value,
+	the number of thresholds it reaches
+	"""
+	bins = np.digitize(np.asarray(values, dtype=np.float64), thresholds)
+	return np.char.mod("%02d", bins)
+
+def precipCategory(val, thresholds):
+	"""
+	this function will return the two digit category of a single value
+	"""
+	return str(precipCategories([val], thresholds)[0])
+
+#-------------------------------------------------------
+# Fraction of fire cells at or above each threshold
+#------------------------------------------------------
+def exceedanceFractions(values, segments, thresholds, nodata=None):
+	"""
+	this function will return the fraction of each fire's valid cells at or above every threshold,
+	shaped (hour, fire, threshold), from one digitize and one bincount over the (hour, cell) values
+	fires without valid cells get zeros
+	"""
+	nhours, nfires, nbins = values.shape[0], segments["counts"].size, len(thresholds) + 1
+
+	valid = ~np.isnan(values)
+	if nodata is not None:
+		valid &= (values != nodata)
+
+	bins = np.digitize(np.where(valid, values, -np.inf), thresholds)
+	keys = (np.arange(nhours, dtype=np.int64)[:, None] * nfires + segments["labels"][None, :]) * nbins + bins
+	counts = np.bincount(keys[valid], minlength=nhours * nfires * nbins).reshape(nhours, nfires, nbins)
+
+	# cells at or above threshold j fall in bin j + 1 and up
+	above = counts[:, :, ::-1].cumsum(axis=2)[:, :, ::-1][:, :, 1:]
+	total = counts.sum(axis=2)[:, :, None]
+
+	with np.errstate(invalid="ignore", divide="ignore"):
+		return np.where(total > 0, above / np.maximum(total, 1), 0.)
@@ -0,0 +1,162 @@
+"""-------------------------------------------------------------
+	Script Name: 	region_stats.py
+	Description: 	Label-mask region statistics for the shapefile stats notebook
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import numpy as np
+import xarray as xr
+import regionmask
+
+#-------------------------------------------------------
+# 2-D label mask of the polygons
+#------------------------------------------------------
+def regionLabels(polygons, lon, lat, wrap_lon=True):
+	"""
+	this function will return a 2-D int32 mask holding the position of the polygon covering each
+	grid cell (-1 outside every polygon) and the positions of polygons that overlap another,
+	which a single label per cell cannot represent
+	"""
+	polygons = polygons.reset_index(drop=True)
+
+	labels = regionmask.mask_geopandas(polygons[["geometry"]], lon, lat, wrap_lon=wrap_lon)
+	labels = np.where(np.isnan(labels.values), -1, labels.values).astype(np.int32)
+
+	overlapping = set()
+	geoms = polygons.geometry.values
+
+	# candidate pairs from the spatial index (query_bulk before geopandas 0.12 took array input)
+	sindex = polygons.sindex
+	if hasattr(sindex, "query_bulk"):
+		pairs = sindex.query_bulk(polygons.geometry, predicate="intersects")
+	else:
+		pairs = sindex.query(polygons.geometry, predicate="intersects")
+
+	for i, j in zip(*pairs):
+		if i < j and geoms[i].intersection(geoms[j]).area > 0:
+			overlapping.update([int(i), int(j)])
+
+	return labels, sorted(overlapping)
+
+#-------------------------------------------------------
+# Grid cells of one polygon
+#------------------------------------------------------
+def regionCells(polygons, i, lon, lat, wrap_lon=True):
+	"""
+	this function will return the flat grid cell indices inside polygon i on its own,
+	building one 2-D mask at a time
+	"""
+	mask = regionmask.mask_geopandas(polygons.iloc[[i]][["geometry"]], lon, lat, wrap_lon=wrap_lon)
+	return np.flatnonzero(~np.isnan(mask.values)).astype(np.int64)
+
+#-------------------------------------------------------
+# Concatenated cell segments of every polygon
+#------------------------------------------------------
+def regionSegments(polygons, lon, lat, wrap_lon=True):
+	"""
+	this function will return the cell indices of every polygon as one array of segments
+	(cells, starts, counts) from the label mask, with overlapping polygons filled from their
+	own sparse cell lists
+	"""
+	labels, overlapping = regionLabels(polygons, lon, lat, wrap_lon)
+	nregions = len(polygons)
+
+	# group the labeled cells by region with one sort
+	flat = labels.ravel()
+	inside = np.flatnonzero(flat >= 0)
+	order = np.argsort(flat[inside], kind="stable")
+	sorted_labels = flat[inside][order]
+
+	bounds = np.searchsorted(sorted_labels, np.arange(nregions + 1))
+	region_cells = [ inside[order][bounds[r]:bounds[r + 1]] for r in range(nregions) ]
+
+	polygons = polygons.reset_index(drop=True)
+	for r in overlapping:
+		region_cells[r] = regionCells(polygons, r, lon, lat, wrap_lon)
+
+	counts = np.array([c.size for c in region_cells], dtype=np.int64)
+	starts = np.zeros(nregions, dtype=np.int64)
+	starts[1:] = np.cumsum(counts)[:-1]
+
+	return {
+		"cells": np.concatenate(region_cells) if nregions > 0 else np.zeros(0, dtype=np.int64),
+		"starts": starts,
+		"counts": counts,
+		"shape": labels.shape,
+		"overlapping": overlapping
+	}
+
+#-------------------------------------------------------
+# Grouped reductions of one grid
+#------------------------------------------------------
+def reduceRegions(values, segments):
+	"""
+	this function will return the max/min/mean of every region for one 2-D grid, skipping NaN
+	regions without valid cells are NaN
+	"""
+	nregions = segments["counts"].size
+	stats = { k: np.full(nregions, np.nan) for k in ["max", "min", "mean"] }
+
+	filled = np.nonzero(segments["counts"] > 0)[0]
+	if filled.size == 0:
+		return stats
+	starts = segments["starts"][filled]
+
+	cells = np.asarray(values, dtype=np.float64).ravel()[segments["cells"]]
+	valid = ~np.isnan(cells)
+
+	count = np.add.reduceat(valid, starts, dtype=np.int64)
+	vmax = np.maximum.reduceat(np.where(valid, cells, -np.inf), starts)
+	vmin = np.minimum.reduceat(np.where(valid, cells, np.inf), starts)
+	vsum = np.add.reduceat(np.where(valid, cells, 0.), starts)
+
+	with np.errstate(invalid="ignore", divide="ignore"):
+		empty = count == 0
+		stats["max"][filled] = np.where(empty, np.nan, vmax)
+		stats["min"][filled] = np.where(empty, np.nan, vmin)
+		stats["mean"][filled] = np.where(empty, np.nan, vsum / count)
+
+	return stats
+
+#-------------------------------------------------------
+# Region stats of a DataArray, one time step at a time
+#------------------------------------------------------
+def regionStats(da, segments, dim="valid_time", prefix="tp", scale=1., region_dim="name"):
+	"""
+	this function will return a Dataset of <prefix>_max/_min/_mean over (dim, region_dim), loading
+	one (y, x) grid of da at a time so memory does not grow with regions or forecast hours
+	values are multiplied by scale (e.g. 1/25.4 for mm to in)
+	"""
+	if dim not in da.dims:
+		da = da.expand_dims(dim)
+
+	nregions = segments["counts"].size
+	out = { k: np.full((da.sizes[dim], nregions), np.nan) for k in ["max", "min", "mean"] }
+
+	for t in range(da.sizes[dim]):
+		frame = da.isel({dim: t}).values * scale
+		if frame.shape != tuple(segments["shape"]):
+			raise ValueError("Grid shape %s does not match the region mask %s" % (frame.shape, tuple(segments["shape"])))
+		stats = reduceRegions(frame, segments)
+		for k in out:
+			out[k][t] = stats[k]
+
+	coords = { dim: da[dim].values, region_dim: np.arange(nregions) }
+
+	return xr.Dataset({ "%s_%s" % (prefix, k): ((dim, region_dim), out[k]) for k in ["max", "min", "mean"] }, coords=coords)
+
+def regionStatsFiles(paths, segments, variable="tp", dim="valid_time", prefix="tp", scale=1., region_dim="name", **open_kwargs):
+	"""
+	this function will stream region stats over model files, opening one at a time
+	(open_kwargs go to xr.open_dataset, e.g. engine="cfgrib", backend_kwargs=...)
+	"""
+	open_kwargs.setdefault("engine", "cfgrib")
+	parts = []
+
+	for path in paths:
+		with xr.open_dataset(path, **open_kwargs) as ds:
+			parts.append(regionStats(ds[variable], segments, dim, prefix, scale, region_dim))
+
+	return xr.concat(parts, dim=dim).sortby(dim)
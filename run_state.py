@@ -0,0 +1,304 @@
+#!/usr/local/anaconda3/envs/py37/bin/python
+
+"""-------------------------------------------------------------
+	Script Name: 	run_state.py
+	Description: 	SQLite store of per-init, per-hour NBM QPF pipeline state
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, time, datetime, sqlite3, contextlib, argparse
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+current_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+state_file = os.environ.get("NBM_QPF_STATE_DB", current_dir + "/data/nbm/run_state.sqlite")
+state_version = 2
+
+# seconds to wait on another process's write lock
+busy_timeout = 60
+
+# a claimed hour whose worker has not reported back after this long is claimed again
+claim_timeout = 1800
+
+# failed hours are retried until they have failed this often (or their source changes)
+max_attempts = 3
+
+# conversion statuses that leave nothing to do for an hour
+done_statuses = ("converted", "exists")
+
+# stats statuses that leave nothing to do for an hour; hours without a QPF field are skipped
+# (terminal until their source changes)
+stats_done_statuses = ("done", "skipped")
+
+schema = """
+CREATE TABLE IF NOT EXISTS hours (
+	init TEXT NOT NULL,
+	fhr INTEGER NOT NULL,
+	source_size INTEGER,
+	source_mtime_ns INTEGER,
+	source_changed INTEGER NOT NULL DEFAULT 0,
+	convert_status TEXT NOT NULL DEFAULT 'pending',
+	convert_seconds REAL,
+	convert_error TEXT,
+	convert_attempts INTEGER NOT NULL DEFAULT 0,
+	converted_at TEXT,
+	claimed_by TEXT,
+	claimed_at REAL,
+	stats_status TEXT NOT NULL DEFAULT 'pending',
+	stats_seconds REAL,
+	stats_error TEXT,
+	stats_at TEXT,
+	PRIMARY KEY (init, fhr)
+);
+CREATE INDEX IF NOT EXISTS hours_convert ON hours (convert_status, init);
+CREATE INDEX IF NOT EXISTS hours_stats ON hours (stats_status, init);
+"""
+
+# connections of this process, by (pid, file)
+_connections = {}
+
+#-------------------------------------------------------
+# Open the store
+#------------------------------------------------------
+def openState(db_file=None):
+	"""
+	this function will return this process's connection to the run-state store (WAL mode, so
+	readers never block the writer), creating the schema the first time
+	"""
+	db_file = db_file or state_file
+	key = (os.getpid(), db_file)
+
+	if key not in _connections:
+		os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+
+		conn = sqlite3.connect(db_file, timeout=busy_timeout, isolation_level=None)
+		conn.row_factory = sqlite3.Row
+		conn.execute("PRAGMA journal_mode=WAL")
+		conn.execute("PRAGMA synchronous=NORMAL")
+
+		version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+		if version != state_version:
+			conn.executescript(schema)
+			# version 1 stores predate the changed-source flag
+			if version == 1:
+				conn.execute("ALTER TABLE hours ADD COLUMN source_changed INTEGER NOT NULL DEFAULT 0")
+			conn.execute("PRAGMA user_version = %d" % state_version)
+
+		_connections[key] = conn
+
+	return _connections[key]
+
+@contextlib.contextmanager
+def transaction(conn):
+	"""
+	this function will run the block it wraps in one write transaction, taking the write lock
+	up front so concurrent processes queue instead of failing part way
+	"""
+	conn.execute("BEGIN IMMEDIATE")
+	try:
+		yield conn
+	except BaseException:
+		conn.execute("ROLLBACK")
+		raise
+	conn.execute("COMMIT")
+
+def _now():
+	return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _lastLine(error):
+	return error.strip().split("\n")[-1] if error else None
+
+#-------------------------------------------------------
+# Source files
+#------------------------------------------------------
+def recordSources(conn, init, sources):
+	"""
+	this function will record the Grib2 size and mtime of each forecast hour of an init
+	({fhr: (size, mtime_ns)}); an hour whose source changed is flagged, so it is converted again
+	over its existing GeoTiffs and evaluated again
+	"""
+	with transaction(conn):
+		for fhr, (size, mtime_ns) in sources.items():
+			conn.execute("""
+				INSERT INTO hours (init, fhr, source_size, source_mtime_ns) VALUES (?, ?, ?, ?)
+				ON CONFLICT (init, fhr) DO UPDATE SET
+					source_changed = CASE WHEN source_size IS NULL OR (source_size IS excluded.source_size AND source_mtime_ns IS excluded.source_mtime_ns)
+						THEN source_changed ELSE 1 END,
+					convert_status = CASE WHEN source_size IS excluded.source_size AND source_mtime_ns IS excluded.source_mtime_ns
+						THEN convert_status ELSE 'pending' END,
+					convert_attempts = CASE WHEN source_size IS excluded.source_size AND source_mtime_ns IS excluded.source_mtime_ns
+						THEN convert_attempts ELSE 0 END,
+					stats_status = CASE WHEN source_size IS excluded.source_size AND source_mtime_ns IS excluded.source_mtime_ns
+						THEN stats_status ELSE 'pending' END,
+					source_size = excluded.source_size,
+					source_mtime_ns = excluded.source_mtime_ns
+				""", (init, fhr, size, mtime_ns))
+
+#-------------------------------------------------------
+# Conversion
+#------------------------------------------------------
+def workerName():
+	return "%s:%d" % (os.uname()[1], os.getpid())
+
+def claimAbandoned(claimed_by, claimed_at):
+	"""
+	this function will check a claim was abandoned: older than claim_timeout, or made by a process
+	of this host that is no longer running
+	"""
+	if claimed_at is None or claimed_at < time.time() - claim_timeout:
+		return True
+
+	host, _, pid = (claimed_by or "").rpartition(":")
+	if host != os.uname()[1] or not pid.isdigit():
+		return False
+
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return True
+	except PermissionError:
+		return False
+
+	return False
+
+def claimHours(conn, init, worker=None, fhrs=None):
+	"""
+	this function will claim the hours of an init that need converting (new or changed sources,
+	failed hours under max_attempts, abandoned claims) for worker and return their fhrs
+	fhrs limits the claim to those forecast hours
+	"""
+	worker = worker or workerName()
+	now = time.time()
+	wanted = None if fhrs is None else set(fhrs)
+
+	with transaction(conn):
+		rows = conn.execute("""
+			SELECT fhr, convert_status, claimed_by, claimed_at FROM hours WHERE init = ? AND source_size IS NOT NULL AND (
+				convert_status IN ('pending', 'missing', 'running')
+				OR (convert_status = 'failed' AND convert_attempts < ?))
+			ORDER BY fhr""", (init, max_attempts)).fetchall()
+
+		fhrs = [ row["fhr"] for row in rows if (wanted is None or row["fhr"] in wanted)
+			and (row["convert_status"] != "running" or claimAbandoned(row["claimed_by"], row["claimed_at"])) ]
+
+		conn.executemany("UPDATE hours SET convert_status = 'running', claimed_by = ?, claimed_at = ? WHERE init = ? AND fhr = ?",
+			[ (worker, now, init, fhr) for fhr in fhrs ])
+
+	return fhrs
+
+def recordConversions(conn, results):
+	"""
+	this function will record the status, timing and error of conversion results and release
+	their claims; newly converted hours need their stats again and hours without QPF have none
+	"""
+	with transaction(conn):
+		for r in results:
+			conn.execute("""
+				INSERT INTO hours (init, fhr) VALUES (?, ?) ON CONFLICT (init, fhr) DO NOTHING""", (r["init"], r["fhr"]))
+			conn.execute("""
+				UPDATE hours SET convert_status = ?, convert_seconds = ?, convert_error = ?, converted_at = ?,
+					convert_attempts = convert_attempts + ?, claimed_by = NULL, claimed_at = NULL,
+					source_changed = CASE WHEN ? = 'converted' THEN 0 ELSE source_changed END,
+					stats_status = CASE WHEN ? = 'converted' THEN 'pending' WHEN ? = 'no_qpf' THEN 'skipped' ELSE stats_status END
+				WHERE init = ? AND fhr = ?""",
+				(r["status"], round(r["seconds"], 4), _lastLine(r["error"]), _now(), 1 if r["status"] == "failed" else 0,
+				r["status"], r["status"], r["status"], r["init"], r["fhr"]))
+
+def sourceChanged(conn, init, fhr):
+	"""
+	this function will check the Grib2 file of an hour changed since it was last converted
+	"""
+	row = conn.execute("SELECT source_changed FROM hours WHERE init = ? AND fhr = ?", (init, fhr)).fetchone()
+	return row is not None and row["source_changed"] == 1
+
+def convertedHours(conn, init):
+	"""
+	this function will return the forecast hours of an init with GeoTiffs
+	"""
+	rows = conn.execute("SELECT fhr FROM hours WHERE init = ? AND convert_status IN (%s) ORDER BY fhr"
+		% ",".join("?" * len(done_statuses)), (init,) + done_statuses).fetchall()
+	return [row["fhr"] for row in rows]
+
+#-------------------------------------------------------
+# Stats
+#------------------------------------------------------
+def recordStats(conn, init, fhrs, status, seconds=None, error=None):
+	"""
+	this function will record the stats status of forecast hours of an init
+	"""
+	with transaction(conn):
+		conn.executemany("""
+			INSERT INTO hours (init, fhr) VALUES (?, ?) ON CONFLICT (init, fhr) DO NOTHING""", [ (init, fhr) for fhr in fhrs ])
+		conn.executemany("""
+			UPDATE hours SET stats_status = ?, stats_seconds = ?, stats_error = ?, stats_at = ? WHERE init = ? AND fhr = ?""",
+			[ (status, seconds, _lastLine(error), _now(), init, fhr) for fhr in fhrs ])
+
+def statsHours(conn, init):
+	"""
+	this function will return the forecast hours of an init already in its fire output
+	"""
+	rows = conn.execute("SELECT fhr FROM hours WHERE init = ? AND stats_status = 'done' ORDER BY fhr", (init,)).fetchall()
+	return [row["fhr"] for row in rows]
+
+def pendingStatsInits(conn, limit=7):
+	"""
+	this function will return the newest inits with converted hours not yet in their fire output
+	"""
+	rows = conn.execute("""
+		SELECT DISTINCT init FROM hours WHERE stats_status NOT IN (%s) AND convert_status IN (%s)
+		ORDER BY init DESC LIMIT ?""" % (",".join("?" * len(stats_done_statuses)), ",".join("?" * len(done_statuses))),
+		stats_done_statuses + done_statuses + (limit,)).fetchall()
+	return [row["init"] for row in rows]
+
+def knownInit(conn, init):
+	"""
+	this function will check the store has rows for an init (otherwise callers fall back to the files)
+	"""
+	return conn.execute("SELECT 1 FROM hours WHERE init = ? LIMIT 1", (init,)).fetchone() is not None
+
+#-------------------------------------------------------
+# Retention and reporting
+#------------------------------------------------------
+def pruneState(conn, before):
+	"""
+	this function will delete the rows of inits older than before (YYYYMMDDHH)
+	"""
+	with transaction(conn):
+		return conn.execute("DELETE FROM hours WHERE init < ?", (before,)).rowcount
+
+def statusReport(conn, since=None):
+	"""
+	this function will return per-init counts of sources, converted, failed and evaluated hours
+	and the latest error
+	"""
+	return conn.execute("""
+		SELECT init,
+			COUNT(source_size) AS sources,
+			SUM(convert_status IN ('converted', 'exists')) AS converted,
+			SUM(convert_status = 'running') AS running,
+			SUM(convert_status = 'failed') AS failed,
+			SUM(stats_status = 'done') AS evaluated,
+			MAX(convert_error) AS error
+		FROM hours WHERE init >= ? GROUP BY init ORDER BY init DESC""", (since or "",)).fetchall()
+
+def main():
+
+	parser = argparse.ArgumentParser(description="Report NBM QPF pipeline state per init")
+	parser.add_argument("--db", default=state_file, help="run-state database (default $NBM_QPF_STATE_DB)")
+	parser.add_argument("--hours", type=int, default=48, help="inits from the last N hours (default 48)")
+	args = parser.parse_args()
+
+	since = (datetime.datetime.utcnow() - datetime.timedelta(hours=args.hours)).strftime("%Y%m%d%H")
+
+	print("%-10s %7s %9s %7s %6s %9s  %s" % ("init", "sources", "converted", "running", "failed", "evaluated", "error"))
+	for row in statusReport(openState(args.db), since):
+		print("%-10s %7d %9d %7d %6d %9d  %s" % (row["init"], row["sources"], row["converted"], row["running"], row["failed"],
+			row["evaluated"], row["error"] or ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+#!/usr/local/anaconda3/envs/py37/bin/python
+
+"""-------------------------------------------------------------
+	Script Name: 	stream_nbm_qpf.py
+	Description: 	Convert NBM QPF and update fire stats as each hour is decoded
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, datetime, time, traceback, threading, queue, argparse
+import concurrent.futures
+import numpy as np
+from process_nbm_qpf import decodeQPF, gribPath, hourTifs, hourProducts, hourConverted, makeOutputDirs, writeProduct, quantizeQPF, quantize_scale, quantize_nodata, nbm_dir
+from process_nbm_qpf import process_again as convert_again, grib_products
+from find_nbm_qpf_stats import loadFires, fireOutput, saveRunOutput, mergeFireStats, mergeRollingStats, qpfGridDefinition
+from find_nbm_qpf_stats import complete_count, stats_grid, rolling_hours, exceed_thresholds, use_run_state
+from qpf_stats_engine import fireSegments, gridCells, valueStats, rollingStats, loadQPFCube, rollingNames
+from run_state import openState, recordStats
+from pipeline_metrics import startRun, finishRun, addTime, addCount, timer, event
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+
+# hours decoded ahead of the one being reduced (bounded, each holds the decoded grids)
+prefetch_hours = 2
+
+# rewrite the fire output after every write_every hours (and after the last one)
+write_every = 6
+
+# with --wait, seconds between checks for the next Grib2 file, and how long it must be
+# unmodified before it is read
+poll_seconds = 10
+settle_seconds = 5
+
+# product and grid the fire stats are computed on
+stats_product = (grib_products[0]["name"], "native" if stats_grid == "native" else "web")
+
+#-------------------------------------------------------
+# Decode forecast hours in order
+#------------------------------------------------------
+def gribReady(path):
+	"""
+	this function will check a Grib2 file exists and is no longer being written
+	"""
+	try:
+		return time.time() - os.path.getmtime(path) >= settle_seconds
+	except OSError:
+		return False
+
+def decodeHours(dt, fhrs, wait=0):
+	"""
+	this function will yield (fhr, products, stages) of every forecast hour in order, decoding each
+	Grib2 file once for all of its grib_products; with wait, a file not there yet is polled for up
+	to wait seconds
+	products is None for hours without a Grib2 file or any product field
+	"""
+	for fhr in fhrs:
+
+		nbm_fullpath = gribPath(dt, fhr)
+		deadline = time.time() + wait
+
+		while not gribReady(nbm_fullpath) and time.time() < deadline:
+			time.sleep(poll_seconds)
+
+		stages = {}
+		products = None
+
+		if os.path.exists(nbm_fullpath):
+			try:
+				products = decodeQPF(nbm_fullpath, stages, products=hourProducts(fhr))
+			except Exception as err:
+				print(traceback.format_exc())
+
+		yield fhr, products, stages
+
+#-------------------------------------------------------
+# Bounded prefetch between stages
+#------------------------------------------------------
+def prefetch(items, size):
+	"""
+	this function will run the items generator in a background thread at most size items ahead,
+	so hour N+1 decodes while hour N is reduced; errors are raised in the consumer
+	"""
+	q = queue.Queue(maxsize=max(size, 1))
+	done = object()
+
+	def fill():
+		try:
+			for item in items:
+				q.put(item)
+		except Exception as err:
+			q.put(err)
+		q.put(done)
+
+	threading.Thread(target=fill, daemon=True).start()
+
+	while True:
+		item = q.get()
+		if item is done:
+			return
+		if isinstance(item, Exception):
+			raise item
+		yield item
+
+#-------------------------------------------------------
+# Fire cell values of one hour
+#------------------------------------------------------
+def storedValues(qpf_in, nodata, segments):
+	"""
+	this function will return the fire cell values of a decoded grid as the GeoTiff stores them
+	(quantize_scale multiples, nodata as -9999), so stats match a run reading the files
+	"""
+	quantized = quantizeQPF(gridCells(qpf_in, segments), nodata)
+	return np.where(quantized == quantize_nodata, -9999., quantized / round(1. / quantize_scale))
+
+def tifValues(tif_path, segments):
+	"""
+	this function will read the fire cell values of an hour converted earlier from its GeoTiff
+	"""
+	window = segments["window"]
+	cube = loadQPFCube([tif_path], window, [[window]], -9999)
+	return cube.reshape(1, -1)[0, segments["cells"]]
+
+def writeHour(dt, fhr, product, tif_path, values, grid, nodata):
+	"""
+	this function will write the GeoTiff, block-max summary and cube band of one product hour (writer thread)
+	"""
+	start = time.time()
+	writeProduct(dt, fhr, product, tif_path, values, grid, nodata)
+	return time.time() - start, os.path.getsize(tif_path)
+
+#-------------------------------------------------------
+# Merge one new hour into the fire output
+#------------------------------------------------------
+def mergeHour(dt, fires, segments, tail, run_maxvals):
+	"""
+	this function will reduce the newest streamed hour and merge it into every fire's output
+	like an incremental stats run; tail holds the (fhr, valid, cell values) of the hours its
+	rolling windows reach back to, newest last
+	"""
+	default_valid = (dt + datetime.timedelta(hours=1)).strftime("%Y%m%d%H")
+	fhr, valid, row = tail[-1]
+
+	with timer("zonal_stats"):
+		stats, run = valueStats(row[np.newaxis], [valid], segments, default_valid, nodata=-9999, thresholds=exceed_thresholds)
+		rolling = rollingStats(np.array([r for h, v, r in tail]), [h for h, v, r in tail], segments, rolling_hours, -9999)
+
+	rolling = { k: rolling[k][-1:] for k in rollingNames(rolling_hours) }
+
+	for n, (kind, f, fire_dict, mask) in enumerate(fires):
+		previous = dict(fire_dict) if "qpf_valid" in fire_dict else None
+		run_maxvals[n] = mergeFireStats(fire_dict, [valid], stats, run, n, previous)
+		mergeRollingStats(fire_dict, [valid], rolling, n, default_valid, previous)
+
+def writeOutput(dt, fires, run_maxvals, fhrs):
+	"""
+	this function will save the run's fire output and record its hours as evaluated
+	"""
+	saveRunOutput(dt, fireOutput(fires, run_maxvals, verbose=False))
+
+	if use_run_state:
+		recordStats(openState(), dt.strftime("%Y%m%d%H"), fhrs, "done")
+
+#-------------------------------------------------------
+# Convert and evaluate one init in a single pass
+#------------------------------------------------------
+def streamRun(dt, wait=0):
+	"""
+	this function will decode each forecast hour of an init once, hand its grid to the fire stats
+	in memory and write its GeoTiffs in a background thread, updating the fire output as it goes
+	hours without a Grib2 file are read once from their GeoTiff when one was converted earlier
+	"""
+	print("\n#----------------------------------------------------")
+	print("# Streaming NBM QPF initialized: %sZ" % dt.strftime("%b %d, %Y %H"))
+	print("#----------------------------------------------------\n")
+
+	makeOutputDirs(dt)
+
+	fires, segments, run_maxvals = None, None, None
+	tail, fhrs = [], []
+	writes = []
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+
+		for fhr, products, stages in prefetch(decodeHours(dt, range(1, complete_count + 1), wait), prefetch_hours):
+
+			hr_start = time.time()
+			hour_tifs = hourTifs(dt, fhr)
+
+			for stage, seconds in stages.items():
+				addTime(stage, seconds)
+
+			write = products is not None and (convert_again or not hourConverted(dt, fhr))
+
+			for product, (values, grid, out_nodata) in (products or {}).items():
+				if write:
+					writes.append(writer.submit(writeHour, dt, fhr, product, hour_tifs[product], values, grid, out_nodata))
+
+			if products is not None and stats_product in products:
+
+				qpf_in, grid, out_nodata = products[stats_product]
+
+			elif os.path.exists(hour_tifs.get(stats_product, "")):
+				grid = qpfGridDefinition(hour_tifs[stats_product])
+
+			else:
+				print("NBM QPF not available for fcst hour: %d" % fhr)
+				addCount("hours_missing")
+				continue
+
+			if fires is None:
+				fires = loadFires(grid)
+				segments = fireSegments([fire[3] for fire in fires], grid["shape"])
+				run_maxvals = [0.] * len(fires)
+
+			with timer("fire_values"):
+				if products is not None and stats_product in products:
+					row = storedValues(qpf_in, out_nodata, segments)
+				else:
+					row = tifValues(hour_tifs[stats_product], segments)
+					addCount("hours_read_geotiff")
+
+			# only the hours the longest rolling window reaches back to are kept
+			tail.append((fhr, (dt + datetime.timedelta(hours=fhr)).strftime("%Y%m%d%H"), row))
+			tail = [ hour for hour in tail if hour[0] > fhr - max(rolling_hours, default=1) ]
+			fhrs.append(fhr)
+			products = None
+
+			mergeHour(dt, fires, segments, tail, run_maxvals)
+
+			if len(fhrs) % write_every == 0:
+				writeOutput(dt, fires, run_maxvals, fhrs)
+
+			addCount("hours_streamed")
+			event("stream_hour", init=dt.strftime("%Y%m%d%H"), fhr=fhr, seconds=round(time.time() - hr_start, 4),
+				stages={ k: round(v, 4) for k, v in stages.items() })
+
+			print("Fcst hour %d: %d fires updated" % (fhr, len(fires)))
+
+		if len(fhrs) > 0 and len(fhrs) % write_every != 0:
+			writeOutput(dt, fires, run_maxvals, fhrs)
+
+	# the writer has finished every GeoTiff once the pool is shut down
+	for future in writes:
+		try:
+			seconds, size = future.result()
+			addTime("geotiff_write", seconds)
+			addCount("bytes_written", size, format="geotiff")
+		except Exception as err:
+			print(traceback.format_exc())
+			addCount("geotiff_failed")
+
+	if len(fhrs) == 0:
+		print("No NBM QPF available for %sZ" % dt.strftime("%b %d, %Y %H"))
+
+def main():
+
+	start = datetime.datetime.utcnow()
+	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
+
+	parser = argparse.ArgumentParser(description="Convert NBM QPF and update fire stats hour by hour")
+	parser.add_argument("init", nargs="*", type=int, help="custom init time: YYYY MM DD HH (default: latest init with Grib2 data)")
+	parser.add_argument("--wait", type=int, default=0, help="seconds to wait for each missing Grib2 file (default 0)")
+	parser.add_argument("--profile", action="store_true", help="profile this run with cProfile (also $NBM_QPF_PROFILE=1)")
+	args = parser.parse_args()
+
+	startRun("stream_nbm_qpf", profile=args.profile)
+
+	dt_init = None
+
+	if len(args.init) > 0:
+
+		init_yr, init_mo, init_dy, init_hr = args.init[:4]
+		dt_init = datetime.datetime(init_yr, init_mo, init_dy, init_hr, 0)
+
+	else:
+
+		for lookback in range(0, 7):
+			dt = (datetime.datetime.utcnow() - datetime.timedelta(hours=lookback)).replace(minute=0, second=0, microsecond=0)
+			if os.path.exists(nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"):
+				dt_init = dt
+				break
+
+	if dt_init is not None:
+		try:
+			with timer("stream_run", init=dt_init.strftime("%Y%m%d%H")):
+				streamRun(dt_init, args.wait)
+		except Exception as err:
+			print(traceback.format_exc())
+	else:
+		print("No NBM Grib2 init found")
+
+	end = datetime.datetime.utcnow()
+	print("\nScript completed at " + end.strftime("%a %b %d, %Y %H:%M:%S Z"))
+	diff_minute = (end-start).total_seconds()/60
+	print("Script execution: %.2f" % diff_minute + " minutes\n")
+
+	finishRun(inits=[dt_init.strftime("%Y%m%d%H")] if dt_init is not None else [])
+
+if __name__ == "__main__":
+    main()
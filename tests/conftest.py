@@ -0,0 +1,8 @@
+"""-------------------------------------------------------------
+	Script Name: 	conftest.py
+	Description: 	Shared pytest setup, the scripts are imported from the repo root
+-------------------------------------------------------------"""
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
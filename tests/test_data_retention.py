@@ -0,0 +1,90 @@
+"""-------------------------------------------------------------
+	Script Name: 	test_data_retention.py
+	Description: 	Expiry windows of the dated and flat product trees
+-------------------------------------------------------------"""
+
+import os, datetime
+import pytest
+
+from data_retention import expiredRuns, removeExpired
+
+#-------------------------------------------------------
+# Product trees
+#------------------------------------------------------
+def datedTree(root):
+	for date_dir, hours in [ ("20260101", ["00", "06", "12", "18"]), ("20260102", ["00", "06", "12"]), ("20260103", ["00"]) ]:
+		for hour_dir in hours:
+			os.makedirs(os.path.join(root, date_dir, hour_dir))
+			with open(os.path.join(root, date_dir, hour_dir, "qpf.tif"), "wb") as outfile:
+				outfile.write(b"\0" * 100)
+	# not init directories
+	os.makedirs(os.path.join(root, "shp"))
+	os.makedirs(os.path.join(root, "20260102", "tmp"))
+
+def flatTree(root):
+	os.makedirs(root)
+	for name in ["nbm.2026010100.json", "nbm.2026010112.npz", "nbm.2026010200.min.json", "nbm.2026010206.json", "notes.txt"]:
+		with open(os.path.join(root, name), "w") as outfile:
+			outfile.write("{}")
+
+def names(root, expired):
+	return [ (os.path.relpath(path, root), dt_init.strftime("%Y%m%d%H")) for path, dt_init in expired ]
+
+#-------------------------------------------------------
+# Tests
+#------------------------------------------------------
+def test_dated_expires_whole_days_and_hours(tmp_path):
+	root = str(tmp_path / "grib")
+	datedTree(root)
+
+	expired = expiredRuns(root, "dated", datetime.datetime(2026, 1, 2, 7))
+
+	assert names(root, expired) == [ ("20260101", "2026010100"), ("20260102/00", "2026010200"), ("20260102/06", "2026010206") ]
+
+def test_dated_cutoff_on_last_hour_of_day(tmp_path):
+	root = str(tmp_path / "grib")
+	datedTree(root)
+
+	# the 23z of the first day has not expired, so its hours are listed one by one
+	expired = expiredRuns(root, "dated", datetime.datetime(2026, 1, 1, 23))
+	assert names(root, expired) == [ ("20260101/00", "2026010100"), ("20260101/06", "2026010106"),
+		("20260101/12", "2026010112"), ("20260101/18", "2026010118") ]
+
+	expired = expiredRuns(root, "dated", datetime.datetime(2026, 1, 1, 23, 1))
+	assert names(root, expired) == [ ("20260101", "2026010100") ]
+
+def test_dated_nothing_expired(tmp_path):
+	root = str(tmp_path / "grib")
+	datedTree(root)
+
+	assert expiredRuns(root, "dated", datetime.datetime(2026, 1, 1, 0)) == []
+
+def test_flat_expires_by_init_in_name(tmp_path):
+	root = str(tmp_path / "stats")
+	flatTree(root)
+
+	expired = expiredRuns(root, "flat", datetime.datetime(2026, 1, 2, 0))
+
+	assert names(root, expired) == [ ("nbm.2026010100.json", "2026010100"), ("nbm.2026010112.npz", "2026010112") ]
+
+def test_missing_root_and_unknown_layout(tmp_path):
+	assert expiredRuns(str(tmp_path / "missing"), "dated", datetime.datetime(2026, 1, 2)) == []
+	assert expiredRuns(str(tmp_path / "missing"), "flat", datetime.datetime(2026, 1, 2)) == []
+
+	with pytest.raises(ValueError):
+		expiredRuns(str(tmp_path), "nested", datetime.datetime(2026, 1, 2))
+
+def test_remove_expired(tmp_path):
+	root = str(tmp_path / "grib")
+	datedTree(root)
+	products = [ ("grib", root, "dated", 24) ]
+	now = datetime.datetime(2026, 1, 3, 7)
+
+	report = removeExpired(products, now=now, dry_run=True)
+	assert report["grib"] == { "removed": 3, "bytes": 600 }
+	assert os.path.isdir(os.path.join(root, "20260101"))
+
+	report = removeExpired(products, now=now)
+	assert report["grib"] == { "removed": 3, "bytes": 600 }
+	assert sorted(os.listdir(root)) == ["20260102", "20260103", "shp"]
+	assert sorted(os.listdir(os.path.join(root, "20260102"))) == ["12", "tmp"]
@@ -0,0 +1,87 @@
+"""-------------------------------------------------------------
+	Script Name: 	test_qpf_run_output.py
+	Description: 	Compact run output round trip against the indented json
+-------------------------------------------------------------"""
+
+import json, datetime
+
+from qpf_run_output import runPaths, writeCompactRun, readHeader, readCompactRun
+
+series_keys = ["qpf_max", "qpf_mean", "qpf_range", "qpf_sum", "qpf_max_3h", "qpf_mean_3h"]
+thresholds = [0.1, 0.5, 1.0]
+
+#-------------------------------------------------------
+# Fire output like find_nbm_qpf_stats writes it
+#------------------------------------------------------
+def fireDict(n, valid):
+	fire = {
+		"year": 2025 + n,
+		"state": "CA",
+		"name": "Fire %d" % n,
+		"perimeter": "fire_%d_perimeter.geojson" % n,
+		"buffer": "fire_%d_10mi_buffer.geojson" % n,
+		"coordinates": [37.5 + n, -120.25 - n]
+	}
+
+	for j, k in enumerate(series_keys):
+		fire[k] = [ round(0.07 * (i + 1) * (j + 1) + 0.01 * n, 2) for i in range(len(valid)) ]
+	# rolling windows are missing until they are complete
+	fire["qpf_max_3h"][0] = None
+	fire["qpf_mean_3h"][0] = None
+	fire["qpf_valid"] = list(valid)
+
+	fire["exceed_thresholds"] = list(thresholds)
+	fire["qpf_exceed"] = [ [ round(1. / (i + 2 + t), 3) for t in range(len(thresholds)) ] for i in range(len(valid)) ]
+
+	for k in ["max", "mean", "range", "sum", "max_3h", "mean_3h"]:
+		fire["run_qpf_" + k] = { "valid": valid[-1], "value": "%0.2f" % (1.5 + n) }
+
+	return fire
+
+def precipDict():
+	valid = [ "20260101%02d" % h for h in range(1, 7) ]
+	# the second fire is missing hours the first one has
+	return [ fireDict(0, valid), fireDict(1, valid[1:4]), fireDict(2, valid) ]
+
+#-------------------------------------------------------
+# Tests
+#------------------------------------------------------
+def test_round_trip_matches_json(tmp_path):
+	paths = runPaths(str(tmp_path), datetime.datetime(2026, 1, 1, 0))
+	precip_dict = precipDict()
+
+	writeCompactRun(paths, datetime.datetime(2026, 1, 1, 0), precip_dict)
+
+	assert readCompactRun(paths) == json.loads(json.dumps(precip_dict))
+
+def test_header(tmp_path):
+	dt = datetime.datetime(2026, 1, 1, 0)
+	paths = runPaths(str(tmp_path), dt)
+
+	written = writeCompactRun(paths, dt, precipDict())
+	header = readHeader(paths)
+
+	assert header == written
+	assert header["init"] == "2026010100"
+	assert header["valid"] == [ "20260101%02d" % h for h in range(1, 7) ]
+	assert header["complete"] == 3
+	assert header["fires"] == 3
+	assert header["exceed_thresholds"] == thresholds
+
+def test_web_json(tmp_path):
+	dt = datetime.datetime(2026, 1, 1, 0)
+	paths = runPaths(str(tmp_path), dt)
+	precip_dict = precipDict()
+
+	writeCompactRun(paths, dt, precip_dict)
+	with open(paths["web"]) as infile:
+		web = json.load(infile)
+
+	assert web["fires"]["name"] == [ fire["name"] for fire in precip_dict ]
+	assert web["qpf"]["max"][0] == precip_dict[0]["qpf_max"]
+	assert web["qpf"]["max"][1] == [None] + precip_dict[1]["qpf_max"] + [None, None]
+	assert web["qpf"]["exceed"][1][0] is None
+	assert web["run"]["max"]["value"] == [1.5, 2.5, 3.5]
+
+def test_missing_header(tmp_path):
+	assert readHeader(runPaths(str(tmp_path), datetime.datetime(2026, 1, 1, 0))) is None
@@ -0,0 +1,108 @@
+"""-------------------------------------------------------------
+	Script Name: 	test_qpf_stats_engine.py
+	Description: 	Segmented fire reductions against a per-fire loop
+-------------------------------------------------------------"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+
+from qpf_stats_engine import fireSegments, reduceCells, runMaxima, stat_names
+
+nodata = -9999
+
+#-------------------------------------------------------
+# Fires of a small grid, one of them without cells
+#------------------------------------------------------
+def fireMasks():
+	indexes = [ [0, 1, 2, 10, 11], [], [11, 12, 40, 41, 42, 43], [99] ]
+	masks = []
+
+	for index in indexes:
+		index = np.array(index, dtype=np.int64)
+		rows, cols = np.divmod(index, 10)
+		window = (rows.min(), cols.min(), rows.max() + 1, cols.max() + 1) if index.size > 0 else (0, 0, 0, 0)
+		masks.append({ "index": index, "window": window })
+
+	return masks
+
+def cellValues(segments, nhours, seed=0):
+	rng = np.random.default_rng(seed)
+	values = np.round(rng.random((nhours, segments["cells"].size)) * 2 - 0.2, 2)
+	values[rng.random(values.shape) < 0.2] = nodata
+	values[0, :] = nodata
+	return values
+
+def naiveStats(values, segments):
+	"""
+	this function will reduce every fire and hour one at a time, like the zonal_stats loop
+	"""
+	nhours, nfires = values.shape[0], segments["counts"].size
+	stats = { k: np.full((nhours, nfires), np.nan) for k in stat_names }
+
+	for n in range(nfires):
+		start, count = segments["starts"][n], segments["counts"][n]
+		for t in range(nhours):
+			cells = values[t, start:start + count]
+			cells = cells[cells != nodata]
+			if cells.size == 0:
+				continue
+			stats["max"][t, n] = cells.max()
+			stats["mean"][t, n] = cells.mean()
+			stats["range"][t, n] = cells.max() - cells.min()
+			stats["sum"][t, n] = cells.sum()
+
+	return stats
+
+#-------------------------------------------------------
+# Tests
+#------------------------------------------------------
+def test_reduce_cells_matches_per_fire_loop():
+	segments = fireSegments(fireMasks(), (10, 10))
+	values = cellValues(segments, 6)
+
+	stats = reduceCells(values, segments, nodata)
+	expected = naiveStats(values, segments)
+
+	for k in stat_names:
+		np.testing.assert_allclose(stats[k], expected[k], equal_nan=True)
+
+def test_reduce_cells_empty_fires_are_nan():
+	segments = fireSegments(fireMasks(), (10, 10))
+	stats = reduceCells(cellValues(segments, 3), segments, nodata)
+
+	for k in stat_names:
+		assert np.isnan(stats[k][:, 1]).all()
+		assert np.isnan(stats[k][0]).all()
+
+def test_run_maxima_matches_per_fire_loop():
+	segments = fireSegments(fireMasks(), (10, 10))
+	stats = reduceCells(cellValues(segments, 8, seed=1), segments, nodata)
+	stats = { k: np.where(stats[k] > 0, stats[k], 0.) for k in stat_names }
+	valid = [ "20260101%02d" % t for t in range(8) ]
+
+	run = runMaxima(stats, valid, "default")
+
+	for k in stat_names:
+		values, times = run[k]
+		for n in range(segments["counts"].size):
+			best, best_time = 0., "default"
+			for t in range(len(valid)):
+				if stats[k][t, n] > best:
+					best, best_time = stats[k][t, n], valid[t]
+			assert values[n] == best
+			assert times[n] == best_time
+
+def test_run_maxima_ties_keep_earliest_hour():
+	stats = { k: np.array([[0.], [1.5], [1.5]]) for k in stat_names }
+	run = runMaxima(stats, ["a", "b", "c"], "default")
+
+	assert run["max"][1] == ["b"]
+
+def test_run_maxima_without_hours():
+	stats = { k: np.zeros((0, 2)) for k in stat_names }
+	run = runMaxima(stats, [], "default")
+
+	assert run["max"][1] == ["default", "default"]
+	assert (run["max"][0] == 0).all()
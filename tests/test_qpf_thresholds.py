@@ -0,0 +1,49 @@
+"""-------------------------------------------------------------
+	Script Name: 	test_qpf_thresholds.py
+	Description: 	Threshold categories and exceedance fractions
+-------------------------------------------------------------"""
+
+import numpy as np
+import pytest
+
+from qpf_thresholds import precipCategories, precipCategory, exceedanceFractions, threshold_inch, threshold_mm
+
+#-------------------------------------------------------
+# Tests
+#------------------------------------------------------
+@pytest.mark.parametrize("thresholds", [threshold_inch, threshold_mm])
+def test_categories_at_each_threshold_boundary(thresholds):
+	for n, t in enumerate(thresholds):
+		assert precipCategory(t, thresholds) == "%02d" % (n + 1)
+		assert precipCategory(np.nextafter(t, -np.inf), thresholds) == "%02d" % n
+
+def test_categories_below_and_above_the_range():
+	assert precipCategory(0., threshold_inch) == "00"
+	assert precipCategory(-0.01, threshold_inch) == "00"
+	assert precipCategory(5., threshold_inch) == "10"
+
+def test_categories_of_decoded_hundredths():
+	# quantized QPF decodes as hundredths / 100, 0.10 must reach category 01 and not stay at 00
+	values = np.arange(0, 151) / 100
+	expected = [ "%02d" % min(h // 10, 10) for h in range(151) ]
+
+	assert precipCategories(values, threshold_inch).tolist() == expected
+
+def test_exceedance_fractions_match_per_fire_counts():
+	rng = np.random.default_rng(0)
+	counts = np.array([4, 0, 7, 3])
+	segments = { "counts": counts, "labels": np.repeat(np.arange(counts.size), counts) }
+	values = np.round(rng.random((5, counts.sum())) * 1.2, 2)
+	values[rng.random(values.shape) < 0.25] = -9999
+	values[:, :2] = [0.1, 1.0]
+
+	fractions = exceedanceFractions(values, segments, threshold_inch, nodata=-9999)
+
+	assert fractions.shape == (5, counts.size, len(threshold_inch))
+	for t in range(values.shape[0]):
+		for n in range(counts.size):
+			cells = values[t, segments["labels"] == n]
+			cells = cells[cells != -9999]
+			for j, threshold in enumerate(threshold_inch):
+				expected = (cells >= threshold).mean() if cells.size > 0 else 0.
+				assert fractions[t, n, j] == pytest.approx(expected)
@@ -0,0 +1,123 @@
+"""-------------------------------------------------------------
+	Script Name: 	test_run_state.py
+	Description: 	Run-state claims of new, abandoned and changed-source hours
+-------------------------------------------------------------"""
+
+import os, time, sqlite3, subprocess, sys
+import pytest
+
+import run_state
+from run_state import openState, recordSources, claimHours, recordConversions, recordStats, sourceChanged, \
+	convertedHours, statsHours, pendingStatsInits
+
+init = "2026010100"
+
+@pytest.fixture
+def conn(tmp_path):
+	return openState(str(tmp_path / "run_state.sqlite"))
+
+def result(fhr, status):
+	return { "init": init, "fhr": fhr, "status": status, "seconds": 1.5, "error": "Traceback\nValueError: bad" if status == "failed" else None }
+
+def hour(conn, fhr):
+	return conn.execute("SELECT * FROM hours WHERE init = ? AND fhr = ?", (init, fhr)).fetchone()
+
+def deadWorker():
+	proc = subprocess.Popen([sys.executable, "-c", "pass"])
+	proc.wait()
+	return "%s:%d" % (os.uname()[1], proc.pid)
+
+#-------------------------------------------------------
+# Tests
+#------------------------------------------------------
+def test_claim_new_hours_once(conn):
+	recordSources(conn, init, { 1: (100, 1), 2: (100, 1), 3: (100, 1) })
+
+	assert claimHours(conn, init, worker="a") == [1, 2, 3]
+	# this process is still running, so its claims are not taken
+	assert claimHours(conn, init, worker="b") == []
+
+def test_claim_limited_to_fhrs(conn):
+	recordSources(conn, init, { 1: (100, 1), 2: (100, 1), 3: (100, 1) })
+
+	assert claimHours(conn, init, fhrs=[2, 3, 4]) == [2, 3]
+	assert claimHours(conn, init) == [1]
+
+def test_reclaim_timed_out_claim(conn):
+	recordSources(conn, init, { 1: (100, 1), 2: (100, 1) })
+	claimHours(conn, init, worker="remote-host:1")
+	conn.execute("UPDATE hours SET claimed_at = ? WHERE fhr = 1", (time.time() - run_state.claim_timeout - 1,))
+
+	assert claimHours(conn, init, worker="b") == [1]
+	assert hour(conn, 1)["claimed_by"] == "b"
+
+def test_reclaim_claim_of_dead_process(conn):
+	recordSources(conn, init, { 1: (100, 1) })
+	claimHours(conn, init, worker=deadWorker())
+
+	assert claimHours(conn, init, worker="b") == [1]
+
+def test_failed_hours_until_max_attempts(conn):
+	recordSources(conn, init, { 1: (100, 1) })
+
+	for attempt in range(run_state.max_attempts):
+		assert claimHours(conn, init) == [1]
+		recordConversions(conn, [result(1, "failed")])
+
+	assert claimHours(conn, init) == []
+	assert hour(conn, 1)["convert_error"] == "ValueError: bad"
+
+def test_unchanged_source_stays_converted(conn):
+	recordSources(conn, init, { 1: (100, 1) })
+	claimHours(conn, init)
+	recordConversions(conn, [result(1, "converted")])
+	recordSources(conn, init, { 1: (100, 1) })
+
+	assert claimHours(conn, init) == []
+	assert not sourceChanged(conn, init, 1)
+	assert convertedHours(conn, init) == [1]
+
+def test_reclaim_changed_source(conn):
+	recordSources(conn, init, { 1: (100, 1), 2: (100, 1) })
+	claimHours(conn, init)
+	recordConversions(conn, [result(1, "converted"), result(2, "converted")])
+	recordStats(conn, init, [1, 2], "done")
+
+	recordSources(conn, init, { 1: (120, 2), 2: (100, 1) })
+
+	assert claimHours(conn, init) == [1]
+	assert sourceChanged(conn, init, 1)
+	assert not sourceChanged(conn, init, 2)
+	assert statsHours(conn, init) == [2]
+
+	recordConversions(conn, [result(1, "converted")])
+
+	assert not sourceChanged(conn, init, 1)
+	assert hour(conn, 1)["stats_status"] == "pending"
+	assert pendingStatsInits(conn) == [init]
+
+def test_no_qpf_hours_are_not_pending(conn):
+	recordSources(conn, init, { 1: (100, 1), 2: (100, 1) })
+	claimHours(conn, init)
+	recordConversions(conn, [result(1, "converted"), result(2, "no_qpf")])
+
+	assert hour(conn, 2)["stats_status"] == "skipped"
+	assert pendingStatsInits(conn) == [init]
+
+	recordStats(conn, init, [1], "done")
+	assert pendingStatsInits(conn) == []
+
+def test_migrate_version_1_store(tmp_path):
+	db_file = str(tmp_path / "old.sqlite")
+	old = sqlite3.connect(db_file)
+	old.executescript(run_state.schema.replace("source_changed INTEGER NOT NULL DEFAULT 0,", ""))
+	old.execute("INSERT INTO hours (init, fhr, source_size, source_mtime_ns) VALUES (?, 1, 100, 1)", (init,))
+	old.execute("PRAGMA user_version = 1")
+	old.commit()
+	old.close()
+
+	conn = openState(db_file)
+	recordSources(conn, init, { 1: (200, 2) })
+
+	assert conn.execute("PRAGMA user_version").fetchone()[0] == run_state.state_version
+	assert sourceChanged(conn, init, 1)
@@ -0,0 +1,323 @@
+#!/usr/local/anaconda3/envs/py37/bin/python
+
+"""-------------------------------------------------------------
+	Script Name: 	watch_nbm_qpf.py
+	Description: 	Convert and evaluate new NBM QPF hours as their Grib2 files arrive
+-------------------------------------------------------------"""
+
+#---------------------------------------------------------------
+# Import python packages
+#---------------------------------------------------------------
+import os, sys, re, datetime, time, traceback, argparse
+from process_nbm_qpf import convertHour, hourConverted, makeOutputDirs, initWorker, printSummary, recordMetrics, nbm_dir
+from process_nbm_qpf import process_again as convert_again, use_run_state, removeOldData as removeOldGeoTiffs
+from find_nbm_qpf_stats import evaluateRun, processRun, publishData, removeOldData as removeOldOutput
+from run_state import openState, recordSources, claimHours, recordConversions
+from pipeline_metrics import startRun, finishRun, event
+
+# inotify is optional, without it (or on file systems that do not deliver its events) new files are polled for
+try:
+	import inotify_simple
+except ImportError:
+	inotify_simple = None
+
+#-------------------------------------------------------
+# Global configuration options
+#-------------------------------------------------------
+
+# init directories (nbm_dir/YYYYMMDD/HHZ) watched, hours back from now
+watch_hours = 6
+
+# a Grib2 file is processed once its size and mtime have not changed for this long
+debounce_seconds = 5
+
+# full rescans: every poll_seconds without inotify, every rescan_seconds with it (safety net)
+poll_seconds = 30
+rescan_seconds = 600
+
+# run retention every maintenance_seconds
+maintenance_seconds = 3600
+
+# only update and publish a run's stats once shouldProcess passes (75% of hours), like the cron
+# run; False updates them on every new hour
+stats_gate = True
+
+grib_pattern = re.compile(r"^blend\.t(\d{2})z\.core\.f(\d{3})\.co\.grib2$")
+
+#-------------------------------------------------------
+# Init directories and Grib2 files being watched
+#------------------------------------------------------
+def initDir(dt):
+	return nbm_dir + "/" + dt.strftime("%Y%m%d") + "/" + dt.strftime("%H") + "Z"
+
+def watchedInits(now=None):
+	"""
+	this function will return the init times of the last watch_hours hours, newest first
+	"""
+	now = (now or datetime.datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+	return [ now - datetime.timedelta(hours=h) for h in range(0, watch_hours + 1) ]
+
+def gribHour(dt, name):
+	"""
+	this function will return the forecast hour of a Grib2 file name of init dt, or None
+	"""
+	match = grib_pattern.match(name)
+	if match is None or int(match.group(1)) != dt.hour:
+		return None
+	return int(match.group(2))
+
+def scanInit(dt):
+	"""
+	this function will return {(dt, fhr): (path, size, mtime_ns)} of the Grib2 files of an init
+	"""
+	files = {}
+
+	try:
+		entries = list(os.scandir(initDir(dt)))
+	except (IOError, OSError):
+		return files
+
+	for entry in entries:
+		fhr = gribHour(dt, entry.name)
+		if fhr is not None:
+			try:
+				info = entry.stat()
+			except OSError:
+				continue
+			files[(dt, fhr)] = (entry.path, info.st_size, info.st_mtime_ns)
+
+	return files
+
+#-------------------------------------------------------
+# inotify watches
+#------------------------------------------------------
+def openInotify():
+	"""
+	this function will return an inotify instance, or None when it is unavailable
+	"""
+	if inotify_simple is None:
+		return None
+
+	try:
+		return inotify_simple.INotify()
+	except OSError as err:
+		print("inotify unavailable, polling: %s" % err)
+		return None
+
+def updateWatches(inotify, watches, inits):
+	"""
+	this function will watch nbm_dir, the date directories and the init directories of inits
+	(new directories, finished and renamed files) and drop the watches of expired directories
+	watches maps path to watch descriptor
+	"""
+	flags = inotify_simple.flags
+	dir_mask = flags.CREATE | flags.MOVED_TO
+	file_mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+
+	wanted = { nbm_dir: dir_mask }
+	for dt in inits:
+		wanted[nbm_dir + "/" + dt.strftime("%Y%m%d")] = dir_mask
+		wanted[initDir(dt)] = file_mask
+
+	for path, mask in wanted.items():
+		if path not in watches and os.path.isdir(path):
+			try:
+				watches[path] = inotify.add_watch(path, mask)
+			except OSError:
+				continue
+
+	for path in [ p for p in watches if p not in wanted ]:
+		try:
+			inotify.rm_watch(watches.pop(path))
+		except OSError:
+			continue
+
+#-------------------------------------------------------
+# Process ready forecast hours
+#------------------------------------------------------
+def needsConversion(dt, fhr):
+	return convert_again or not hourConverted(dt, fhr)
+
+def processHours(hours):
+	"""
+	this function will convert the ready (init, fhr) hours and update the stats of their inits
+	once each (gated by shouldProcess with stats_gate), then publish the changes
+	with the run-state store only the hours claimed here are converted, hours another process
+	is converting (cron run, backfill) or has converted are left to it
+	"""
+	startRun("watch_nbm_qpf")
+
+	if use_run_state:
+		conn = openState()
+		claimed = []
+		for dt in sorted(set(dt for dt, fhr in hours)):
+			fhrs = claimHours(conn, dt.strftime("%Y%m%d%H"), fhrs=[ fhr for d, fhr in hours if d == dt ])
+			claimed.extend((dt, fhr) for fhr in fhrs)
+
+		if len(claimed) < len(hours):
+			print("Skipping %d hours claimed or converted by another process" % (len(hours) - len(claimed)))
+		hours = claimed
+
+	if len(hours) == 0:
+		finishRun(inits=[])
+		return
+
+	results = []
+	inits = sorted(set(dt for dt, fhr in hours))
+
+	for dt, fhr in sorted(hours):
+		makeOutputDirs(dt)
+		results.append(convertHour(dt, fhr))
+
+	printSummary(results)
+	recordMetrics(results)
+
+	if use_run_state:
+		recordConversions(openState(), results)
+
+	evaluated = 0
+
+	for dt in inits:
+		try:
+			if stats_gate:
+				evaluated += processRun(dt)
+			else:
+				evaluateRun(dt)
+				evaluated += 1
+		except Exception as err:
+			print(traceback.format_exc())
+
+	# partial runs held back by the gate are not published
+	if evaluated > 0:
+		try:
+			publishData()
+		except Exception as err:
+			print(traceback.format_exc())
+
+	event("watch_batch", hours=[ "%s f%03d" % (dt.strftime("%Y%m%d%H"), fhr) for dt, fhr in sorted(hours) ])
+	finishRun(inits=[ dt.strftime("%Y%m%d%H") for dt in inits ])
+
+def maintenance():
+	"""
+	this function will remove expired GeoTiffs, images and run output
+	"""
+	startRun("watch_nbm_qpf_maintenance")
+
+	for remove in [removeOldGeoTiffs, removeOldOutput]:
+		try:
+			remove()
+		except Exception as err:
+			print(traceback.format_exc())
+
+	finishRun()
+
+#-------------------------------------------------------
+# Watch loop
+#------------------------------------------------------
+def watch(poll=False, once=False):
+	"""
+	this function will wait for Grib2 files to arrive (inotify events, or scans every poll_seconds),
+	debounce them until unchanged for debounce_seconds, and process the ready hours in one batch
+	catalogs, fire masks and remap tables stay cached in this process between batches
+	"""
+	inotify = None if (poll or once) else openInotify()
+	watches = {}
+
+	print("Watching %s (%s)" % (nbm_dir, "inotify" if inotify is not None else "polling every %ds" % poll_seconds))
+
+	seen = {}       # (dt, fhr) -> (size, mtime_ns) last processed
+	pending = {}    # (dt, fhr) -> (size, mtime_ns, time the file last changed)
+	next_scan = 0.
+	next_maintenance = time.time() + maintenance_seconds
+
+	while True:
+
+		inits = watchedInits()
+
+		if inotify is not None:
+			updateWatches(inotify, watches, inits)
+
+		# block until the next scan, an inotify event or a pending file's debounce check
+		timeout = next_scan - time.time()
+		if pending:
+			timeout = min(timeout, debounce_seconds)
+
+		changed_inits = set(key[0] for key in pending)
+
+		if timeout > 0:
+			if inotify is not None:
+				for event_ in inotify.read(timeout=int(timeout * 1000)):
+					if event_.mask & inotify_simple.flags.ISDIR:
+						updateWatches(inotify, watches, inits)
+						changed_inits.update(inits)
+					changed_inits.update(dt for dt in inits if watches.get(initDir(dt)) == event_.wd)
+			else:
+				time.sleep(timeout)
+
+		# full scan at start and every poll (or rescan) interval
+		if time.time() >= next_scan:
+			changed_inits.update(inits)
+			next_scan = time.time() + (poll_seconds if inotify is None else rescan_seconds)
+
+		for dt in changed_inits:
+			for key, (path, size, mtime_ns) in scanInit(dt).items():
+				if seen.get(key) == (size, mtime_ns):
+					continue
+				if key not in pending:
+					pending[key] = (size, mtime_ns, min(time.time(), mtime_ns / 1e9))
+				elif pending[key][:2] != (size, mtime_ns):
+					pending[key] = (size, mtime_ns, time.time())
+
+		# hours whose files are done changing
+		now = time.time()
+		hours = []
+
+		for key in [ key for key, (size, mtime_ns, changed) in pending.items() if now - changed >= debounce_seconds ]:
+			seen[key] = pending.pop(key)[:2]
+			if needsConversion(*key):
+				hours.append(key)
+
+		if use_run_state:
+			for dt in set(key[0] for key in hours):
+				recordSources(openState(), dt.strftime("%Y%m%d%H"), { fhr: seen[(d, fhr)] for d, fhr in hours if d == dt })
+
+		if len(hours) > 0:
+			try:
+				processHours(hours)
+			except Exception as err:
+				print(traceback.format_exc())
+
+		# forget the files of inits no longer watched
+		for table in [seen, pending]:
+			for key in [ key for key in table if key[0] not in inits ]:
+				table.pop(key)
+
+		if time.time() >= next_maintenance:
+			maintenance()
+			next_maintenance = time.time() + maintenance_seconds
+
+		if once and len(pending) == 0:
+			return
+
+def main():
+
+	start = datetime.datetime.utcnow()
+	print("\nScript executed at " + start.strftime("%a %b %d, %Y %H:%M:%S Z\n"))
+
+	parser = argparse.ArgumentParser(description="Convert and evaluate new NBM QPF hours as their Grib2 files arrive")
+	parser.add_argument("--poll", action="store_true", help="scan for new files every poll_seconds instead of using inotify")
+	parser.add_argument("--once", action="store_true", help="process what is ready now and exit (cron fallback)")
+	args = parser.parse_args()
+
+	initWorker()
+
+	try:
+		watch(poll=args.poll, once=args.once)
+	except KeyboardInterrupt:
+		print("\nStopped")
+
+	end = datetime.datetime.utcnow()
+	print("\nScript completed at " + end.strftime("%a %b %d, %Y %H:%M:%S Z"))
+
+if __name__ == "__main__":
+    main()